@@ -7,6 +7,15 @@
 # Enable debug logging for all components.
 # debug = False
 
+# Logging
+# Log records are written by a background thread. They are formatted as text
+# or, with log_format = 'json', as one JSON object per line including the
+# structured fields of the records. High rate debug records of a logger can
+# be sampled: with 'pyaiot.broker=100', only one debug record out of 100 of
+# the broker logger and of its children is kept. Rates are integers >= 1.
+# log_format = 'text'
+# log_sampling = []
+
 # Broker host:
 # Other component connect to this host for their broker connection. The
 # dashboard passes this hostname to the clients for their broker connection.
@@ -18,6 +27,159 @@
 # number to connect to.
 # broker_port = 8020
 
+# Wire format
+# Encoding requested by gateways for their broker connection: 'json',
+# 'msgpack' or 'cbor'. Binary formats require the corresponding python package,
+# installed with the pyaiot[msgpack] or pyaiot[cbor] extras, and fall back to
+# 'json' when the broker does not support them. Web clients always use 'json'.
+# JSON is encoded and decoded with orjson or ujson when installed, with the
+# json module of the standard library otherwise.
+# wire_format = 'json'
+
+# Websocket compression
+# Enable the permessage-deflate extension on the websocket connections between
+# nodes, gateways, brokers and web clients. The compression level (0-9) and
+# memory level (1-9) apply to all connections. Messages broadcast by the
+# broker are compressed once and shared by all web clients, using a window of
+# ws_compression_wbits (9-15) bits; messages smaller than
+# ws_compression_threshold bytes are sent uncompressed.
+# ws_compression = False
+# ws_compression_level = 6
+# ws_compression_mem_level = 8
+# ws_compression_wbits = 15
+# ws_compression_threshold = 256
+
+# Client queue size
+# The broker queues at most this many messages for each web client. Messages
+# are queued when a client cannot read them as fast as they are produced.
+# client_queue_size = 1000
+
+# Client queue policy
+# What the broker does when the queue of a web client is full:
+# - 'drop-oldest': drop the oldest queued node update
+# - 'keep-latest': only keep the latest queued value of a node resource
+# - 'disconnect': close the connection with the client
+# Dropped messages are counted in pyaiot_broker_client_dropped_frames_total.
+# client_queue_policy = 'drop-oldest'
+
+# Update coalescing
+# When greater than 0, the broker only broadcasts the latest value of each
+# node resource every given number of milliseconds (50 or 250 for example).
+# Node announces, removals and resets are always sent immediately.
+# update_coalescing = 0
+
+# Replay buffer size
+# Messages broadcast by the broker carry a sequence number. The broker keeps
+# this many of them so that a reconnecting web client only receives the ones
+# it missed; when they are not available anymore the client receives all
+# nodes again. Each worker has its own epoch and a reconnecting client lands
+# on any worker, so with several workers sessions are generally not resumed
+# and clients receive all nodes again.
+# replay_buffer_size = 1000
+
+# Latency tracing
+# Gateways add trace timestamps to the node updates they send: when the data
+# was received from the node and when it was sent to the broker. The broker
+# adds its own receive and send timestamps and the dashboard reports when it
+# rendered the update, for at most one update per second. Per hop latency
+# histograms are available on the /metrics endpoint of the broker and of the
+# gateways. Gateways without HTTP server serve their metrics on
+# gateway_metrics_port. Hops between hosts are only meaningful when their
+# clocks are synchronized.
+# trace = False
+# gateway_metrics_port = None
+
+# Gateway batches
+# When batch_interval is greater than 0, gateways accumulate the messages sent
+# to the broker for this many milliseconds (or until batch_size messages) and
+# send them in a single batch message. The broker forwards them to the web
+# clients announcing the 'batch' feature in a single batch as well. Brokers
+# announce the batch and snapshot messages they accept in the
+# X-Pyaiot-Features header of the websocket handshake, gateways connected to
+# an older broker send their messages one by one.
+# batch_interval = 0
+# batch_size = 100
+
+# Typed values
+# Gateways add to the node updates the typed form of their values (a number,
+# a number with a unit or a vector), used by the broker history instead of
+# parsing the strings. Only finite numbers are typed, and only with a known
+# unit (see pyaiot.common.values.UNITS, extended with register_unit): values
+# like '6LoWPAN' or '12:30' stay strings. value_parsers selects the parser of
+# some endpoints among 'auto' (the default), 'number', 'vector' and 'string'
+# (no typed form), e.g. ['name=string', 'imu=string'].
+# value_parsers = []
+
+# Admission control
+# After a broker restart, all gateways and web clients reconnect at once. The
+# broker accepts admission_burst websocket upgrades at once, then
+# admission_rate upgrades per second (0 to accept all), separately for
+# gateways and web clients. Rejected upgrades get a 503 response with a
+# Retry-After hint, honored by gateways and peer brokers.
+# admission_rate = 0
+# admission_burst = 50
+
+# Resources history
+# The broker keeps the last history_size samples of each numeric resource
+# in memory, served on /history/<uid>/<endpoint>. history_sizes overrides
+# the size of some endpoints, e.g. ['temperature=3600', 'name=0'] (0 to keep
+# no history).
+# history_size = 1000
+# history_sizes = []
+
+# Telemetry log
+# When telemetry_dir is set, the broker appends all node updates to segment
+# files in that directory, so the history survives restarts. Updates are
+# written and synced in batches every telemetry_flush_interval ms, outside
+# of the thread serving the websockets, a new
+# segment is started above telemetry_segment_size bytes or
+# telemetry_segment_age seconds. Segments older than telemetry_retention
+# seconds (a week by default, 0 to keep them) are deleted when a new one is
+# started. History queries with a start ('since' or 'last') older than the
+# in-memory samples are read from the log.
+# telemetry_dir = None
+# telemetry_segment_size = 67108864
+# telemetry_segment_age = 3600
+# telemetry_retention = 604800
+# telemetry_flush_interval = 1000
+
+# Client commands
+# Each web client may send client_command_burst messages of a type at once,
+# then the rate per second given for that type in client_command_rates, e.g.
+# ['update=10', 'subscribe=2'] (types not listed are not limited). Commands
+# are forwarded to the gateways round-robin between clients, at most
+# command_rate per second overall (0 for no limit). An update queued for a
+# node endpoint is replaced by a newer one, other messages over budget are
+# dropped.
+# command_rate = 0
+# client_command_rates = []
+# client_command_burst = 10
+
+# Token cache
+# Time in seconds a verified gateway token is remembered by the broker so
+# reconnecting gateways don't need to be verified again (0 to disable).
+# token_cache_ttl = 300
+
+# Broker workers
+# Number of broker processes accepting client and gateway connections on the
+# broker port. Workers exchange node events over unix sockets created in
+# workers_ipc_dir (a temporary directory when None, removed when the broker
+# stops), so that any worker can reach any client or gateway. The metrics,
+# the admission control and the node cache are per worker: /metrics and
+# /nodes only reflect the worker serving the request.
+# workers = 1
+# workers_ipc_dir = None
+
+# Broker peers
+# List of other brokers ('host:port' or 'ws://host:port/peer') this broker
+# exchanges node events with. Gateways and clients can then connect to any
+# of the federated brokers. Peer brokers must share the same key file. When
+# two brokers list each other, only one link is kept between them; with
+# several workers a link has to be configured on one side only. Node events
+# are not relayed transitively: a broker only serves the nodes of the brokers
+# it is directly linked with.
+# peers = []
+
 # Key file
 # The key file is necessary to authenticate different components to the broker.
 # Both the broker and the other components use the path specified to find the
@@ -0,0 +1,68 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Admission control of websocket upgrades."""
+
+import math
+
+from .ratelimit import TokenBucket
+
+ADMISSION_RATE = 0
+ADMISSION_BURST = 50
+MAX_RETRY_AFTER = 60
+
+
+class Admission(TokenBucket):
+    """Token bucket pacing the websocket upgrades accepted by the broker.
+
+    At most `burst` upgrades are accepted at once, then `rate` per second.
+    A rate of 0 accepts everything.
+
+    >>> admission = Admission(rate=1, burst=2)
+    >>> admission.admit(), admission.admit()
+    (None, None)
+    >>> admission.admit(), admission.admit()
+    (2, 3)
+    """
+
+    def __init__(self, rate=ADMISSION_RATE, burst=ADMISSION_BURST):
+        super().__init__(rate, burst)
+
+    def admit(self):
+        """Admit an upgrade.
+
+        None is returned when accepted, otherwise the number of seconds after
+        which the client should retry. Each rejected client reserves a later
+        slot, so that rejected clients don't all come back at the same time.
+        """
+        if self.take():
+            return None
+        self._tokens = max(self._tokens - 1, -MAX_RETRY_AFTER * self.rate)
+        return min(MAX_RETRY_AFTER,
+                   max(1, math.ceil((1 - self._tokens) / self.rate)))
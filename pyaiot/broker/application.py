@@ -29,13 +29,105 @@
 
 """Broker application module."""
 
+import os
 import sys
-from tornado.options import options
+import shutil
+import tempfile
+from tornado.netutil import bind_sockets
+from tornado.options import define, options
+from tornado.process import fork_processes
 
-from pyaiot.common.auth import check_key_file
+from pyaiot.common.auth import check_key_file, TOKEN_CACHE_TTL
 from pyaiot.common.helpers import start_application, parse_command_line
 
+from .admission import ADMISSION_RATE, ADMISSION_BURST
 from .broker import Broker, logger
+from .commands import COMMAND_RATE, COMMAND_BURST
+from .history import HISTORY_SIZE
+from .telemetry import SEGMENT_SIZE, SEGMENT_AGE, FLUSH_INTERVAL, RETENTION
+from .outbound import QUEUE_SIZE, QUEUE_POLICIES, DROP_OLDEST
+from .replay import REPLAY_BUFFER_SIZE
+
+
+def extra_args():
+    """Parse command line arguments for the broker application."""
+    if not hasattr(options, "client_queue_size"):
+        define("client_queue_size", default=QUEUE_SIZE,
+               help="Maximum number of messages queued for a web client")
+    if not hasattr(options, "client_queue_policy"):
+        define("client_queue_policy", default=DROP_OLDEST,
+               help="Policy applied when a web client queue is full: {}"
+               .format(", ".join(QUEUE_POLICIES)))
+    if not hasattr(options, "update_coalescing"):
+        define("update_coalescing", default=0,
+               help="Period (in ms) at which node updates are coalesced "
+                    "before being broadcast, 0 to disable")
+    if not hasattr(options, "replay_buffer_size"):
+        define("replay_buffer_size", default=REPLAY_BUFFER_SIZE,
+               help="Number of broadcast messages kept for replay to "
+                    "reconnecting web clients")
+    if not hasattr(options, "history_size"):
+        define("history_size", default=HISTORY_SIZE,
+               help="Number of samples kept per numeric node resource, 0 to "
+                    "disable the history")
+    if not hasattr(options, "history_sizes"):
+        define("history_sizes", default=[], multiple=True,
+               help="Comma separated list of endpoint=size overriding the "
+                    "history size of some endpoints")
+    if not hasattr(options, "telemetry_dir"):
+        define("telemetry_dir", default=None,
+               help="Directory of the log of the node updates, disabled by "
+                    "default")
+    if not hasattr(options, "telemetry_segment_size"):
+        define("telemetry_segment_size", default=SEGMENT_SIZE,
+               help="Size (in bytes) above which a new log segment is "
+                    "started")
+    if not hasattr(options, "telemetry_segment_age"):
+        define("telemetry_segment_age", default=SEGMENT_AGE,
+               help="Age (in s) above which a new log segment is started")
+    if not hasattr(options, "telemetry_retention"):
+        define("telemetry_retention", default=RETENTION,
+               help="Age (in s) above which log segments are deleted, 0 to "
+                    "keep them forever")
+    if not hasattr(options, "telemetry_flush_interval"):
+        define("telemetry_flush_interval", default=FLUSH_INTERVAL,
+               help="Period (in ms) at which the logged updates are written "
+                    "and synced to disk")
+    if not hasattr(options, "token_cache_ttl"):
+        define("token_cache_ttl", default=TOKEN_CACHE_TTL,
+               help="Time (in s) a verified gateway token is cached, 0 to "
+                    "disable")
+    if not hasattr(options, "admission_rate"):
+        define("admission_rate", default=ADMISSION_RATE, type=float,
+               help="Websocket upgrades accepted per second, separately for "
+                    "gateways and web clients, 0 to accept all")
+    if not hasattr(options, "admission_burst"):
+        define("admission_burst", default=ADMISSION_BURST,
+               help="Websocket upgrades accepted at once above the "
+                    "admission rate")
+    if not hasattr(options, "command_rate"):
+        define("command_rate", default=COMMAND_RATE, type=float,
+               help="Client commands forwarded to the gateways per second, "
+                    "shared fairly between clients, 0 for no limit")
+    if not hasattr(options, "client_command_rates"):
+        define("client_command_rates", default=[], multiple=True,
+               help="Comma separated list of type=rate limits of the "
+                    "messages per second of each web client")
+    if not hasattr(options, "client_command_burst"):
+        define("client_command_burst", default=COMMAND_BURST,
+               help="Messages of a type accepted at once from a web client "
+                    "above its rate")
+    if not hasattr(options, "workers"):
+        define("workers", default=1,
+               help="Number of broker worker processes sharing the port")
+    if not hasattr(options, "workers_ipc_dir"):
+        define("workers_ipc_dir", default=None,
+               help="Directory of the unix sockets used by the workers to "
+                    "communicate, a temporary directory by default")
+    if not hasattr(options, "peers"):
+        define("peers", default=[], multiple=True,
+               help="Comma separated list of peer brokers (host:port or "
+                    "websocket url) to federate with")
 
 
 def run(arguments=[]):
@@ -44,12 +136,17 @@ def run(arguments=[]):
         sys.argv[1:] = arguments
 
     try:
-        parse_command_line()
+        parse_command_line(extra_args_func=extra_args)
     except SyntaxError as exc:
-        logger.error("Invalid config file: {}".format(exc))
+        logger.error("Invalid config file: %s", exc)
         return
     except FileNotFoundError as exc:
-        logger.error("Config file not found: {}".format(exc))
+        logger.error("Config file not found: %s", exc)
+        return
+
+    if options.client_queue_policy not in QUEUE_POLICIES:
+        logger.error("Invalid client queue policy: %s",
+                     options.client_queue_policy)
         return
 
     try:
@@ -58,8 +155,28 @@ def run(arguments=[]):
         logger.error(exc)
         return
 
-    start_application(Broker(keys, options=options),
-                      port=options.broker_port)
+    if options.workers <= 1:
+        start_application(Broker(keys, options=options),
+                          port=options.broker_port)
+        return
+
+    # Sockets are bound before forking so that all workers accept
+    # connections on the same port.
+    sockets = bind_sockets(int(options.broker_port))
+    ipc_dir = None
+    if options.workers_ipc_dir is None:
+        ipc_dir = tempfile.mkdtemp(prefix="pyaiot-broker-")
+        options.workers_ipc_dir = ipc_dir
+    parent = os.getpid()
+    try:
+        worker = fork_processes(options.workers)
+    finally:
+        # Only the parent process leaves fork_processes with an exception,
+        # once all the workers exited or when interrupted
+        if ipc_dir is not None and os.getpid() == parent:
+            shutil.rmtree(ipc_dir, ignore_errors=True)
+    start_application(Broker(keys, options=options, worker=worker),
+                      sockets=sockets)
 
 
 if __name__ == '__main__':
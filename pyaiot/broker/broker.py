@@ -29,31 +29,113 @@
 
 """Broker tornado application module."""
 
+import time
+import bisect
 import uuid
+import asyncio
 import logging
+from contextlib import contextmanager
 from tornado import web, websocket
-
-from pyaiot.common.auth import verify_auth_token
-from pyaiot.common.messaging import Message
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
+
+from pyaiot.common.auth import TokenCache
+from pyaiot.common.compression import compression_options, negotiated_deflate
+from pyaiot.common.messaging import (
+    Message, select_wire_format, wire_subprotocol, json_codec, JSON,
+    BATCH, SNAPSHOT, CLIENT_SCHEMAS, GATEWAY_SCHEMAS, GATEWAY_FEATURES,
+    FEATURES_HEADER, New, Update
+)
+from pyaiot.common.metrics import CONTENT_TYPE
+from pyaiot.common.trace import (
+    BROKER_HOPS, BROKER_IN, BROKER_OUT, CLIENT_HOPS, CLIENT_IN
+)
+
+from .admission import Admission
+from .cache import NodeCache
+from .commands import CommandScheduler, parse_rates, DROPPED
+from .federation import Federation
+from .frames import Frames
+from .history import (
+    History, DOWNSAMPLING, BUCKETS, downsample, parse_sizes
+)
+from .metrics import BrokerMetrics
+from .outbound import OutboundQueue
+from .replay import ReplayBuffer
+from .subscriptions import Subscriptions, WILDCARD
+from .telemetry import SegmentLog
+from .workers import WorkerBus
 
 logger = logging.getLogger("pyaiot.broker")
 
 
-class BrokerWebsocketGatewayHandler(websocket.WebSocketHandler):
+class WireFormatMixin():
+    """Negotiates the wire format of a websocket with its subprotocols.
+
+    JSON text frames are used unless the peer offers a 'pyaiot.<format>'
+    subprotocol for a supported binary format.
+    """
+
+    wire_format = JSON
+
+    def select_subprotocol(self, subprotocols):
+        self.wire_format = select_wire_format(subprotocols)
+        if self.wire_format == JSON:
+            return None
+        return wire_subprotocol(self.wire_format)
+
+
+class CompressionMixin():
+    """Negotiates permessage-deflate from the broker options."""
+
+    def get_compression_options(self):
+        return compression_options(self.application.options)
+
+
+class AdmissionMixin():
+    """Paces websocket upgrades with the broker admission control.
+
+    Upgrades above the admission rate are rejected before any other check
+    with a 503 status and a Retry-After hint.
+    """
+
+    admission = 'client'
+
+    def prepare(self):
+        retry_after = self.application.admission[self.admission].admit()
+        if retry_after is not None:
+            logger.debug("Reject %s websocket upgrade, retry after %ss",
+                         self.admission, retry_after)
+            self.application.metrics.rejected_upgrades.inc(
+                kind=self.admission)
+            self.set_status(503)
+            self.set_header('Retry-After', retry_after)
+            self.finish("Too many connection requests")
+
+
+class BrokerWebsocketGatewayHandler(WireFormatMixin, CompressionMixin,
+                                    AdmissionMixin,
+                                    websocket.WebSocketHandler):
+
+    uid = None
+    peer = False
+    admission = 'gateway'
 
     def check_origin(self, origin):
         """Allow connections from anywhere."""
         return True
 
     def _check_subprotocols(self, subprotocols):
-        if len(subprotocols) != 2 or subprotocols[0].strip() != 'token':
+        # The 'token' subprotocol is followed by the token and optionally by
+        # the requested wire formats.
+        if len(subprotocols) < 2 or subprotocols[0].strip() != 'token':
             logger.warning("Reject websocket connection: invalib subprotocol")
             self.set_status(401)  # Authentication failed
             self.finish("Invalid subprotocols")
             return False
 
         req_token = subprotocols[1].strip()
-        if not verify_auth_token(req_token, self.application.keys):
+        if not self.application.tokens.verify(req_token):
             logger.info("Gateway websocket authentication failed, "
                         "invalid token.")
             self.set_status(401)  # Authentication failed
@@ -74,33 +156,77 @@ class BrokerWebsocketGatewayHandler(websocket.WebSocketHandler):
         if not self._check_subprotocols(subprotocols):
             return
 
+        # Gateways only send the batch and snapshot messages announced here
+        self.set_header(FEATURES_HEADER, ','.join(GATEWAY_FEATURES))
+
         # Let parent class correctly configure the websocket connection
         await super(BrokerWebsocketGatewayHandler, self).get(*args, **kwargs)
 
     async def open(self):
         """Discover nodes on each opened connection."""
+        self.uid = str(uuid.uuid4())
         self.set_nodelay(True)
-        self.application.gateways.update({self: []})
+        self.application.add_gateway(self)
+        if self.application.workers is not None:
+            self.application.workers.add_gateway(self)
         logger.info("New gateway websocket opened")
 
+    def write_message(self, message, binary=False):
+        """Write a message to the gateway in the negotiated wire format."""
+        if self.wire_format != JSON and isinstance(message, str):
+            message = Message.serialize(json_codec.loads(message),
+                                        self.wire_format)
+            binary = True
+        return super().write_message(message, binary=binary)
+
     def on_message(self, raw):
         """Triggered when a message is received from the broker child."""
-        message, reason = Message.check_message(raw)
+        message, reason = Message.check_message(raw, self.wire_format,
+                                                GATEWAY_SCHEMAS)
         if message is not None:
-            self.application.on_gateway_message(self, message)
+            frames = Frames(message, raw, self.wire_format)
+            self.application.on_gateway_message(self, message, frames)
+            if self.application.workers is not None:
+                self.application.workers.publish_gateway_message(
+                    self, frames.raw())
         else:
             logger.debug("Invalid message, closing websocket")
+            self.application.metrics.invalid_messages.inc(source='gateway')
             self.close(code=1003, reason="{}.".format(reason))
 
     def on_close(self):
         """Remove websocket from internal list."""
         logger.info("Gateway websocket closed")
+        if self.application.workers is not None:
+            self.application.workers.remove_gateway(self)
         self.application.remove_ws(self)
 
 
-class BrokerWebsocketClientHandler(websocket.WebSocketHandler):
+class BrokerWebsocketPeerHandler(BrokerWebsocketGatewayHandler):
+    """Websocket handler for the links opened by peer brokers."""
+
+    link = None
+
+    def open(self):
+        self.set_nodelay(True)
+        self.link = self.application.federation.open_link(self)
+
+    def on_message(self, raw):
+        self.application.federation.on_link_message(self.link, raw)
+
+    def on_close(self):
+        if self.link is not None:
+            self.application.federation.close_link(self.link)
+
+
+class BrokerWebsocketClientHandler(WireFormatMixin, CompressionMixin,
+                                   AdmissionMixin,
+                                   websocket.WebSocketHandler):
 
     uid = None
+    queue = None
+    compression = None
+    features = frozenset()
 
     def check_origin(self, origin):
         """Allow connections from anywhere."""
@@ -109,32 +235,241 @@ class BrokerWebsocketClientHandler(websocket.WebSocketHandler):
     def open(self):
         """Discover nodes on each opened connection."""
         self.uid = str(uuid.uuid4())
+        self.queue = OutboundQueue(
+            maxsize=self.application.options.client_queue_size,
+            policy=self.application.options.client_queue_policy,
+            on_drop=self.application.metrics.dropped_frame)
+        # Frames are compressed by the broker, never by the connection
+        self.compression = negotiated_deflate(
+            self.request.headers.get('Sec-WebSocket-Extensions'),
+            self.application.options)
+        self._writing = False
         self.set_nodelay(True)
-        logger.info("New client connection opened '{}'".format(self.uid))
+        logger.info("New client connection opened '%s'", self.uid)
+
+    def send(self, frame, key=None):
+        """Queue a prebuilt websocket frame for this client.
+
+        Frames are written by a single writer coroutine that waits for the
+        previous write to be flushed before writing the next ones, so a slow
+        client only fills its own bounded queue.
+        """
+        if self.ws_connection is None or self.ws_connection.is_closing():
+            return
+
+        if not self.queue.put(frame, key):
+            logger.warning("Client '%s' is too slow, closing connection",
+                           self.uid)
+            self.queue.clear()
+            self.close(code=1008, reason="Client too slow.")
+            return
+
+        if not self._writing:
+            self._writing = True
+            asyncio.ensure_future(self._write_queued())
+
+    def write_frame(self, frame):
+        """Write a prebuilt websocket frame to the client stream.
+
+        This bypasses the per connection framing and compression done by
+        `write_message` so a broadcast frame is built and compressed once and
+        shared by all clients.
+        """
+        if self.ws_connection is None or self.ws_connection.is_closing():
+            raise websocket.WebSocketClosedError()
+        return self.ws_connection.stream.write(frame)
+
+    async def _write_queued(self):
+        try:
+            while len(self.queue):
+                await self.write_frame(b''.join(self.queue.drain()))
+        except (websocket.WebSocketClosedError, StreamClosedError):
+            logger.debug("Cannot write to closed client '%s'", self.uid)
+            self.queue.clear()
+        finally:
+            self._writing = False
 
     def on_message(self, raw):
         """Triggered when a message is received from the web client."""
-        message, reason = Message.check_message(raw)
+        message, reason = Message.check_message(raw, self.wire_format,
+                                                CLIENT_SCHEMAS)
         if message is not None:
             message.update({'src': self.uid})
             self.application.on_client_message(self, message)
         else:
             logger.debug("Invalid message, closing websocket")
+            self.application.metrics.invalid_messages.inc(source='client')
             self.close(code=1003, reason="{}.".format(reason))
 
     def on_close(self):
         """Remove websocket from internal list."""
-        logger.info("Client connection closed '{}'".format(self.uid))
+        logger.info("Client connection closed '%s'", self.uid)
+        if self.queue is not None and self.queue.dropped:
+            logger.info("%s messages (%s control) dropped for slow client "
+                        "'%s'", self.queue.dropped, self.queue.dropped_control,
+                        self.uid)
         self.application.remove_ws(self.uid)
 
 
+class BrokerMetricsHandler(web.RequestHandler):
+    """Exposes the broker metrics in the Prometheus text format."""
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(self.application.metrics.expose())
+
+
+class BrokerNodesHandler(web.RequestHandler):
+    """Serves the nodes of the broker cache as JSON.
+
+    `/nodes` returns the resources of all nodes by uid and `/nodes/<uid>`
+    the resources of a single node. The `fields` query argument selects the
+    resources to return, e.g. `/nodes?fields=led,temperature`. The ETag
+    is the cache version, so polling clients get a 304 response until a
+    node changes.
+    """
+
+    def compute_etag(self):
+        # The ETag is set from the cache version, not from the body
+        return None
+
+    def get(self, uid=None):
+        nodes = self.application.nodes
+        if uid is not None and uid not in nodes:
+            raise web.HTTPError(404)
+        version = nodes.version if uid is None else nodes.node_version(uid)
+        # The epoch tells apart the caches of successive brokers or workers
+        self.set_header(
+            'Etag', '"{}-{}"'.format(self.application.replay.epoch, version))
+        self.set_header('Cache-Control', 'no-cache')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        fields = {field for argument in self.get_query_arguments('fields')
+                  for field in argument.split(',') if field}
+
+        def select(resources):
+            if not fields:
+                return resources
+            return {endpoint: value for endpoint, value in resources.items()
+                    if endpoint in fields}
+
+        if uid is None:
+            self.write({node: select(resources)
+                        for node, resources in nodes.items()})
+        else:
+            self.write(select(nodes.resources(uid)))
+
+
+class BrokerHistoryHandler(web.RequestHandler):
+    """Serves the history of a numeric resource as JSON.
+
+    `/history/<uid>/<endpoint>` returns the [time, value] samples of the
+    resource. The window is given with the `since` and `until` timestamps,
+    or with `last` seconds. With `points`, the samples are downsampled
+    either in [time, min, max, mean] buckets or with LTTB, selected with
+    `method`.
+
+    Samples older than the ones kept in memory are read from the telemetry
+    log, in an executor, only for windows with a start.
+    """
+
+    def _argument(self, name, convert, default=None):
+        value = self.get_query_argument(name, None)
+        if value is None:
+            return default
+        try:
+            return convert(value)
+        except ValueError:
+            raise web.HTTPError(400, "Invalid {} argument".format(name))
+
+    async def get(self, uid, endpoint):
+        since = self._argument('since', float)
+        until = self._argument('until', float)
+        last = self._argument('last', float)
+        if last is not None:
+            since = time.time() - last
+        points = self._argument('points', int)
+        if points is not None and points < 1:
+            raise web.HTTPError(400, "Invalid points argument")
+        method = self.get_query_argument('method', BUCKETS)
+        if method not in DOWNSAMPLING:
+            raise web.HTTPError(400, "Invalid method argument")
+
+        history = self.application.history
+        window = history.window(uid, endpoint, since, until)
+        telemetry = self.application.telemetry
+        if (telemetry is not None and since is not None and
+                not history.covers(uid, endpoint, since)):
+            # Samples older than the ones in memory are read from the log
+            times, values = await IOLoop.current().run_in_executor(
+                None, telemetry.window, uid, endpoint, since, until)
+            if window is not None and len(window[0]):
+                older = bisect.bisect_left(times, window[0][0])
+                window = (times[:older] + window[0],
+                          values[:older] + window[1])
+            elif len(times):
+                window = (times, values)
+        if window is None:
+            raise web.HTTPError(404)
+        self.write({'uid': uid, 'endpoint': endpoint,
+                    'method': method if points is not None else None,
+                    'samples': downsample(*window, points, method)})
+
+
 class Broker(web.Application):
-    """Pyaiot broker."""
+    """Pyaiot broker.
 
-    def __init__(self, keys, options):
+    When the broker runs in several worker processes, `worker` is the index
+    of this process and the gateways connected to the other workers are
+    reachable via the workers bus.
+
+    Peer brokers are seen as gateways owning the nodes of their own
+    gateways. Only the first worker connects to the configured peers.
+    """
+
+    def __init__(self, keys, options, worker=None):
         self.keys = keys
+        self.options = options
+        self.tokens = TokenCache(keys, ttl=options.token_cache_ttl)
+        # Gateways and clients are admitted separately, so that a storm of
+        # web clients doesn't prevent gateways from reconnecting
+        self.admission = {
+            kind: Admission(options.admission_rate, options.admission_burst)
+            for kind in ('gateway', 'client')}
+        # gateway => set of uids of the nodes behind the gateway
         self.gateways = {}
+        # node uid => gateway owning the node
+        self.routes = {}
         self.clients = {}
+        self.nodes = NodeCache()
+        self.subscriptions = Subscriptions()
+        # uid => endpoint => latest update waiting for the coalescing tick
+        self._pending_updates = {}
+        # client uid => frames waiting to be sent in a single batch
+        self._client_batches = None
+        self.replay = ReplayBuffer(options.replay_buffer_size)
+        self.history = History(options.history_size,
+                               parse_sizes(options.history_sizes))
+        self.telemetry = None
+        if options.telemetry_dir is not None:
+            # All the workers receive the updates of all the gateways, the
+            # first one writes them to the log, the others only read it
+            self.telemetry = SegmentLog(
+                options.telemetry_dir,
+                segment_size=options.telemetry_segment_size,
+                segment_age=options.telemetry_segment_age,
+                writable=worker is None or worker == 0,
+                retention=options.telemetry_retention)
+        self._telemetry_flush = None
+        self.workers = None
+        self.metrics = BrokerMetrics(self, worker)
+        self.commands = CommandScheduler(
+            self.route_to_gateway, self.metrics.client_commands,
+            rate=options.command_rate,
+            rates=parse_rates(options.client_command_rates),
+            burst=options.client_command_burst)
 
         if options.debug:
             logger.setLevel(logging.DEBUG)
@@ -142,91 +477,452 @@ class Broker(web.Application):
         handlers = [
             (r"/ws", BrokerWebsocketClientHandler),
             (r"/gw", BrokerWebsocketGatewayHandler),
+            (r"/peer", BrokerWebsocketPeerHandler),
+            (r"/metrics", BrokerMetricsHandler),
+            (r"/nodes", BrokerNodesHandler),
+            (r"/nodes/([^/]+)", BrokerNodesHandler),
+            (r"/history/([^/]+)/([^/]+)", BrokerHistoryHandler),
         ]
         settings = {'debug': True}
+        if worker is not None:
+            # Autoreload is not compatible with multi-process mode
+            settings.update({'autoreload': False})
 
         super().__init__(handlers, **settings)
-        logger.info('Application started, listening on port {}'
-                    .format(options.broker_port))
 
-    def broadcast(self, message):
-        """Broadcast message to all clients."""
-        logger.debug("Broadcasting message '{}' to web clients."
-                     .format(message))
-        for uid in self.clients.keys():
-            self.send_to_client(uid, message)
+        if worker is not None:
+            self.workers = WorkerBus(self, worker, options.workers,
+                                     options.workers_ipc_dir)
+            self.workers.start()
+
+        self.federation = Federation(self, options.peers)
+        if worker is None or worker == 0:
+            self.federation.start()
+
+        if options.update_coalescing > 0:
+            PeriodicCallback(self.flush_updates,
+                             options.update_coalescing).start()
+
+        if self.telemetry is not None and self.telemetry.writable:
+            PeriodicCallback(self.flush_telemetry,
+                             options.telemetry_flush_interval).start()
+
+        logger.info('Application started, listening on port %s',
+                    options.broker_port)
+
+    def flush_telemetry(self):
+        """Write the buffered updates to the telemetry log.
+
+        The log is written and synced in an executor thread, so a slow disk
+        doesn't block the IOLoop. Updates appended meanwhile are written by
+        the next flush.
+        """
+        if (self._telemetry_flush is not None and
+                not self._telemetry_flush.done()):
+            return
+        self._telemetry_flush = IOLoop.current().run_in_executor(
+            None, self.telemetry.flush)
+        self._telemetry_flush.add_done_callback(self._telemetry_flushed)
+
+    @staticmethod
+    def _telemetry_flushed(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Cannot write the telemetry log: %s",
+                         future.exception())
+
+    def broadcast(self, message, uid=None, endpoint=None):
+        """Broadcast message to all clients interested in a node.
+
+        The message is stamped with the next sequence number and kept for
+        replay to resuming clients.
+
+        :param uid: the uid of the node concerned by the message, the message
+                    is sent to all clients when None.
+        :param endpoint: the endpoint of node updates, None for messages
+                         concerning the node itself (new, out, reset).
+        """
+        logger.debug("Broadcasting message '%s' to web clients.", message,
+                     extra={'uid': uid, 'endpoint': endpoint})
+        if uid is None:
+            clients = list(self.clients)
+        else:
+            clients = self.subscriptions.match(
+                uid, endpoint, self.node_protocol(uid))
+
+        if endpoint is None:
+            key = None
+        else:
+            key = (uid, endpoint)
+        if not isinstance(message, Frames):
+            message = Frames(raw=message)
+        if (message.message is not None and
+                isinstance(message.message.get('trace'), dict)):
+            message = self.stamp_trace(message, BROKER_OUT)
+            self.metrics.observe_trace(message.message['trace'], BROKER_HOPS)
+        message = self.replay.append(message, uid, endpoint)
+        start = time.perf_counter()
+        sent = 0
+        for client in clients:
+            if client in self.clients:
+                self._send(client, message, key)
+                sent += 1
+        self.metrics.fanout_time.observe(time.perf_counter() - start)
+        if sent:
+            self.metrics.messages_out.inc(sent, destination='client',
+                                          type=message.type)
+
+    def stamp_trace(self, frames, name):
+        """Return new frames of a traced message with a timestamp added."""
+        message = frames.message
+        trace = dict(message['trace'], **{name: time.time()})
+        return Frames(dict(message, trace=trace))
+
+    def flush_updates(self):
+        """Broadcast the latest value of the coalesced node updates."""
+        pending, self._pending_updates = self._pending_updates, {}
+        with self.batching():
+            for uid, updates in pending.items():
+                for endpoint, message in updates.items():
+                    self.broadcast(message, uid, endpoint)
+
+    @contextmanager
+    def batching(self):
+        """Send the messages sent to a client in the block in one batch.
+
+        Only clients that announced the batch feature in their 'new' message
+        receive batches. A batch built for several clients is shared when
+        they received the same messages in the same wire format.
+
+        Batches of node updates are queued with the keys of their updates,
+        the others are control frames of the client queues.
+        """
+        if self._client_batches is not None:
+            # Already batching in an outer block
+            yield
+            return
+
+        self._client_batches = {}
+        try:
+            yield
+        finally:
+            batches, self._client_batches = self._client_batches, None
+        shared = {}
+        for uid, messages in batches.items():
+            ws = self.clients.get(uid)
+            if ws is None:
+                continue
+            if len(messages) == 1:
+                frames, key = messages[0]
+            else:
+                shared_key = (ws.wire_format,
+                              tuple(id(message) for message, _ in messages))
+                frames, key = shared.get(shared_key, (None, None))
+                if frames is None:
+                    frames = Frames(raw=Message.batch(
+                        [message.raw(ws.wire_format)
+                         for message, _ in messages],
+                        ws.wire_format), wire_format=ws.wire_format,
+                        message_type=BATCH)
+                    keys = tuple(key for _, key in messages)
+                    # A batch with new, out or reset records is never
+                    # dropped before the node updates
+                    key = None if None in keys else keys
+                    shared[shared_key] = (frames, key)
+            ws.send(frames.frame(ws.wire_format, ws.compression), key)
+
+    def _send(self, uid, message, key=None):
+        """Send frames to a client, or add them to its pending batch."""
+        ws = self.clients[uid]
+        if self._client_batches is not None and BATCH in ws.features:
+            self._client_batches.setdefault(uid, []).append((message, key))
+        else:
+            ws.send(message.frame(ws.wire_format, ws.compression), key)
+
+    def node_protocol(self, uid):
+        """Return the protocol of a node, None if not known yet."""
+        if uid not in self.nodes:
+            return None
+        return self.nodes.resources(uid).get('protocol')
 
     def send_to_client(self, uid, message):
         """Send message to single client given its uid."""
-        logger.debug("Sending message '{}' to client {}."
-                     .format(message, uid))
-        self.clients[uid].write_message(message)
+        logger.debug("Sending message '%s' to client %s.", message, uid,
+                     extra={'client': uid})
+        if not isinstance(message, Frames):
+            message = Frames(raw=message)
+        self._send(uid, message)
+        self.metrics.messages_out.inc(destination='client', type=message.type)
 
     def on_client_message(self, ws, message):
         """Handle a message received from a client."""
-        logger.debug("Handling message '{}' received from client websocket."
-                     .format(message))
-        if message['type'] == "new":
-            logger.info("New client connected: {}".format(ws.uid))
+        logger.debug("Handling message '%s' received from client websocket.",
+                     message)
+        self.metrics.messages_in.inc(source='client', type=message.type)
+        if message.type == "update":
+            logger.debug("New message from client: %s", ws.uid)
+            self.commands.submit(ws.uid, message)
+            return
+        elif not self.commands.allow(ws.uid, message.type):
+            logger.debug("Client %s over budget, dropping message %s",
+                         ws.uid, message)
+            self.metrics.client_commands.inc(type=message.type,
+                                             outcome=DROPPED)
+            return
+        if message.type == "new":
+            logger.info("New client connected: %s", ws.uid)
             if ws.uid not in self.clients.keys():
                 self.clients.update({ws.uid: ws})
-        elif message['type'] == "update":
-            logger.debug("New message from client: {}".format(ws.uid))
+                self.subscriptions.add_default(ws.uid)
+            ws.features = frozenset(message.features)
+            # The broker cache is up to date with the gateways, no need to
+            # ask them to send their nodes again.
+            if not self.resume_session(ws.uid, message.data):
+                self.send_cached_nodes(ws.uid)
+            return
+        elif message.type in ("subscribe", "unsubscribe"):
+            self.on_client_subscription(ws, message)
+            return
+        elif message.type == "trace":
+            # The client reports the trace of an update it received
+            if CLIENT_IN in message.data:
+                self.metrics.observe_trace(message.data, CLIENT_HOPS)
+        else:
+            logger.debug("Dropping unsupported message from client: %s",
+                         message)
 
-        # Simply forward this message to satellite gateways
-        logger.debug("Forwarding message {} to gateways".format(message))
-        for gw in self.gateways:
-            gw.write_message(Message.serialize(message))
+    def route_to_gateway(self, message, peers=True):
+        """Forward a client update command to the gateway owning the node.
 
-    def on_gateway_message(self, ws, message):
+        :param peers: when False, the message is not forwarded to a peer
+                      broker, for commands already received from a peer.
+        """
+        data = message.data
+        gateway = self.routes.get(data['uid'])
+        if gateway is None or (gateway.peer and not peers):
+            logger.debug("No gateway for node '%s'", data['uid'])
+            return
+
+        logger.debug("Forwarding message %s to gateway", message)
+        gateway.write_message(Message.serialize(message))
+        self.metrics.messages_out.inc(
+            destination='peer' if gateway.peer else 'gateway',
+            type=message.type)
+
+    def add_gateway(self, ws):
+        """Register a new gateway, with no node behind it."""
+        self.gateways.update({ws: set()})
+
+    def on_client_subscription(self, ws, message):
+        """Handle a subscribe or unsubscribe message received from a client.
+
+        The data of the message can contain a node 'uid', an 'endpoint' and
+        a 'protocol', missing ones default to the '*' wildcard.
+        """
+        data = message.data or {}
+        pattern = {field: str(data.get(field, WILDCARD))
+                   for field in ('uid', 'endpoint', 'protocol')}
+        logger.debug("Client %s %s: %s", ws.uid, message.type, pattern)
+        if message.type == "subscribe":
+            self.subscriptions.add(ws.uid, **pattern)
+        else:
+            self.subscriptions.remove(ws.uid, **pattern)
+
+    def resume_session(self, uid, data):
+        """Replay the broadcasts missed by a reconnecting client.
+
+        The data of the client 'new' message contains the 'epoch' and the
+        'seq' number of the last message it received. False is returned when
+        the missed messages are not available anymore.
+        """
+        if not isinstance(data, dict):
+            return False
+        missed = self.replay.since(data.get('epoch'), data.get('seq'))
+        if missed is None:
+            logger.debug("Cannot resume session of client %s", uid)
+            return False
+
+        logger.debug("Replaying %s messages to client %s", len(missed), uid)
+        for _, node_uid, endpoint, frames in missed:
+            if uid in self.subscriptions.match(node_uid, endpoint,
+                                               self.node_protocol(node_uid)):
+                self.send_to_client(uid, frames)
+        return True
+
+    def send_cached_nodes(self, uid):
+        """Send the cached state of the nodes a client is interested in.
+
+        Messages are stamped with the current epoch and sequence number so
+        the client can resume its session from there. Clients supporting
+        snapshots receive all the nodes in a single snapshot message, even
+        when there is no node, so they always learn the current epoch.
+        """
+        logger.debug("Sending %s cached nodes to client %s.",
+                     len(self.nodes), uid)
+        stamp = {'epoch': self.replay.epoch, 'seq': self.replay.seq}
+        nodes = {}
+        for node_uid, resources in self.nodes.items():
+            protocol = resources.get('protocol')
+            if uid not in self.subscriptions.match(node_uid,
+                                                   protocol=protocol):
+                continue
+            nodes[node_uid] = {
+                endpoint: value for endpoint, value in resources.items()
+                if uid in self.subscriptions.match(node_uid, endpoint,
+                                                   protocol)}
+
+        if SNAPSHOT in self.clients[uid].features:
+            self.send_to_client(uid, Frames(
+                raw=Message.snapshot(nodes, dst=uid),
+                message_type=SNAPSHOT).stamped(**stamp))
+            return
+
+        with self.batching():
+            for node_uid, resources in nodes.items():
+                self.send_to_client(uid, Frames(
+                    raw=Message.new_node(node_uid, dst=uid),
+                    message_type='new').stamped(**stamp))
+                for endpoint, value in resources.items():
+                    self.send_to_client(uid, Frames(
+                        raw=Message.update_node(node_uid, endpoint, value,
+                                                dst=uid),
+                        message_type='update').stamped(**stamp))
+
+    def on_gateway_message(self, ws, message, raw=None):
         """Handle a message received from a gateway.
 
         This method redirect messages from gateways to the right destinations:
         - for freshly new information initiated by nodes => broadcast
         - for replies to new client connection => only send to this client
+
+        Snapshots are handled as a new node message followed by the updates
+        of its resources, for each node of the snapshot.
+
+        When available, the frames of the message received from the gateway
+        are forwarded as is to the clients using the same wire format instead
+        of serializing the message again.
         """
-        logger.debug("Handling message '{}' received from gateway."
-                     .format(message))
-        if message['type'] == "new":
+        logger.debug("Handling message '%s' received from gateway.", message,
+                     extra={'gateway': ws.uid})
+        self.metrics.messages_in.inc(
+            source='peer' if ws.peer else 'gateway', type=message.type)
+        if isinstance(raw, Frames):
+            frames = raw
+        else:
+            frames = Frames(message, raw)
+
+        if not ws.peer:
+            # Messages from the gateways of this broker are relayed to the
+            # peer brokers.
+            self.federation.publish(frames.raw())
+
+        if message.type == BATCH:
+            with self.batching():
+                for record in message.records:
+                    self.metrics.messages_in.inc(
+                        source='peer' if ws.peer else 'gateway',
+                        type=record.type)
+                    self.on_node_message(ws, record)
+        elif message.type == "snapshot":
+            with self.batching():
+                for uid, resources in message.nodes.items():
+                    self.on_node_message(ws, New(uid=uid, dst=message.dst))
+                    for endpoint, value in resources.items():
+                        self.on_node_message(ws, Update(
+                            uid=uid, endpoint=endpoint, data=value,
+                            dst=message.dst))
+        else:
+            self.on_node_message(ws, message, frames)
+
+    def on_node_message(self, ws, message, frames=None):
+        """Handle a message concerning a node behind a gateway."""
+        if frames is None:
+            frames = Frames(message)
+        if message.trace is not None:
+            frames = self.stamp_trace(frames, BROKER_IN)
+
+        if message.type == "new":
             # Received when notifying clients of a new node available
-            if not message['uid'] in self.gateways[ws]:
-                self.gateways[ws].append(message['uid'])
+            self.gateways[ws].add(message.uid)
+            self.routes.update({message.uid: ws})
+            self.nodes.add(message.uid)
 
-            if message['dst'] == "all":
+            if message.dst == "all":
                 # Occurs when an unknown new node arrived
-                self.broadcast(Message.serialize(message))
-            elif message['dst'] in self.clients.keys():
+                self.broadcast(frames, message.uid)
+            elif message.dst in self.clients.keys():
                 # Occurs when a single client has just connected
-                self.send_to_client(
-                    message['dst'], Message.serialize(message))
-        elif (message['type'] == "out" and
-              message['uid'] in self.gateways[ws]):
-            # Node disparition are always broadcasted to clients
-            self.gateways[ws].remove(message['uid'])
-            self.broadcast(Message.serialize(message))
-        elif message['type'] == "reset":
+                self.send_to_client(message.dst, frames)
+        elif (message.type == "out" and
+              message.uid in self.gateways[ws]):
+            self.gateways[ws].discard(message.uid)
+            if self.routes.get(message.uid) is ws:
+                # Node disparition are always broadcasted to clients, unless
+                # the node moved behind another gateway
+                self.routes.pop(message.uid)
+                self._pending_updates.pop(message.uid, None)
+                self.broadcast(frames, message.uid)
+                self.nodes.remove(message.uid)
+                self.history.remove(message.uid)
+        elif message.type == "reset":
             # Occurs when a node has reset (reboot, firmware update):
             # require broadcast
-            self.broadcast(Message.serialize(message))
-        elif (message['type'] in "update" and
-              message['uid'] in self.gateways[ws]):
-            if message['dst'] == "all":
+            self.broadcast(frames, message.uid)
+            if message.uid in self.gateways[ws]:
+                self._pending_updates.pop(message.uid, None)
+                self.nodes.reset(message.uid)
+        elif (message.type == "update" and message.endpoint is not None and
+              message.uid in self.gateways[ws]):
+            self.nodes.update(message.uid, message.endpoint,
+                              message.data)
+            if message.dst == "all":
+                timestamp = time.time()
+                # The typed value parsed by the gateway is stored, if any
+                value = message.value
+                if value is None:
+                    value = message.data
+                self.history.record(message.uid, message.endpoint, value,
+                                    timestamp)
+                if (self.telemetry is not None and
+                        self.telemetry.writable and
+                        self.telemetry.append(message.uid, message.endpoint,
+                                              value, timestamp)):
+                    self.flush_telemetry()
                 # Occurs when a new update was pushed by a node:
-                # require broadcast
-                self.broadcast(Message.serialize(message))
-            elif message['dst'] in self.clients.keys():
+                # require broadcast, possibly delayed to the next coalescing
+                # tick where only the latest value is sent
+                if self.options.update_coalescing > 0:
+                    (self._pending_updates.setdefault(message.uid, {})
+                     [message.endpoint]) = frames
+                else:
+                    self.broadcast(frames, message.uid,
+                                   message.endpoint)
+            elif message.dst in self.clients.keys():
                 # Occurs when a new client has just connected:
                 # Only the cached information of a node are pushed to this
                 # specific client
-                self.send_to_client(
-                    message['dst'], Message.serialize(message))
+                self.send_to_client(message.dst, frames)
 
     def remove_ws(self, ws):
         """Remove websocket that has been closed."""
+        if ws in self.subscriptions:
+            self.subscriptions.remove_client(ws)
+        self.commands.remove_client(ws)
+
         if ws in self.clients:
             self.clients.pop(ws)
         elif ws in self.gateways.keys():
-            # Notify clients that the nodes behind the closed gateway are out.
+            # Notify clients that the nodes behind the closed gateway are out,
+            # except the ones that moved behind another gateway.
             for node_uid in self.gateways[ws]:
-                self.broadcast(Message.out_node(node_uid))
+                if self.routes.get(node_uid) is not ws:
+                    continue
+                self.routes.pop(node_uid)
+                self._pending_updates.pop(node_uid, None)
+                message = Message.out_node(node_uid)
+                self.broadcast(Frames(raw=message, message_type='out'),
+                               node_uid)
+                if not ws.peer:
+                    self.federation.publish(message)
+                self.nodes.remove(node_uid)
+                self.history.remove(node_uid)
             self.gateways.pop(ws)
@@ -0,0 +1,108 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker side cache of the nodes state."""
+
+
+class NodeCache():
+    """Last known resources values of the nodes connected to the broker.
+
+    The cache is fed by the new/update/out/reset messages received from the
+    gateways and is used to reply to new clients without involving the
+    gateways.
+
+    Each change bumps the cache `version`, the version of a node is the
+    cache version of its last change.
+
+    >>> cache = NodeCache()
+    >>> cache.add('1234')
+    >>> cache.update('1234', 'led', '1')
+    >>> cache.update('5678', 'led', '0')
+    >>> cache.resources('1234')
+    {'led': '1'}
+    >>> '5678' in cache
+    False
+    >>> cache.version, cache.node_version('1234')
+    (2, 2)
+    """
+
+    def __init__(self):
+        self._nodes = {}
+        # uid => cache version of the last change of the node
+        self._versions = {}
+        self.version = 0
+
+    def __contains__(self, uid):
+        return uid in self._nodes
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _changed(self, uid):
+        self.version += 1
+        self._versions[uid] = self.version
+
+    def add(self, uid):
+        """Add a node with no resources, if not already known."""
+        if uid not in self._nodes:
+            self._nodes[uid] = {}
+            self._changed(uid)
+
+    def update(self, uid, endpoint, value):
+        """Set the value of a resource of a known node."""
+        if uid in self._nodes:
+            self._nodes[uid][endpoint] = value
+            self._changed(uid)
+
+    def reset(self, uid):
+        """Clear all resources of a known node."""
+        if uid in self._nodes:
+            self._nodes[uid] = {}
+            self._changed(uid)
+
+    def remove(self, uid):
+        """Forget a node."""
+        if self._nodes.pop(uid, None) is not None:
+            self._versions.pop(uid)
+            self.version += 1
+
+    def resources(self, uid):
+        """Return the resources of a node."""
+        return self._nodes[uid]
+
+    def node_version(self, uid):
+        """Return the cache version of the last change of a node."""
+        return self._versions[uid]
+
+    def items(self):
+        """Iterate over (uid, resources) of all known nodes."""
+        return self._nodes.items()
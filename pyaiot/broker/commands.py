@@ -0,0 +1,149 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Fair scheduling of the commands sent by web clients to the gateways."""
+
+from collections import deque, OrderedDict
+
+from tornado.ioloop import IOLoop
+
+from .ratelimit import TokenBucket
+
+COMMAND_RATE = 0
+COMMAND_BURST = 10
+COMMAND_QUEUE_SIZE = 100
+
+FORWARDED = 'forwarded'
+COALESCED = 'coalesced'
+DROPPED = 'dropped'
+
+
+def parse_rates(rates):
+    """Return the rates per message type from 'type=rate' strings.
+
+    >>> parse_rates(['update=10', 'subscribe=0.5'])
+    {'update': 10.0, 'subscribe': 0.5}
+    """
+    parsed = {}
+    for item in rates:
+        name, _, rate = item.partition('=')
+        parsed.update({name.strip(): float(rate)})
+    return parsed
+
+
+def command_key(message):
+    """Return the node resource targeted by a command, None if unknown."""
+    data = message.get('data')
+    if not isinstance(data, dict):
+        return None
+    return (data.get('uid'), data.get('endpoint'))
+
+
+class CommandScheduler():
+    """Forwards client commands to the gateways fairly.
+
+    Each client is limited per message type by its own token buckets, with
+    the `rates` per second of each type. Commands within budget are queued
+    per client and forwarded round-robin across clients, at most `rate`
+    per second overall (0 for no limit).
+
+    A command targeting the same node resource as a command still queued
+    replaces it. Other commands over budget are dropped. Outcomes are
+    counted per message type with the `counter` metric.
+    """
+
+    def __init__(self, forward, counter, rate=COMMAND_RATE, rates=None,
+                 burst=COMMAND_BURST, queue_size=COMMAND_QUEUE_SIZE):
+        self.forward = forward
+        self.counter = counter
+        self.rates = rates or {}
+        self.burst = burst
+        self.queue_size = queue_size
+        self._bucket = TokenBucket(rate, burst)
+        # client => type => token bucket
+        self._buckets = {}
+        # client => command key => queued command, oldest first
+        self._queues = {}
+        # clients with queued commands, in round-robin order
+        self._ready = deque()
+        self._timer = None
+
+    def allow(self, client, message_type):
+        """Take a token from the bucket of a client for a message type."""
+        rate = self.rates.get(message_type)
+        if rate is None:
+            return True
+        buckets = self._buckets.setdefault(client, {})
+        if message_type not in buckets:
+            buckets[message_type] = TokenBucket(rate, self.burst)
+        return buckets[message_type].take()
+
+    def submit(self, client, message):
+        """Queue a command of a client for forwarding to the gateways."""
+        message_type = message['type']
+        queue = self._queues.setdefault(client, OrderedDict())
+        key = command_key(message)
+        if key is not None and key in queue:
+            queue[key] = message
+            self.counter.inc(type=message_type, outcome=COALESCED)
+            return
+        if (len(queue) >= self.queue_size or
+                not self.allow(client, message_type)):
+            self.counter.inc(type=message_type, outcome=DROPPED)
+            return
+        queue[key if key is not None else object()] = message
+        if len(queue) == 1:
+            self._ready.append(client)
+        self.dispatch()
+
+    def dispatch(self):
+        """Forward queued commands while the overall rate allows it."""
+        while self._ready:
+            if not self._bucket.take():
+                if self._timer is None:
+                    self._timer = IOLoop.current().call_later(
+                        self._bucket.delay(), self._on_timer)
+                return
+            client = self._ready.popleft()
+            queue = self._queues[client]
+            _, message = queue.popitem(last=False)
+            if queue:
+                self._ready.append(client)
+            self.counter.inc(type=message['type'], outcome=FORWARDED)
+            self.forward(message)
+
+    def _on_timer(self):
+        self._timer = None
+        self.dispatch()
+
+    def remove_client(self, client):
+        """Forget the buckets and the queued commands of a client."""
+        self._buckets.pop(client, None)
+        if self._queues.pop(client, None) and client in self._ready:
+            self._ready.remove(client)
@@ -0,0 +1,303 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Links between federated brokers."""
+
+import uuid
+import asyncio
+import logging
+
+from tornado import gen
+from tornado.httpclient import HTTPClientError
+from tornado.websocket import websocket_connect
+
+from pyaiot.common.auth import auth_token
+from pyaiot.common.compression import compression_options
+from pyaiot.common.helpers import retry_delay
+from pyaiot.common.messaging import (
+    Message, json_codec, CLIENT_SCHEMAS, GATEWAY_SCHEMAS
+)
+
+logger = logging.getLogger("pyaiot.broker.federation")
+
+RECONNECT_DELAY = 3
+
+
+def peer_url(peer):
+    """Return the websocket url of a peer given as 'host:port' or url.
+
+    >>> peer_url('localhost:8000')
+    'ws://localhost:8000/peer'
+    >>> peer_url('wss://broker.example.com/peer')
+    'wss://broker.example.com/peer'
+    """
+    if peer.startswith('ws://') or peer.startswith('wss://'):
+        return peer
+    return "ws://{}/peer".format(peer)
+
+
+class PeerLink():
+    """A websocket link with a peer broker.
+
+    From the broker point of view, a peer link is a gateway owning all the
+    nodes of the gateways of the peer broker. Frames exchanged on the link
+    are envelopes with a 'kind' and the raw 'message':
+
+    - node: a message received from one of the gateways of the sender
+    - client: a client command for the gateways of the receiver
+
+    Each side first sends a 'hello' envelope with the id of its 'broker'.
+    Messages received from a peer are never relayed to other peers, so
+    nodes are not reachable transitively: each broker has to be linked with
+    all the brokers whose nodes it serves.
+    """
+
+    peer = True
+
+    def __init__(self, connection, url=None):
+        self.uid = str(uuid.uuid4())
+        self.connection = connection
+        # Url of the peer for the links dialed by this broker
+        self.url = url
+        # Id of the peer broker, known once its hello is received
+        self.peer_id = None
+
+    def __repr__(self):
+        return "PeerLink <{}>".format(self.uid)
+
+    def write_message(self, message):
+        """Send a client command to the gateways of the peer broker."""
+        self._write({'kind': 'client', 'message': message})
+
+    def send_node_message(self, message):
+        """Send a message received from a local gateway to the peer."""
+        self._write({'kind': 'node', 'message': message})
+
+    def send_hello(self, broker_id):
+        """Send the id of this broker to the peer."""
+        self._write({'kind': 'hello', 'broker': broker_id})
+
+    def close(self):
+        """Close the connection with the peer."""
+        try:
+            self.connection.close()
+        except Exception as exc:
+            logger.debug("Cannot close link with peer %s: %s", self, exc)
+
+    def _write(self, envelope):
+        try:
+            self.connection.write_message(Message.serialize(envelope))
+        except Exception as exc:
+            logger.debug("Cannot write to peer %s: %s", self, exc)
+
+
+class Federation():
+    """Manages the links of a broker with its peers.
+
+    Brokers listing each other as peers open two links, only the one dialed
+    by the broker with the lowest id is kept so that node events are not
+    received twice.
+    """
+
+    def __init__(self, broker, peers):
+        self.broker = broker
+        self.peers = peers
+        self.uid = str(uuid.uuid4())
+        # Opened links, including the ones waiting for the peer hello
+        self.links = {}
+        # peer broker id => established link
+        self.peer_links = {}
+        # peer url => id of the peer broker, to not dial a linked peer again
+        self._peer_ids = {}
+        self.token = None
+
+    def start(self):
+        """Connect to the configured peers."""
+        if self.peers:
+            # Reused by all connections, so peers can keep it in their cache
+            # of verified tokens
+            self.token = auth_token(self.broker.keys).decode()
+        for peer in self.peers:
+            asyncio.ensure_future(self._connect(peer_url(peer)))
+
+    def open_link(self, connection, url=None):
+        """Register a new link with a peer broker.
+
+        The link is established once the hello of the peer is received.
+
+        :param url: the url of the peer, for links dialed by this broker.
+        """
+        link = PeerLink(connection, url)
+        self.links.update({link.uid: link})
+        logger.info("Peer link opened %s", link)
+        link.send_hello(self.uid)
+        return link
+
+    def on_hello(self, link, peer_id):
+        """Establish a link with an identified peer, unless the peer is
+        already linked.
+        """
+        if not isinstance(peer_id, str) or link.peer_id is not None:
+            logger.debug("Invalid hello from peer %s", link)
+            return
+        if link.url is not None:
+            self._peer_ids.update({link.url: peer_id})
+        if peer_id == self.uid:
+            logger.warning("Closing link %s with this broker", link)
+            self._drop_link(link)
+            return
+
+        existing = self.peer_links.get(peer_id)
+        if existing is not None:
+            dialer = min(self.uid, peer_id)
+            if (self._dialer(link, peer_id) != dialer or
+                    self._dialer(existing, peer_id) == dialer):
+                logger.info("Closing duplicate link %s with peer %s",
+                            link, peer_id)
+                self._drop_link(link)
+                return
+            logger.info("Closing duplicate link %s with peer %s",
+                        existing, peer_id)
+            self.close_link(existing)
+            existing.close()
+
+        link.peer_id = peer_id
+        self.peer_links.update({peer_id: link})
+        self.broker.add_gateway(link)
+        if self.broker.workers is not None:
+            self.broker.workers.add_gateway(link)
+        logger.info("Peer link %s established with %s", link, peer_id)
+        self._send_state(link)
+
+    def close_link(self, link):
+        """Forget a link with a peer and the nodes behind it."""
+        if self.links.pop(link.uid, None) is None:
+            return
+        logger.info("Peer link closed %s", link)
+        if (link.peer_id is None or
+                self.peer_links.get(link.peer_id) is not link):
+            return
+        self.peer_links.pop(link.peer_id)
+        if self.broker.workers is not None:
+            self.broker.workers.remove_gateway(link)
+        self.broker.remove_ws(link)
+
+    def publish(self, raw):
+        """Send a message from a gateway of this broker to all peers."""
+        for link in self.peer_links.values():
+            link.send_node_message(raw)
+
+    def on_link_message(self, link, raw):
+        """Handle an envelope received from a peer."""
+        try:
+            envelope = json_codec.loads(raw)
+            kind = envelope['kind']
+            if kind == 'hello':
+                peer_id = envelope['broker']
+            else:
+                raw = envelope['message']
+        except (ValueError, TypeError, KeyError):
+            logger.debug("Invalid message from peer %s", link)
+            self.broker.metrics.invalid_messages.inc(source='peer')
+            return
+
+        if kind == 'hello':
+            self.on_hello(link, peer_id)
+            return
+        if link.peer_id is None:
+            logger.debug("Dropping message from unidentified peer %s", link)
+            return
+
+        message, _ = Message.check_message(
+            raw, schemas=GATEWAY_SCHEMAS if kind == 'node' else CLIENT_SCHEMAS)
+        if message is None or (kind == 'client' and message.type != 'update'):
+            # Peers only forward the update commands of their clients
+            self.broker.metrics.invalid_messages.inc(source='peer')
+            return
+        if kind == 'node':
+            self.broker.on_gateway_message(link, message, raw)
+            if self.broker.workers is not None:
+                self.broker.workers.publish_gateway_message(link, raw)
+        elif kind == 'client':
+            self.broker.route_to_gateway(message, peers=False)
+
+    def _send_state(self, link):
+        """Send the nodes of the gateways of this broker to a peer."""
+        for gateway, uids in self.broker.gateways.items():
+            if gateway.peer:
+                continue
+            for uid in uids:
+                link.send_node_message(Message.new_node(uid))
+                if uid not in self.broker.nodes:
+                    continue
+                for endpoint, value in \
+                        self.broker.nodes.resources(uid).items():
+                    link.send_node_message(
+                        Message.update_node(uid, endpoint, value))
+
+    def _dialer(self, link, peer_id):
+        """Return the id of the broker that dialed a link."""
+        return self.uid if link.url is not None else peer_id
+
+    def _drop_link(self, link):
+        self.links.pop(link.uid, None)
+        link.close()
+
+    async def _connect(self, url):
+        while True:
+            delay = RECONNECT_DELAY
+            peer_id = self._peer_ids.get(url)
+            if peer_id == self.uid:
+                logger.warning("Not connecting to peer %s, it is this broker",
+                               url)
+                return
+            if peer_id in self.peer_links:
+                # Already linked by a connection dialed by the peer
+                await gen.sleep(delay)
+                continue
+            try:
+                connection = await websocket_connect(
+                    url, subprotocols=['token', self.token],
+                    compression_options=compression_options(
+                        self.broker.options))
+            except (ConnectionRefusedError, OSError, HTTPClientError) as exc:
+                delay = retry_delay(exc, RECONNECT_DELAY)
+                logger.warning("Cannot connect to peer %s: %s, retrying in "
+                               "%ss", url, exc, delay)
+            else:
+                link = self.open_link(connection, url)
+                while True:
+                    raw = await connection.read_message()
+                    if raw is None:
+                        logger.warning("Connection with peer %s lost", url)
+                        break
+                    self.on_link_message(link, raw)
+                self.close_link(link)
+
+            await gen.sleep(delay)
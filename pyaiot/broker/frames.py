@@ -0,0 +1,170 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Prebuilt websocket frames shared between several connections."""
+
+import struct
+
+from pyaiot.common.compression import deflate
+from pyaiot.common.messaging import Message, JSON
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+
+FIN = 0x80
+RSV1 = 0x40
+
+
+def websocket_frame(payload, opcode=OPCODE_TEXT, flags=0):
+    """Build an unmasked websocket data frame from payload.
+
+    Server to client frames are never masked (RFC 6455, section 5.1), so the
+    same frame bytes can be written as is on the stream of every client
+    receiving the same message.
+
+    >>> websocket_frame('test')
+    b'\\x81\\x04test'
+    >>> len(websocket_frame(b'a' * 200, opcode=OPCODE_BINARY))
+    204
+    """
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", FIN | opcode | flags, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", FIN | opcode | flags, 126, length)
+    else:
+        header = struct.pack("!BBQ", FIN | opcode | flags, 127, length)
+    return header + payload
+
+
+class Frames():
+    """A message with its encodings and websocket frames per wire format.
+
+    Encodings and frames are computed on first use, then shared by all the
+    connections using the same wire format. The type of frames built from an
+    encoded message is given by the caller, so that it is known without
+    decoding the message.
+
+    >>> frames = Frames(raw='{"type": "out", "uid": "1234"}',
+    ...                 message_type='out')
+    >>> frames.frame()
+    b'\\x81\\x1e{"type": "out", "uid": "1234"}'
+    >>> frames.message, frames.type
+    (None, 'out')
+    """
+
+    def __init__(self, message=None, raw=None, wire_format=JSON,
+                 message_type=None):
+        self.message = message
+        if message_type is None and message is not None:
+            message_type = message.get('type')
+        self.type = message_type
+        self._raw = {}
+        self._frames = {}
+        if raw is not None:
+            if wire_format == JSON:
+                # JSON is always sent as text, even when received in binary
+                # frames, and stays a valid message when stamped
+                if isinstance(raw, (bytes, bytearray)):
+                    raw = raw.decode('utf-8')
+                raw = raw.strip()
+            self._raw.update({wire_format: raw})
+
+    def __str__(self):
+        raw = self.raw(next(iter(self._raw), JSON))
+        return raw if isinstance(raw, str) else repr(raw)
+
+    def _decoded(self):
+        if self.message is None:
+            encoded_format, encoded = next(iter(self._raw.items()))
+            self.message = Message.deserialize(encoded, encoded_format)
+        return self.message
+
+    def stamped(self, **fields):
+        """Return new frames of the message with additional fields.
+
+        The JSON encoding is updated without decoding the message again, the
+        other encodings are computed again when needed. Fields already in the
+        message are replaced.
+
+        >>> Frames(raw='{"type":"out"}').stamped(seq=1).raw()
+        '{"seq":1,"type":"out"}'
+        >>> Frames(raw='{"type":"out","seq":99}').stamped(seq=1).raw()
+        '{"type":"out","seq":1}'
+        >>> Frames(raw=' {"type":"out"}\\n').stamped(seq=1).raw()
+        '{"seq":1,"type":"out"}'
+        >>> Frames(raw=b'{"type":"out"}').stamped(seq=1).raw()
+        '{"seq":1,"type":"out"}'
+        """
+        raw = self._raw.get(JSON)
+        if raw is not None and any('"{}"'.format(name) in raw
+                                   for name in fields):
+            # Possibly an existing field, the message is encoded again
+            raw = None
+        if self.message is not None or raw is None:
+            message = dict(self._decoded(), **fields)
+        else:
+            message = None
+        if raw is not None:
+            raw = '{},{}'.format(Message.serialize(fields)[:-1], raw[1:])
+        return Frames(message, raw, message_type=self.type)
+
+    def raw(self, wire_format=JSON):
+        """Return the message encoded in the given wire format."""
+        raw = self._raw.get(wire_format)
+        if raw is None:
+            raw = Message.serialize(self._decoded(), wire_format)
+            self._raw.update({wire_format: raw})
+        return raw
+
+    def frame(self, wire_format=JSON, compression=None):
+        """Return the websocket frame of the message in a wire format.
+
+        With `compression` settings, payloads above the size threshold are
+        compressed once and the frame is shared by all the connections that
+        negotiated the same settings.
+        """
+        key = (wire_format, compression)
+        frame = self._frames.get(key)
+        if frame is None:
+            raw = self.raw(wire_format)
+            if isinstance(raw, str):
+                opcode, payload = OPCODE_TEXT, raw.encode('utf-8')
+            else:
+                opcode, payload = OPCODE_BINARY, raw
+            flags = 0
+            if (compression is not None and
+                    len(payload) >= compression.threshold):
+                payload = deflate(payload, compression)
+                flags = RSV1
+            frame = websocket_frame(payload, opcode=opcode, flags=flags)
+            self._frames.update({key: frame})
+        return frame
@@ -0,0 +1,244 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""In-memory history of the numeric resources of the nodes."""
+
+import bisect
+from array import array
+
+from pyaiot.common.values import numeric
+
+HISTORY_SIZE = 1000
+
+BUCKETS = 'buckets'
+LTTB = 'lttb'
+DOWNSAMPLING = (BUCKETS, LTTB)
+
+
+def parse_sizes(sizes):
+    """Return the history sizes per endpoint from 'endpoint=size' strings.
+
+    >>> parse_sizes(['temperature=3600', 'pressure=600'])
+    {'temperature': 3600, 'pressure': 600}
+    """
+    parsed = {}
+    for item in sizes:
+        endpoint, _, size = item.partition('=')
+        parsed.update({endpoint.strip(): int(size)})
+    return parsed
+
+
+class Series():
+    """Ring buffer of the last `size` samples of a resource.
+
+    Timestamps and values are stored in preallocated arrays of doubles.
+
+    >>> series = Series(3)
+    >>> for timestamp in range(5):
+    ...     series.append(timestamp, timestamp * 10)
+    >>> series.window()
+    (array('d', [2.0, 3.0, 4.0]), array('d', [20.0, 30.0, 40.0]))
+    >>> series.window(since=3)
+    (array('d', [3.0, 4.0]), array('d', [30.0, 40.0]))
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, timestamp, value):
+        """Add a sample, overwriting the oldest one when full."""
+        index = (self.start + self.count) % self.size
+        self.times[index] = timestamp
+        self.values[index] = value
+        if self.count < self.size:
+            self.count += 1
+        else:
+            self.start = (self.start + 1) % self.size
+
+    def oldest(self):
+        """Return the timestamp of the oldest sample."""
+        return self.times[self.start]
+
+    def _ordered(self, samples):
+        end = self.start + self.count
+        if end <= self.size:
+            return samples[self.start:end]
+        return samples[self.start:] + samples[:end - self.size]
+
+    def window(self, since=None, until=None):
+        """Return the timestamps and values of the samples in a window."""
+        times = self._ordered(self.times)
+        first = 0 if since is None else bisect.bisect_left(times, since)
+        last = len(times) if until is None else bisect.bisect_right(times,
+                                                                    until)
+        return times[first:last], self._ordered(self.values)[first:last]
+
+
+def buckets(times, values, points):
+    """Return the [time, min, max, mean] of `points` equal time buckets.
+
+    Empty buckets are skipped.
+
+    >>> buckets([0, 1, 2, 3], [1, 3, 2, 6], 2)
+    [[0.0, 1, 3, 2.0], [1.5, 2, 6, 4.0]]
+    """
+    if not times:
+        return []
+    span = (times[-1] - times[0]) / points or 1
+    result = []
+    current = None
+    for timestamp, value in zip(times, values):
+        index = min(int((timestamp - times[0]) / span), points - 1)
+        if index != current:
+            current = index
+            bucket = [times[0] + index * span, value, value, 0, 0]
+            result.append(bucket)
+        bucket[1] = min(bucket[1], value)
+        bucket[2] = max(bucket[2], value)
+        bucket[3] += value
+        bucket[4] += 1
+    return [[start, low, high, total / count]
+            for start, low, high, total, count in result]
+
+
+def lttb(times, values, points):
+    """Return at most `points` [time, value] samples selected with the
+    Largest-Triangle-Three-Buckets algorithm, which keeps the visual shape
+    of the series.
+
+    >>> lttb([0, 1, 2, 3, 4], [0, 5, 1, 1, 0], 3)
+    [[0, 0], [1, 5], [4, 0]]
+    """
+    count = len(times)
+    if points >= count or points < 3:
+        return [[timestamp, value] for timestamp, value in zip(times, values)]
+    sampled = [[times[0], values[0]]]
+    every = (count - 2) / (points - 2)
+    selected = 0
+    for index in range(points - 2):
+        start = int(index * every) + 1
+        end = int((index + 1) * every) + 1
+        next_end = min(int((index + 2) * every) + 1, count)
+        average_time = sum(times[end:next_end]) / (next_end - end)
+        average_value = sum(values[end:next_end]) / (next_end - end)
+        best, best_area = start, -1
+        for candidate in range(start, end):
+            area = abs((times[selected] - average_time) *
+                       (values[candidate] - values[selected]) -
+                       (times[selected] - times[candidate]) *
+                       (average_value - values[selected]))
+            if area > best_area:
+                best, best_area = candidate, area
+        sampled.append([times[best], values[best]])
+        selected = best
+    sampled.append([times[-1], values[-1]])
+    return sampled
+
+
+def downsample(times, values, points=None, method=BUCKETS):
+    """Return the samples of a window, downsampled to `points` if given."""
+    if points is None:
+        return [[timestamp, value] for timestamp, value in zip(times, values)]
+    if method == LTTB:
+        return lttb(times, values, points)
+    return buckets(times, values, points)
+
+
+class History():
+    """Last samples of the numeric resources of the nodes.
+
+    `size` samples are kept per resource, or the size given for its
+    endpoint in `sizes`. A size of 0 disables the history. Non numeric
+    values are ignored.
+
+    >>> history = History(size=10, sizes={'name': 0})
+    >>> history.record('1234', 'temperature', '21.5', timestamp=1)
+    >>> history.record('1234', 'name', '42', timestamp=1)
+    >>> history.record('1234', 'led', 'on', timestamp=1)
+    >>> history.query('1234', 'temperature')
+    [[1.0, 21.5]]
+    >>> history.query('1234', 'name') is None
+    True
+    """
+
+    def __init__(self, size=HISTORY_SIZE, sizes=None):
+        self.size = size
+        self.sizes = sizes or {}
+        # uid => endpoint => series
+        self._series = {}
+
+    def record(self, uid, endpoint, value, timestamp):
+        """Add a sample of a resource, if numeric or a number with a unit."""
+        size = self.sizes.get(endpoint, self.size)
+        if size <= 0:
+            return
+        value = numeric(value)
+        if value is None:
+            return
+        resources = self._series.setdefault(uid, {})
+        if endpoint not in resources:
+            resources[endpoint] = Series(size)
+        resources[endpoint].append(timestamp, value)
+
+    def remove(self, uid):
+        """Forget the history of a node."""
+        self._series.pop(uid, None)
+
+    def window(self, uid, endpoint, since=None, until=None):
+        """Return the timestamps and values of the samples of a resource in
+        a window, None if unknown.
+        """
+        series = self._series.get(uid, {}).get(endpoint)
+        if series is None:
+            return None
+        return series.window(since, until)
+
+    def covers(self, uid, endpoint, since):
+        """Tell if all the samples of a resource since a time are kept."""
+        series = self._series.get(uid, {}).get(endpoint)
+        return (since is not None and series is not None and
+                len(series) > 0 and series.oldest() <= since)
+
+    def query(self, uid, endpoint, since=None, until=None, points=None,
+              method=BUCKETS):
+        """Return the samples of a resource in a window, None if unknown.
+
+        With `points`, the samples are downsampled with the `method`.
+        """
+        window = self.window(uid, endpoint, since, until)
+        if window is None:
+            return None
+        return downsample(*window, points, method)
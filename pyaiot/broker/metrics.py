@@ -0,0 +1,128 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker metrics."""
+
+from pyaiot.common.metrics import Registry
+from pyaiot.common.trace import hop_latencies
+
+
+class BrokerMetrics():
+    """Metrics describing the load of a broker.
+
+    Connection and node counts, and the depth of the client queues, are
+    computed from the broker state when the metrics are exposed. With several
+    workers, each scrape is answered by a single worker, identified by the
+    'worker' label.
+    """
+
+    def __init__(self, broker, worker=None):
+        self.broker = broker
+        const_labels = None
+        if worker is not None:
+            const_labels = {'worker': worker}
+        self.registry = Registry(const_labels)
+        self.registry.gauge('pyaiot_broker_clients',
+                            'Number of connected web clients.',
+                            function=lambda: len(broker.clients))
+        self.registry.gauge('pyaiot_broker_gateways',
+                            'Number of connected gateways and peer brokers.',
+                            ['kind'], function=self._gateways)
+        self.registry.gauge('pyaiot_broker_gateway_nodes',
+                            'Number of nodes known per gateway.',
+                            ['gateway'], function=self._gateway_nodes)
+        self.registry.gauge('pyaiot_broker_nodes',
+                            'Number of nodes in the broker cache.',
+                            function=lambda: len(broker.nodes))
+        self.messages_in = self.registry.counter(
+            'pyaiot_broker_messages_received_total',
+            'Messages received per source and type.', ['source', 'type'])
+        self.messages_out = self.registry.counter(
+            'pyaiot_broker_messages_sent_total',
+            'Messages sent per destination and type.',
+            ['destination', 'type'])
+        self.invalid_messages = self.registry.counter(
+            'pyaiot_broker_invalid_messages_total',
+            'Messages rejected by the message check, per source.',
+            ['source'])
+        self.rejected_upgrades = self.registry.counter(
+            'pyaiot_broker_rejected_upgrades_total',
+            'Websocket upgrades rejected by the admission control.',
+            ['kind'])
+        self.client_commands = self.registry.counter(
+            'pyaiot_broker_client_commands_total',
+            'Client messages per type and outcome of the rate limits: '
+            'forwarded, coalesced or dropped.', ['type', 'outcome'])
+        self.fanout_time = self.registry.histogram(
+            'pyaiot_broker_broadcast_seconds',
+            'Time spent queuing a broadcast message for all its clients.')
+        self.latency = self.registry.histogram(
+            'pyaiot_broker_latency_seconds',
+            'Latency of the traced node updates per hop, from the trace '
+            'timestamps of the gateways, the broker and the web clients.',
+            ['hop'])
+        self.dropped_frames = self.registry.counter(
+            'pyaiot_broker_client_dropped_frames_total',
+            'Frames dropped from the queues of slow clients, per kind: '
+            'update or control.', ['kind'])
+        self.registry.gauge('pyaiot_broker_client_queued_frames',
+                            'Number of frames queued for all web clients.',
+                            function=lambda: sum(self._queue_depths()))
+        self.registry.gauge('pyaiot_broker_client_queue_depth_max',
+                            'Depth of the longest web client queue.',
+                            function=lambda: max(self._queue_depths(),
+                                                 default=0))
+
+    def observe_trace(self, trace, hops):
+        """Add the latencies of the given hops of a trace."""
+        for hop, latency in hop_latencies(trace, hops):
+            self.latency.observe(latency, hop=hop)
+
+    def dropped_frame(self, control):
+        """Count a frame dropped from a client queue."""
+        self.dropped_frames.inc(kind='control' if control else 'update')
+
+    def _queue_depths(self):
+        return [len(client.queue) for client in self.broker.clients.values()
+                if client.queue is not None]
+
+    def _gateways(self):
+        counts = {('gateway',): 0, ('peer',): 0}
+        for gateway in self.broker.gateways:
+            kind = 'peer' if gateway.peer else 'gateway'
+            counts[(kind,)] += 1
+        return counts
+
+    def _gateway_nodes(self):
+        return {(gateway.uid,): len(nodes)
+                for gateway, nodes in self.broker.gateways.items()}
+
+    def expose(self):
+        """Return the metrics in the Prometheus text format."""
+        return self.registry.expose()
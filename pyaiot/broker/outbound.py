@@ -0,0 +1,145 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Bounded outbound queues for broker websocket clients."""
+
+import time
+import logging
+import itertools
+from collections import OrderedDict
+
+logger = logging.getLogger("pyaiot.broker.outbound")
+
+DROP_OLDEST = 'drop-oldest'
+KEEP_LATEST = 'keep-latest'
+DISCONNECT = 'disconnect'
+
+QUEUE_POLICIES = (DROP_OLDEST, KEEP_LATEST, DISCONNECT)
+QUEUE_SIZE = 1000
+
+# Minimum delay between two warnings about dropped control frames, in seconds
+WARNING_PERIOD = 10
+
+
+class OutboundQueue():
+    """Bounded queue of frames waiting to be written to a single client.
+
+    Each frame can be queued with a key, generally the (uid, endpoint) of a
+    node update. Frames without key (new, out, reset, ...) are only dropped
+    when there is no keyed frame left to drop, they are counted separately
+    in `dropped_control` and logged at most every WARNING_PERIOD seconds.
+    The policy applies once the queue is full:
+
+    - drop-oldest: drop the oldest queued keyed frame
+    - keep-latest: replace the queued frame with the same key, if any,
+      otherwise drop the oldest keyed frame
+    - disconnect: refuse the frame, the client has to be disconnected
+
+    >>> queue = OutboundQueue(maxsize=2, policy=KEEP_LATEST)
+    >>> queue.put(b'1', key=('node', 'temperature'))
+    True
+    >>> queue.put(b'2', key=('node', 'pressure'))
+    True
+    >>> queue.put(b'3', key=('node', 'temperature'))
+    True
+    >>> queue.drain(), queue.dropped
+    ([b'3', b'2'], 1)
+    """
+
+    def __init__(self, maxsize=QUEUE_SIZE, policy=DROP_OLDEST, on_drop=None):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Invalid queue policy '{}'".format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        # Called with True for a dropped control frame, False otherwise
+        self.on_drop = on_drop
+        self.dropped = 0
+        self.dropped_control = 0
+        self._items = OrderedDict()
+        # Queued keyed frames, oldest first, for constant time eviction
+        self._keyed = OrderedDict()
+        self._keys = {}
+        self._ids = itertools.count()
+        self._warned = None
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, frame, key=None):
+        """Queue a frame, return False if the client has to be disconnected.
+        """
+        if len(self._items) >= self.maxsize:
+            if self.policy == DISCONNECT:
+                return False
+            if self.policy == KEEP_LATEST and key in self._keys:
+                self._items[self._keys[key]] = (key, frame)
+                self._dropped(False)
+                return True
+            self._drop_oldest()
+
+        item_id = next(self._ids)
+        self._items[item_id] = (key, frame)
+        if key is not None:
+            self._keys[key] = item_id
+            self._keyed[item_id] = key
+        return True
+
+    def drain(self):
+        """Remove and return all queued frames, oldest first."""
+        frames = [frame for _, frame in self._items.values()]
+        self.clear()
+        return frames
+
+    def clear(self):
+        """Remove all queued frames."""
+        self._items.clear()
+        self._keyed.clear()
+        self._keys.clear()
+
+    def _drop_oldest(self):
+        if self._keyed:
+            drop_id, key = self._keyed.popitem(last=False)
+            self._items.pop(drop_id)
+            if self._keys.get(key) == drop_id:
+                self._keys.pop(key)
+            self._dropped(False)
+        else:
+            self._items.popitem(last=False)
+            self.dropped_control += 1
+            now = time.monotonic()
+            if self._warned is None or now - self._warned >= WARNING_PERIOD:
+                self._warned = now
+                logger.warning("Queue full of control frames, %d dropped "
+                               "so far", self.dropped_control)
+            self._dropped(True)
+
+    def _dropped(self, control):
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(control)
@@ -0,0 +1,84 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Replay of the messages broadcast by the broker to resuming clients."""
+
+import uuid
+from collections import deque
+
+REPLAY_BUFFER_SIZE = 1000
+
+
+class ReplayBuffer():
+    """Stamps broadcast messages with a sequence number and keeps the latest.
+
+    Sequence numbers are only meaningful within an epoch, which changes each
+    time the broker starts.
+
+    >>> from pyaiot.broker.frames import Frames
+    >>> replay = ReplayBuffer(2)
+    >>> replay.append(Frames(raw='{"type":"out","uid":"1"}'), '1').raw()
+    '{"seq":1,"type":"out","uid":"1"}'
+    >>> for uid in '23':
+    ...     _ = replay.append(Frames(raw='{"type": "out"}'), uid)
+    >>> [entry[0] for entry in replay.since(replay.epoch, 1)]
+    [2, 3]
+    >>> replay.since(replay.epoch, 0) is None
+    True
+    """
+
+    def __init__(self, size=REPLAY_BUFFER_SIZE):
+        self.epoch = uuid.uuid4().hex
+        self.seq = 0
+        # (seq, node uid, endpoint, stamped frames) of the latest broadcasts
+        self._entries = deque(maxlen=size)
+
+    def append(self, frames, uid, endpoint=None):
+        """Stamp broadcast frames with the next sequence number.
+
+        The stamped frames are returned and kept for replay.
+        """
+        self.seq += 1
+        stamped = frames.stamped(seq=self.seq)
+        self._entries.append((self.seq, uid, endpoint, stamped))
+        return stamped
+
+    def since(self, epoch, seq):
+        """Return the entries broadcast after a sequence number.
+
+        None is returned when some of them are no longer available, the
+        client must then be sent a full snapshot.
+        """
+        if (epoch != self.epoch or not isinstance(seq, int) or
+                isinstance(seq, bool) or seq > self.seq):
+            return None
+        first = self._entries[0][0] if self._entries else self.seq + 1
+        if seq < first - 1:
+            return None
+        return [entry for entry in self._entries if entry[0] > seq]
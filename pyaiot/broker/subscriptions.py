@@ -0,0 +1,160 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Web clients subscriptions to node updates."""
+
+import itertools
+from collections import Counter
+
+WILDCARD = '*'
+
+
+class Subscriptions():
+    """Inverted index from node uid, endpoint and protocol to client uids.
+
+    A subscription is a (uid, endpoint, protocol) pattern where each field is
+    either a value or the '*' wildcard. Looking up the clients interested in
+    a node event only visits the patterns that can match it, so the cost
+    depends on the number of interested clients and not on the number of
+    connected clients.
+
+    Clients that never subscribed explicitly are subscribed to everything.
+
+    >>> subscriptions = Subscriptions()
+    >>> subscriptions.add_default('client1')
+    >>> subscriptions.add('client2', endpoint='temperature')
+    >>> sorted(subscriptions.match('1234', 'temperature', 'CoAP'))
+    ['client1', 'client2']
+    >>> sorted(subscriptions.match('1234', 'led', 'CoAP'))
+    ['client1']
+    >>> sorted(subscriptions.match('1234'))
+    ['client1', 'client2']
+    """
+
+    def __init__(self):
+        # (uid, endpoint) pattern => protocol pattern => set of client uids
+        self._updates = {}
+        # uid pattern => protocol pattern => client uids with the number of
+        # their patterns matching, whatever the endpoint
+        self._nodes = {}
+        # client uid => set of (uid, endpoint, protocol) patterns
+        self._clients = {}
+        self._defaults = set()
+
+    def __contains__(self, client):
+        return client in self._clients
+
+    def add_default(self, client):
+        """Subscribe a client to everything, unless already subscribed."""
+        if client not in self._clients:
+            self._add(client, (WILDCARD, WILDCARD, WILDCARD))
+            self._defaults.add(client)
+
+    def add(self, client, uid=WILDCARD, endpoint=WILDCARD,
+            protocol=WILDCARD):
+        """Subscribe a client to the updates matching a pattern."""
+        if client in self._defaults:
+            self._defaults.discard(client)
+            self._remove(client, (WILDCARD, WILDCARD, WILDCARD))
+        self._add(client, (uid, endpoint, protocol))
+
+    def remove(self, client, uid=WILDCARD, endpoint=WILDCARD,
+               protocol=WILDCARD):
+        """Unsubscribe a client from a pattern previously subscribed."""
+        self._defaults.discard(client)
+        self._remove(client, (uid, endpoint, protocol))
+
+    def remove_client(self, client):
+        """Remove all subscriptions of a client."""
+        self._defaults.discard(client)
+        for pattern in list(self._clients.get(client, ())):
+            self._remove(client, pattern)
+
+    def match(self, uid, endpoint=None, protocol=None):
+        """Return the set of clients interested in a node event.
+
+        When endpoint is None, the event concerns the node itself (new, out,
+        reset) and matches all the subscriptions on this node whatever their
+        endpoint. A node with an unknown protocol matches any protocol.
+        """
+        if endpoint is None:
+            keys = (uid, WILDCARD)
+            index = self._nodes
+        else:
+            keys = itertools.product((uid, WILDCARD), (endpoint, WILDCARD))
+            index = self._updates
+
+        clients = set()
+        for key in keys:
+            by_protocol = index.get(key)
+            if by_protocol is None:
+                continue
+            if protocol is None:
+                for subscribers in by_protocol.values():
+                    clients.update(subscribers)
+            else:
+                clients.update(by_protocol.get(protocol, ()))
+                clients.update(by_protocol.get(WILDCARD, ()))
+        return clients
+
+    def _add(self, client, pattern):
+        patterns = self._clients.setdefault(client, set())
+        if pattern in patterns:
+            return
+        patterns.add(pattern)
+        uid, endpoint, protocol = pattern
+        (self._updates.setdefault((uid, endpoint), {})
+         .setdefault(protocol, set()).add(client))
+        (self._nodes.setdefault(uid, {})
+         .setdefault(protocol, Counter()))[client] += 1
+
+    def _remove(self, client, pattern):
+        patterns = self._clients.get(client, set())
+        if pattern not in patterns:
+            return
+        patterns.discard(pattern)
+        if not patterns:
+            self._clients.pop(client)
+
+        uid, endpoint, protocol = pattern
+        by_protocol = self._updates[(uid, endpoint)]
+        by_protocol[protocol].discard(client)
+        if not by_protocol[protocol]:
+            by_protocol.pop(protocol)
+        if not by_protocol:
+            self._updates.pop((uid, endpoint))
+
+        by_protocol = self._nodes[uid]
+        by_protocol[protocol][client] -= 1
+        if by_protocol[protocol][client] <= 0:
+            del by_protocol[protocol][client]
+        if not by_protocol[protocol]:
+            by_protocol.pop(protocol)
+        if not by_protocol:
+            self._nodes.pop(uid)
@@ -0,0 +1,301 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Durable log of the node updates, in segmented append-only files."""
+
+import os
+import mmap
+import time
+import zlib
+import bisect
+import struct
+import logging
+import threading
+from array import array
+
+from pyaiot.common.messaging import json_codec
+from pyaiot.common.values import numeric
+
+logger = logging.getLogger("pyaiot.broker.telemetry")
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_AGE = 3600
+RETENTION = 7 * 24 * 3600
+FLUSH_INTERVAL = 1000
+FLUSH_SIZE = 1024 * 1024
+INDEX_INTERVAL = 4096
+SEGMENT_SUFFIX = '.seg'
+
+# crc32, timestamp, uid length, endpoint length, value length
+HEADER = struct.Struct('<IdHHI')
+
+
+def encode_record(uid, endpoint, value, timestamp):
+    """Return the binary record of an update.
+
+    The crc32 of the record protects against the torn writes of a crash.
+
+    >>> record = encode_record('1234', 'led', '1', 1.5)
+    >>> len(record), next(decode_records(record))[2:]
+    (30, (1.5, b'1234', b'led', b'"1"'))
+    """
+    uid = uid.encode()
+    endpoint = endpoint.encode()
+    value = json_codec.dumps(value).encode()
+    body = HEADER.pack(0, timestamp, len(uid), len(endpoint),
+                       len(value))[4:] + uid + endpoint + value
+    return struct.pack('<I', zlib.crc32(body)) + body
+
+
+def decode_records(buffer, offset=0):
+    """Yield (offset, end, timestamp, uid, endpoint, value) of the records.
+
+    The uid, the endpoint and the JSON value are left encoded. Stops at the
+    first incomplete or corrupted record.
+    """
+    while offset + HEADER.size <= len(buffer):
+        crc, timestamp, uid_length, endpoint_length, value_length = (
+            HEADER.unpack_from(buffer, offset))
+        uid_end = offset + HEADER.size + uid_length
+        endpoint_end = uid_end + endpoint_length
+        end = endpoint_end + value_length
+        if end > len(buffer) or zlib.crc32(buffer[offset + 4:end]) != crc:
+            return
+        yield (offset, end, timestamp, buffer[offset + HEADER.size:uid_end],
+               buffer[uid_end:endpoint_end], buffer[endpoint_end:end])
+        offset = end
+
+
+class SegmentLog():
+    """Append-only log of node updates stored in segment files.
+
+    Updates are buffered and written to the current segment in batches
+    with a single fsync by `flush`, which can run in another thread than the
+    one appending the updates. Segments are named after the time of
+    their first record and are rolled when larger than `segment_size` bytes
+    or older than `segment_age` seconds. When rolling, the segments whose
+    records are all older than `retention` seconds are deleted, 0 keeps
+    them forever.
+
+    Reads memory map the segments, positioned with a sparse index of the
+    time of a record every INDEX_INTERVAL bytes. The index is built lazily
+    from the segment files, so a log opened read-only by another process
+    follows the writer. Reads are safe from other threads than the writer
+    one.
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE,
+                 segment_age=SEGMENT_AGE, writable=True,
+                 retention=RETENTION):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment_age = segment_age
+        self.writable = writable
+        self.retention = retention
+        os.makedirs(directory, exist_ok=True)
+        self._file = None
+        self._segment_start = None
+        self._written = 0
+        self._pending = bytearray()
+        self._pending_start = None
+        self._pending_lock = threading.Lock()
+        # Serializes the flushes, the segment files are only written by them
+        self._write_lock = threading.Lock()
+        # segment path => [indexed size, record times, record offsets]
+        self._indexes = {}
+        self._indexes_lock = threading.Lock()
+        if writable:
+            self._repair()
+
+    def _segments(self):
+        return sorted(os.path.join(self.directory, name)
+                      for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    @staticmethod
+    def _segment_time(path):
+        return int(os.path.basename(path)[:-len(SEGMENT_SUFFIX)]) / 1e6
+
+    def _repair(self):
+        """Truncate the last segment after its last valid record."""
+        segments = self._segments()
+        if not segments:
+            return
+        size, _, _ = self._index(segments[-1])
+        if size < os.path.getsize(segments[-1]):
+            logger.warning("Truncating corrupted segment %s at %s bytes",
+                           segments[-1], size)
+            os.truncate(segments[-1], size)
+
+    def append(self, uid, endpoint, value, timestamp):
+        """Buffer an update until the next flush.
+
+        Return True once FLUSH_SIZE bytes are buffered, the updates should
+        then be flushed without waiting for the next periodic flush.
+        """
+        record = encode_record(uid, endpoint, value, timestamp)
+        with self._pending_lock:
+            if not self._pending:
+                self._pending_start = timestamp
+            self._pending += record
+            return len(self._pending) >= FLUSH_SIZE
+
+    def flush(self):
+        """Write the buffered updates to the current segment and sync it."""
+        with self._pending_lock:
+            pending, self._pending = self._pending, bytearray()
+            start = self._pending_start
+        if not pending:
+            return
+        with self._write_lock:
+            if (self._file is None or self._written >= self.segment_size or
+                    time.time() - self._segment_start >= self.segment_age):
+                self._roll(start)
+            self._file.write(pending)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._written += len(pending)
+
+    def _roll(self, start):
+        if self._file is not None:
+            self._file.close()
+        self._segment_start = start
+        path = os.path.join(self.directory, '{:020d}{}'.format(
+            int(self._segment_start * 1e6), SEGMENT_SUFFIX))
+        logger.debug("Starting telemetry segment %s", path)
+        self._file = open(path, 'ab')
+        self._written = self._file.tell()
+        self._expire()
+
+    def _expire(self):
+        """Delete the segments older than the retention.
+
+        The records of a segment are older than the start of the next one.
+        """
+        if self.retention <= 0:
+            return
+        oldest = time.time() - self.retention
+        segments = self._segments()
+        for path, following in zip(segments, segments[1:]):
+            if self._segment_time(following) >= oldest:
+                break
+            logger.debug("Deleting expired telemetry segment %s", path)
+            os.remove(path)
+            with self._indexes_lock:
+                self._indexes.pop(path, None)
+
+    def close(self):
+        """Flush the buffered updates and close the current segment."""
+        self.flush()
+        with self._write_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def _index(self, path):
+        """Index the records appended to a segment since the last call.
+
+        Return the size of the valid records, their sparse times and
+        offsets.
+        """
+        with self._indexes_lock:
+            return self._index_locked(path)
+
+    def _index_locked(self, path):
+        index = self._indexes.setdefault(path, [0, array('d'), array('Q')])
+        if os.path.getsize(path) <= index[0]:
+            return index
+        with open(path, 'rb') as segment, \
+                mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            last = index[2][-1] if index[2] else -INDEX_INTERVAL
+            for offset, end, timestamp, _, _, _ in decode_records(m,
+                                                                  index[0]):
+                if offset - last >= INDEX_INTERVAL:
+                    index[1].append(timestamp)
+                    index[2].append(offset)
+                    last = offset
+                index[0] = end
+        return index
+
+    def window(self, uid, endpoint, since=None, until=None):
+        """Return the timestamps and numeric values logged for a resource
+        in a window.
+
+        The window starts at the latest at the retention limit, segments
+        deleted while reading are skipped.
+        """
+        uid = uid.encode()
+        endpoint = endpoint.encode()
+        if self.retention > 0:
+            oldest = time.time() - self.retention
+            if since is None or since < oldest:
+                since = oldest
+        times, values = array('d'), array('d')
+        segments = self._segments()
+        with self._indexes_lock:
+            for path in set(self._indexes) - set(segments):
+                # Deleted by the writer process
+                self._indexes.pop(path)
+        for position, path in enumerate(segments):
+            if until is not None and self._segment_time(path) > until:
+                break
+            if (since is not None and position + 1 < len(segments) and
+                    self._segment_time(segments[position + 1]) < since):
+                continue
+            try:
+                self._read(path, uid, endpoint, since, until, times, values)
+            except FileNotFoundError:
+                continue
+        return times, values
+
+    def _read(self, path, uid, endpoint, since, until, times, values):
+        """Append the numeric values of a resource logged in a segment."""
+        size, index_times, index_offsets = self._index(path)
+        if not size:
+            return
+        start = 0
+        if since is not None:
+            found = bisect.bisect_right(index_times, since) - 1
+            if found >= 0:
+                start = index_offsets[found]
+        with open(path, 'rb') as segment, \
+                mmap.mmap(segment.fileno(), size,
+                          access=mmap.ACCESS_READ) as m:
+            for _, _, timestamp, record_uid, record_endpoint, value in (
+                    decode_records(m, start)):
+                if until is not None and timestamp > until:
+                    break
+                if (record_uid != uid or record_endpoint != endpoint or
+                        (since is not None and timestamp < since)):
+                    continue
+                value = numeric(json_codec.loads(value))
+                if value is None:
+                    continue
+                times.append(timestamp)
+                values.append(value)
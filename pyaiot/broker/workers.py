@@ -0,0 +1,236 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Communication between the worker processes of a multi-process broker."""
+
+import os
+import struct
+import socket
+import asyncio
+import logging
+
+from tornado import gen
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+from pyaiot.common.messaging import Message, json_codec, GATEWAY_SCHEMAS
+
+logger = logging.getLogger("pyaiot.broker.workers")
+
+RECONNECT_DELAY = 1
+
+
+def worker_socket_path(ipc_dir, worker):
+    """Return the path of the unix socket a worker listens on."""
+    return os.path.join(ipc_dir, "worker-{}.sock".format(worker))
+
+
+class RemoteGateway():
+    """A gateway connected to another worker of the broker.
+
+    Remote gateways are stored in the broker gateways like the websockets of
+    local gateways, messages written to them are sent to the owning worker.
+    The remote gateway can itself be a link with a peer broker.
+    """
+
+    def __init__(self, bus, worker, uid, peer=False):
+        self.bus = bus
+        self.worker = worker
+        self.uid = uid
+        self.peer = peer
+
+    def __repr__(self):
+        return "RemoteGateway <{}@{}>".format(self.uid, self.worker)
+
+    def write_message(self, message):
+        self.bus.send(self.worker, {'kind': 'client',
+                                    'gateway': self.uid,
+                                    'message': message})
+
+
+class WorkerBus(TCPServer):
+    """Local IPC channel between the worker processes of the broker.
+
+    Each worker listens on a unix socket in a shared directory and opens a
+    connection to every other worker. Events are length prefixed JSON
+    documents:
+
+    - gateway: a message received from a local gateway, processed by the
+      other workers as if the gateway was connected to them
+    - gateway-closed: a local gateway has disconnected
+    - client: a client message to write to a local gateway
+
+    When a connection to another worker is (re)established, the state of the
+    nodes behind the local gateways is sent again on it.
+    """
+
+    def __init__(self, broker, worker, workers, ipc_dir):
+        super().__init__()
+        self.broker = broker
+        self.worker = worker
+        self.workers = workers
+        self.ipc_dir = ipc_dir
+        self.local_gateways = {}
+        self._remote_gateways = {}
+        self._streams = {}
+
+    def start(self):
+        """Start listening and connecting to the other workers."""
+        self.add_socket(bind_unix_socket(
+            worker_socket_path(self.ipc_dir, self.worker)))
+        for worker in range(self.workers):
+            if worker != self.worker:
+                asyncio.ensure_future(self._connect(worker))
+        logger.info("Worker %s bus started", self.worker)
+
+    def add_gateway(self, gateway):
+        """Register a gateway websocket connected to this worker."""
+        self.local_gateways.update({gateway.uid: gateway})
+
+    def remove_gateway(self, gateway):
+        """Notify the other workers that a local gateway is closed."""
+        if self.local_gateways.pop(gateway.uid, None) is not None:
+            self.publish({'kind': 'gateway-closed', 'gateway': gateway.uid})
+
+    def publish_gateway_message(self, gateway, raw):
+        """Relay a message received from a local gateway."""
+        self.publish({'kind': 'gateway', 'gateway': gateway.uid,
+                      'peer': gateway.peer, 'message': raw})
+
+    def publish(self, event):
+        """Send an event to all the other workers."""
+        data = self._encode(event)
+        for worker in list(self._streams):
+            self._write(worker, data)
+
+    def send(self, worker, event):
+        """Send an event to a single worker."""
+        if worker in self._streams:
+            self._write(worker, self._encode(event))
+
+    @staticmethod
+    def _encode(event):
+        data = Message.serialize(event).encode('utf-8')
+        return struct.pack("!I", len(data)) + data
+
+    def _write(self, worker, data):
+        try:
+            self._streams[worker].write(data)
+        except StreamClosedError:
+            self._streams.pop(worker, None)
+
+    async def _connect(self, worker):
+        path = worker_socket_path(self.ipc_dir, worker)
+        while True:
+            stream = IOStream(socket.socket(socket.AF_UNIX,
+                                            socket.SOCK_STREAM))
+            try:
+                await stream.connect(path)
+            except (StreamClosedError, OSError):
+                stream.close()
+                await gen.sleep(RECONNECT_DELAY)
+                continue
+
+            logger.debug("Worker %s connected to worker %s",
+                         self.worker, worker)
+            self._streams.update({worker: stream})
+            stream.write(self._encode({'kind': 'hello',
+                                       'worker': self.worker}))
+            self._send_state(worker)
+            try:
+                # Nothing is expected on this side of the connection, only
+                # wait for the other worker to go away.
+                await stream.read_until_close()
+            except StreamClosedError:
+                pass
+            logger.warning("Connection from worker %s to worker %s lost",
+                           self.worker, worker)
+            self._streams.pop(worker, None)
+            await gen.sleep(RECONNECT_DELAY)
+
+    def _send_state(self, worker):
+        """Send the nodes of the local gateways to a worker."""
+        for gateway in self.local_gateways.values():
+            for uid in self.broker.gateways.get(gateway, ()):
+                events = [Message.new_node(uid)]
+                if uid in self.broker.nodes:
+                    events += [
+                        Message.update_node(uid, endpoint, value)
+                        for endpoint, value in
+                        self.broker.nodes.resources(uid).items()]
+                for raw in events:
+                    self.send(worker, {'kind': 'gateway',
+                                       'gateway': gateway.uid,
+                                       'peer': gateway.peer,
+                                       'message': raw})
+
+    async def handle_stream(self, stream, address):
+        """Process the events sent by another worker."""
+        worker = None
+        try:
+            while True:
+                header = await stream.read_bytes(4)
+                length, = struct.unpack("!I", header)
+                event = json_codec.loads(await stream.read_bytes(length))
+                if event['kind'] == 'hello':
+                    worker = event['worker']
+                else:
+                    self._on_event(worker, event)
+        except StreamClosedError:
+            pass
+
+        if worker is not None:
+            logger.warning("Connection with worker %s lost", worker)
+            for key in [key for key in self._remote_gateways
+                        if key[0] == worker]:
+                self.broker.remove_ws(self._remote_gateways.pop(key))
+
+    def _on_event(self, worker, event):
+        if event['kind'] == 'gateway':
+            key = (worker, event['gateway'])
+            if key not in self._remote_gateways:
+                gateway = RemoteGateway(self, worker, event['gateway'],
+                                        peer=event.get('peer', False))
+                self._remote_gateways.update({key: gateway})
+                self.broker.add_gateway(gateway)
+            message, _ = Message.check_message(event['message'],
+                                               schemas=GATEWAY_SCHEMAS)
+            if message is not None:
+                self.broker.on_gateway_message(
+                    self._remote_gateways[key], message, event['message'])
+        elif event['kind'] == 'gateway-closed':
+            gateway = self._remote_gateways.pop(
+                (worker, event['gateway']), None)
+            if gateway is not None:
+                self.broker.remove_ws(gateway)
+        elif event['kind'] == 'client':
+            gateway = self.local_gateways.get(event['gateway'])
+            if gateway is not None:
+                gateway.write_message(event['message'])
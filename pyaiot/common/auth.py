@@ -31,13 +31,18 @@
 
 import os.path
 import string
+import time
 import configparser
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from functools import lru_cache
 from random import choice
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
 
 DEFAULT_KEY_FILENAME = "{}/.pyaiot/keys".format(os.path.expanduser("~"))
 
+TOKEN_CACHE_TTL = 300
+TOKEN_CACHE_SIZE = 1024
+
 Keys = namedtuple('Keys', ['private', 'secret'])
 
 
@@ -81,12 +86,59 @@ def check_key_file(filename=DEFAULT_KEY_FILENAME):
                 secret=config['keys']['secret'])
 
 
+@lru_cache(maxsize=8)
+def _fernet(private):
+    return Fernet(private.encode())
+
+
 def verify_auth_token(token, keys):
     """Verify the token is valid."""
-    return (Fernet(keys.private.encode()).decrypt(token.encode()) ==
-            keys.secret.encode())
+    try:
+        return (_fernet(keys.private).decrypt(token.encode()) ==
+                keys.secret.encode())
+    except InvalidToken:
+        return False
 
 
 def auth_token(keys):
     """Generate a token from the given private and secret keys."""
-    return Fernet(keys.private.encode()).encrypt(keys.secret.encode())
+    return _fernet(keys.private).encrypt(keys.secret.encode())
+
+
+class TokenCache():
+    """Remembers recently verified tokens to avoid decrypting them again.
+
+    Only valid tokens are cached, for `ttl` seconds.
+
+    >>> keys = Keys(private=generate_private_key(), secret='secret')
+    >>> cache = TokenCache(keys)
+    >>> token = auth_token(keys).decode()
+    >>> cache.verify(token), token in cache
+    (True, True)
+    >>> cache.verify('invalid'), 'invalid' in cache
+    (False, False)
+    """
+
+    def __init__(self, keys, ttl=TOKEN_CACHE_TTL, maxsize=TOKEN_CACHE_SIZE):
+        self.keys = keys
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # token => expiry time, oldest first
+        self._tokens = OrderedDict()
+
+    def __contains__(self, token):
+        expiry = self._tokens.get(token)
+        return expiry is not None and expiry > time.monotonic()
+
+    def verify(self, token):
+        """Verify a token, using the cache when possible."""
+        if token in self:
+            return True
+        self._tokens.pop(token, None)
+        if not verify_auth_token(token, self.keys):
+            return False
+        if self.ttl > 0:
+            self._tokens.update({token: time.monotonic() + self.ttl})
+            while len(self._tokens) > self.maxsize:
+                self._tokens.popitem(last=False)
+        return True
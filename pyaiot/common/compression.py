@@ -0,0 +1,111 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Websocket permessage-deflate (RFC 7692) helpers."""
+
+import zlib
+from collections import namedtuple
+
+COMPRESSION_LEVEL = 6
+COMPRESSION_MEM_LEVEL = 8
+COMPRESSION_WBITS = zlib.MAX_WBITS
+COMPRESSION_THRESHOLD = 256
+
+# zlib cannot produce a raw deflate stream with a 256 bytes window
+MIN_WBITS = 9
+
+DEFLATE_TRAILER = b'\x00\x00\xff\xff'
+
+Deflate = namedtuple('Deflate', ['wbits', 'level', 'mem_level', 'threshold'])
+
+
+def compression_options(options):
+    """Return the tornado websocket compression options.
+
+    None is returned when compression is disabled, tornado then doesn't
+    negotiate the permessage-deflate extension.
+    """
+    if not options.ws_compression:
+        return None
+    return {'compression_level': options.ws_compression_level,
+            'mem_level': options.ws_compression_mem_level}
+
+
+def negotiated_deflate(extensions, options):
+    """Return the settings used to compress the frames sent to a client.
+
+    `extensions` is the Sec-WebSocket-Extensions header of the client opening
+    handshake. The window size never exceeds the one accepted by the client.
+
+    >>> from collections import namedtuple
+    >>> Options = namedtuple('Options', ['ws_compression',
+    ...     'ws_compression_level', 'ws_compression_mem_level',
+    ...     'ws_compression_wbits', 'ws_compression_threshold'])
+    >>> options = Options(True, 6, 8, 15, 256)
+    >>> negotiated_deflate('permessage-deflate; server_max_window_bits=10',
+    ...                    options)
+    Deflate(wbits=10, level=6, mem_level=8, threshold=256)
+    >>> negotiated_deflate('x-webkit-deflate-frame', options)
+    """
+    if not options.ws_compression or not extensions:
+        return None
+    for extension in extensions.split(','):
+        name, *params = [param.strip() for param in extension.split(';')]
+        if name != 'permessage-deflate':
+            continue
+        wbits = options.ws_compression_wbits
+        for param in params:
+            key, _, value = param.partition('=')
+            value = value.strip().strip('"')
+            if key.strip() == 'server_max_window_bits' and value:
+                wbits = min(wbits, int(value))
+        if wbits < MIN_WBITS:
+            return None
+        return Deflate(wbits, options.ws_compression_level,
+                       options.ws_compression_mem_level,
+                       options.ws_compression_threshold)
+    return None
+
+
+def deflate(payload, settings):
+    """Compress a message payload for a permessage-deflate frame.
+
+    Each payload is compressed with a fresh compressor so the result doesn't
+    depend on the messages previously sent and can be shared by all the
+    connections using the same settings.
+
+    >>> settings = Deflate(15, 6, 8, 0)
+    >>> payload = deflate(b'test' * 10, settings)
+    >>> zlib.decompressobj(-15).decompress(payload + DEFLATE_TRAILER)
+    b'testtesttesttesttesttesttesttesttesttest'
+    """
+    compressor = zlib.compressobj(settings.level, zlib.DEFLATED,
+                                  -settings.wbits, settings.mem_level)
+    data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    return data[:-len(DEFLATE_TRAILER)]
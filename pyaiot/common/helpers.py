@@ -4,13 +4,18 @@ import logging
 import signal
 from functools import partial
 import tornado
-from tornado.options import define, options
+from tornado.httpserver import HTTPServer
+from tornado.options import define, options, Error
 
 from pyaiot.common.auth import DEFAULT_KEY_FILENAME
-
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(name)14s - '
-                           '%(levelname)5s - %(message)s')
+from pyaiot.common.logs import (
+    configure_logging, setup_logging, LOG_FORMATS
+)
+from pyaiot.common.compression import (
+    COMPRESSION_LEVEL, COMPRESSION_MEM_LEVEL, COMPRESSION_THRESHOLD,
+    COMPRESSION_WBITS
+)
+from pyaiot.common.messaging import BATCH_SIZE
 
 logger = logging.getLogger("pyaiot.helpers")
 
@@ -26,17 +31,86 @@ def parse_command_line(extra_args_func=None):
                help="Broker websocket port")
     if not hasattr(options, "debug"):
         define("debug", default=False, help="Enable debug mode.")
+    if not hasattr(options, "wire_format"):
+        define("wire_format", default="json",
+               help="Wire format requested by gateways for their broker "
+                    "connection: json, msgpack or cbor")
+    if not hasattr(options, "ws_compression"):
+        define("ws_compression", default=False,
+               help="Enable permessage-deflate on websocket connections")
+    if not hasattr(options, "ws_compression_level"):
+        define("ws_compression_level", default=COMPRESSION_LEVEL, type=int,
+               help="Websocket compression level (0-9)")
+    if not hasattr(options, "ws_compression_mem_level"):
+        define("ws_compression_mem_level", default=COMPRESSION_MEM_LEVEL,
+               type=int, help="Websocket compression memory level (1-9)")
+    if not hasattr(options, "ws_compression_wbits"):
+        define("ws_compression_wbits", default=COMPRESSION_WBITS, type=int,
+               help="Window bits of frames compressed by the broker (9-15)")
+    if not hasattr(options, "ws_compression_threshold"):
+        define("ws_compression_threshold", default=COMPRESSION_THRESHOLD,
+               type=int, help="Minimum size in bytes of the messages "
+                              "compressed by the broker")
+    if not hasattr(options, "trace"):
+        define("trace", default=False,
+               help="Add latency trace timestamps to the node updates sent "
+                    "by gateways")
+    if not hasattr(options, "gateway_metrics_port"):
+        define("gateway_metrics_port", default=None, type=int,
+               help="HTTP port serving the gateway metrics on /metrics, for "
+                    "gateways not running an HTTP server")
+    if not hasattr(options, "batch_interval"):
+        define("batch_interval", default=0,
+               help="Period (in ms) during which gateways accumulate the "
+                    "messages sent to the broker in a batch, 0 to disable")
+    if not hasattr(options, "batch_size"):
+        define("batch_size", default=BATCH_SIZE,
+               help="Maximum number of messages in a gateway batch")
+    if not hasattr(options, "value_parsers"):
+        define("value_parsers", default=[], multiple=True,
+               help="Comma separated list of endpoint=parser, parser of the "
+                    "node values sent by gateways: auto, number, vector or "
+                    "string")
+    if not hasattr(options, "log_format"):
+        define("log_format", default="text",
+               help="Format of the log records: {}"
+               .format(", ".join(LOG_FORMATS)))
+    if not hasattr(options, "log_sampling"):
+        define("log_sampling", default=[], multiple=True,
+               help="Comma separated list of logger=N, only one out of N "
+                    "debug records of the logger is kept")
     if not hasattr(options, "key_file"):
         define("key_file", default=DEFAULT_KEY_FILENAME,
                help="Secret and private keys filename.")
     if extra_args_func is not None:
         extra_args_func()
 
+    # Installed before parsing so tornado doesn't add its own log handler
+    setup_logging()
     options.parse_command_line()
     if options.config:
         options.parse_config_file(options.config)
     # Parse the command line a second time to override config file options
     options.parse_command_line()
+    try:
+        configure_logging(options.log_format, options.log_sampling)
+    except ValueError as exc:
+        raise Error("Invalid log_sampling option: {}".format(exc))
+
+
+def retry_delay(exc, default):
+    """Return the delay before connecting again after a failed connection.
+
+    The Retry-After hint of a server rejecting the connection is used when
+    available.
+    """
+    response = getattr(exc, 'response', None)
+    if response is not None:
+        try:
+            return max(int(response.headers.get('Retry-After')), 1)
+        except (TypeError, ValueError):
+            pass
+    return default
 
 
 def signal_handler(server, app_close, sig, frame):
@@ -57,11 +131,18 @@ def signal_handler(server, app_close, sig, frame):
     _ioloop.add_callback_from_signal(shutdown)
 
 
-def start_application(app, port=None, close_client=False):
-    """Start a tornado application."""
+def start_application(app, port=None, close_client=False, sockets=None):
+    """Start a tornado application.
+
+    The application either listens on the given port or serves the given
+    already bound sockets (shared by several processes for example).
+    """
     _ioloop = tornado.ioloop.IOLoop.current()
     _server = None
-    if port is not None:
+    if sockets is not None:
+        _server = HTTPServer(app)
+        _server.add_sockets(sockets)
+    elif port is not None:
         _server = app.listen(port)
 
     if not close_client:
@@ -0,0 +1,212 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Asynchronous and structured logging for pyaiot applications.
+
+Records are put on a queue by the application thread and written by a
+listener thread, so that writing logs never blocks the IOLoop. Messages
+must be logged with lazy arguments, ``logger.debug("Message %s", value)``,
+so they are only formatted when the record is emitted.
+
+High rate debug events of a logger and of its children can be sampled: with
+a rate of N, only one debug record out of N is kept. Sampling applies to the
+records reaching the handlers of the root logger.
+
+>>> import io
+>>> stream = io.StringIO()
+>>> handler = logging.StreamHandler(stream)
+>>> handler.setFormatter(StructuredFormatter())
+>>> test_logger = logging.getLogger("pyaiot.test")
+>>> test_logger.addHandler(handler)
+>>> test_logger.warning("Node %s is late", "1234", extra={'uid': "1234"})
+>>> record = json.loads(stream.getvalue())
+>>> record['message'], record['level'], record['uid']
+('Node 1234 is late', 'WARNING', '1234')
+>>> test_logger.removeHandler(handler)
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_FORMATS = ('text', 'json')
+
+TEXT_FORMAT = '%(asctime)s - %(name)14s - %(levelname)5s - %(message)s'
+
+# Attributes of all log records, the others are structured fields given with
+# the 'extra' argument of the logging calls
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message',
+                                                            'asctime'}
+
+_listener = None
+_queue_handler = None
+
+
+class StructuredFormatter(logging.Formatter):
+    """Formats log records as JSON objects, one per line."""
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        entry.update({key: value for key, value in vars(record).items()
+                      if key not in RECORD_ATTRIBUTES})
+        if record.exc_info:
+            entry.update({'exception': self.formatException(record.exc_info)})
+        return json.dumps(entry, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps one out of `rate` records below `level` of the logger `name`
+    and of its children, other records are kept.
+
+    >>> log_filter = SamplingFilter(2, name='pyaiot.broker')
+    >>> records = [logging.makeLogRecord({'name': name, 'levelno': 10})
+    ...            for name in ('pyaiot.broker.cache', 'pyaiot.broker',
+    ...                         'pyaiot.broker', 'pyaiot.gw')]
+    >>> [log_filter.filter(record) for record in records]
+    [True, False, True, True]
+    """
+
+    def __init__(self, rate, level=logging.DEBUG, name=''):
+        super().__init__(name)
+        self.rate = rate
+        self.level = level
+        self._count = 0
+
+    def filter(self, record):
+        if record.levelno > self.level or not super().filter(record):
+            return True
+        self._count += 1
+        return (self._count - 1) % self.rate == 0
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on the queue without formatting them.
+
+    The message is merged with its arguments, which may be changed once the
+    call returns, the formatting is left to the listener thread.
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+def parse_sampling(sampling):
+    """Return the sampling rates per logger from 'logger=rate' strings.
+
+    >>> parse_sampling(['pyaiot.broker=100', 'pyaiot.gw.coap=10'])
+    {'pyaiot.broker': 100, 'pyaiot.gw.coap': 10}
+    >>> parse_sampling(['pyaiot.broker=0'])  # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid sampling rate '0' of logger 'pyaiot.broker', ...
+    """
+    rates = {}
+    for item in sampling:
+        name, _, rate = item.partition('=')
+        try:
+            parsed = int(rate)
+        except ValueError:
+            parsed = 0
+        if parsed < 1:
+            raise ValueError(
+                "Invalid sampling rate '{}' of logger '{}', expected an "
+                "integer greater than or equal to 1".format(
+                    rate.strip(), name.strip()))
+        rates.update({name.strip(): parsed})
+    return rates
+
+
+def setup_logging():
+    """Send the records of all loggers to the log listener thread.
+
+    Does nothing when logging is already configured.
+    """
+    global _listener, _queue_handler
+    root = logging.getLogger()
+    if _listener is not None or root.handlers:
+        return
+    records = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(TEXT_FORMAT))
+    _listener = logging.handlers.QueueListener(records, handler,
+                                               respect_handler_level=True)
+    _queue_handler = LogQueueHandler(records)
+    root.addHandler(_queue_handler)
+    _listener.start()
+    atexit.register(stop_listener)
+
+
+def stop_listener():
+    """Write the pending records and stop the log listener thread."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _restart_listener():
+    """Start a new log listener thread in a forked process.
+
+    Only the forking thread exists in the child process: without a listener
+    of its own, the records of a worker would never be written.
+    """
+    if _listener is None:
+        return
+    records = queue.SimpleQueue()
+    _listener.queue = records
+    if _queue_handler is not None:
+        _queue_handler.queue = records
+    _listener._thread = None
+    _listener.start()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_listener)
+
+
+def configure_logging(log_format='text', sampling=()):
+    """Apply the log format and the per logger sampling rates."""
+    if _listener is not None and log_format == 'json':
+        for handler in _listener.handlers:
+            handler.setFormatter(StructuredFormatter())
+    rates = parse_sampling(sampling)
+    # Filters of the handlers, unlike the ones of the loggers, also apply to
+    # the records of the child loggers
+    for handler in logging.getLogger().handlers:
+        for log_filter in list(handler.filters):
+            if isinstance(log_filter, SamplingFilter):
+                handler.removeFilter(log_filter)
+        for name, rate in rates.items():
+            handler.addFilter(SamplingFilter(rate, name=name))
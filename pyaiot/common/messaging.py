@@ -30,20 +30,73 @@
 """Pyaiot messaging utility module."""
 
 import json
+import struct
 import logging
+from functools import partial
+
+from pyaiot.common.values import TYPES as VALUE_TYPES
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
 
 logger = logging.getLogger("pyaiot.messaging")
 
+JSON = 'json'
+MSGPACK = 'msgpack'
+CBOR = 'cbor'
+
+WIRE_SUBPROTOCOL_PREFIX = 'pyaiot.'
+
+ORJSON = 'orjson'
+UJSON = 'ujson'
+STDLIB_JSON = 'json'
+
+MESSAGE_TYPES = ('new', 'update', 'out', 'reset', 'subscribe', 'unsubscribe',
+                 'trace', 'batch', 'snapshot')
+
+# Optional features a web client can request in its 'new' message
+BATCH = 'batch'
+SNAPSHOT = 'snapshot'
+
+# Optional features the broker accepts from gateways, announced in this
+# header of the websocket handshake response
+GATEWAY_FEATURES = (BATCH, SNAPSHOT)
+FEATURES_HEADER = 'X-Pyaiot-Features'
+
+BATCH_SIZE = 100
+
 
 def check_broker_data(data):
     """"Utility function that checks the data object.
 
-    :param data: a dict with only 'uid', 'endpoint' and 'payload' keys.
+    :param data: a dict with only 'uid', 'endpoint' and 'payload' keys, the
+                 uid and the endpoint being strings.
 
     :return True of the data is correct, False otherwise
 
-    >>> check_broker_data({'uid':1, 'endpoint':'/test', 'payload': 'ok'})
+    >>> check_broker_data({'uid':'1', 'endpoint':'/test', 'payload': 'ok'})
     True
+    >>> check_broker_data({'uid':[1], 'endpoint':'/test', 'payload': 'ok'})
+    False
+    >>> check_broker_data({'uid':'1', 'endpoint':2, 'payload': 'ok'})
+    False
     >>> check_broker_data({'endpoint':'/test', 'payload': 'ok'})
     False
     >>> check_broker_data({'uid':1, 'payload': 'ok'})
@@ -53,14 +106,22 @@ def check_broker_data(data):
     >>> check_broker_data({'uid':1, 'endpoint':'/test', 'payload': 'ok',
     ...                    'extra': 'too many'})
     False
+    >>> check_broker_data('test')
+    False
     """
 
-    if 'uid' not in data:
+    if not isinstance(data, dict):
+        logger.debug("Invalid broker data: not an object")
+    elif 'uid' not in data:
         logger.debug("Invalid broker data: missing uid")
     elif 'endpoint' not in data:
         logger.debug("Invalid broker data: missing endpoint")
     elif 'payload' not in data:
         logger.debug("Invalid broker data: missing payload")
+    elif not isinstance(data['uid'], str):
+        logger.debug("Invalid broker data: uid is not a string")
+    elif not isinstance(data['endpoint'], str):
+        logger.debug("Invalid broker data: endpoint is not a string")
     elif len(data.keys()) > 3:
         logger.debug("Invalid broker data: too many keys")
     else:
@@ -68,73 +129,478 @@ def check_broker_data(data):
     return False
 
 
+def wire_formats():
+    """Return the wire formats supported with the installed packages."""
+    formats = [JSON]
+    if msgpack is not None:
+        formats.append(MSGPACK)
+    if cbor2 is not None:
+        formats.append(CBOR)
+    return formats
+
+
+def wire_subprotocol(wire_format):
+    """Return the websocket subprotocol used to negotiate a wire format.
+
+    >>> wire_subprotocol('msgpack')
+    'pyaiot.msgpack'
+    """
+    return WIRE_SUBPROTOCOL_PREFIX + wire_format
+
+
+def select_wire_format(subprotocols):
+    """Return the first supported wire format in a subprotocols list.
+
+    JSON is returned when no binary wire format is requested or supported.
+
+    >>> select_wire_format(['token', 'pyaiot.unknown'])
+    'json'
+    >>> select_wire_format(None)
+    'json'
+    """
+    for subprotocol in subprotocols or []:
+        subprotocol = subprotocol.strip()
+        if not subprotocol.startswith(WIRE_SUBPROTOCOL_PREFIX):
+            continue
+        wire_format = subprotocol[len(WIRE_SUBPROTOCOL_PREFIX):]
+        if wire_format in wire_formats():
+            return wire_format
+    return JSON
+
+
+def json_codecs():
+    """Return the JSON libraries installed, fastest first."""
+    codecs = []
+    if orjson is not None:
+        codecs.append(ORJSON)
+    if ujson is not None:
+        codecs.append(UJSON)
+    codecs.append(STDLIB_JSON)
+    return codecs
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+class JSONCodec():
+    """Encodes and decodes JSON with one of the installed libraries.
+
+    The fastest installed library is used by default. All of them encode to
+    the same compact text, without escaping non ASCII characters, and
+    decode text or bytes. Decoding errors are ValueError.
+
+    >>> codec = JSONCodec(STDLIB_JSON)
+    >>> codec.dumps({'uid': 'é', 'data': [1, 2]})
+    '{"uid":"é","data":[1,2]}'
+    >>> codec.loads(b'{"uid": "1234"}')
+    {'uid': '1234'}
+    """
+
+    def __init__(self, name=None):
+        self.name = name or json_codecs()[0]
+        if self.name == ORJSON:
+            self.dumps = _orjson_dumps
+            self.loads = orjson.loads
+        elif self.name == UJSON:
+            self.dumps = partial(ujson.dumps, ensure_ascii=False,
+                                 escape_forward_slashes=False)
+            self.loads = ujson.loads
+        else:
+            self.dumps = partial(json.dumps, ensure_ascii=False,
+                                 separators=(',', ':'))
+            self.loads = json.loads
+
+
+json_codec = JSONCodec()
+
+
+def _cbor_array_header(length):
+    """Return the CBOR header of an array of a given length."""
+    if length < 24:
+        return struct.pack('>B', 0x80 | length)
+    if length < 0x100:
+        return struct.pack('>BB', 0x98, length)
+    if length < 0x10000:
+        return struct.pack('>BH', 0x99, length)
+    return struct.pack('>BI', 0x9a, length)
+
+
+def _field(name, default=None):
+    """Return a read-only attribute giving a field of a typed message."""
+    return property(lambda message: message.get(name, default),
+                    doc="The '{}' field of the message.".format(name))
+
+
+class TypedMessage(dict):
+    """Base class of the typed messages.
+
+    Typed messages are dicts, so they are encoded like any other message,
+    with attributes giving their fields.
+
+    >>> message = Update(uid='1234', endpoint='led', data='1')
+    >>> message.uid, message.endpoint, message.dst
+    ('1234', 'led', 'all')
+    >>> message == {'type': 'update', 'uid': '1234', 'endpoint': 'led',
+    ...             'data': '1'}
+    True
+    """
+
+    __slots__ = ()
+    TYPE = None
+
+    type = _field('type')
+    data = _field('data')
+    src = _field('src')
+    trace = _field('trace')
+
+    def __init__(self, fields=(), **kwargs):
+        if self.TYPE is not None:
+            super().__init__(type=self.TYPE)
+        self.update(fields, **kwargs)
+
+
+class New(TypedMessage):
+    """A new node from a gateway, or a new web client."""
+
+    __slots__ = ()
+    TYPE = 'new'
+
+    uid = _field('uid')
+    dst = _field('dst', 'all')
+    features = _field('features', ())
+
+
+class Update(TypedMessage):
+    """A node resource update from a gateway, or a client command."""
+
+    __slots__ = ()
+    TYPE = 'update'
+
+    uid = _field('uid')
+    endpoint = _field('endpoint')
+    dst = _field('dst', 'all')
+    value = _field('value')
+
+
+class Out(TypedMessage):
+    """A node gone from a gateway."""
+
+    __slots__ = ()
+    TYPE = 'out'
+
+    uid = _field('uid')
+
+
+class Reset(TypedMessage):
+    """A node reset behind a gateway."""
+
+    __slots__ = ()
+    TYPE = 'reset'
+
+    uid = _field('uid')
+
+
+class Batch(TypedMessage):
+    """Several new, update, out or reset messages sent in one frame."""
+
+    __slots__ = ()
+    TYPE = 'batch'
+
+    records = _field('data', ())
+
+
+class Snapshot(TypedMessage):
+    """The resources of one or several nodes, sent in one frame."""
+
+    __slots__ = ()
+    TYPE = 'snapshot'
+
+    nodes = _field('data', {})
+    dst = _field('dst', 'all')
+
+
+class Discover(TypedMessage):
+    """A discovery request sent to websocket nodes."""
+
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__(request='discover')
+
+
+class Subscription(TypedMessage):
+    """A subscribe or unsubscribe request from a web client."""
+
+    __slots__ = ()
+
+
+class Trace(TypedMessage):
+    """The latency trace of an update, reported by a web client."""
+
+    __slots__ = ()
+    TYPE = 'trace'
+
+
+# Reasons of the rejected messages, the received messages are only
+# formatted when the rejections are logged
+INVALID_FORMAT = "Invalid message format"
+INVALID_TYPE = "Invalid message type"
+INVALID_FIELDS = "Invalid message fields"
+
+
+def check_nodes(data):
+    """Check the data of a snapshot maps node uids to their resources.
+
+    >>> check_nodes({'1234': {'led': '1'}, '5678': {}})
+    True
+    >>> check_nodes({'1234': 'led'})
+    False
+    """
+    return (isinstance(data, dict) and
+            all(isinstance(uid, str) and isinstance(resources, dict)
+                for uid, resources in data.items()))
+
+
+def _compile(schemas):
+    """Return validation tables of messages schemas.
+
+    A schema gives the typed message class of a message type and the
+    (name, check, required) of its fields, where the check is a type, a
+    tuple of types or a predicate.
+    """
+    compiled = {}
+    for message_type, (message_class, fields) in schemas.items():
+        checks = []
+        for name, check, required in fields:
+            if isinstance(check, (type, tuple)):
+                check = partial(lambda types, value: isinstance(value, types),
+                                check)
+            checks.append((name, check, required))
+        compiled.update({message_type: (message_class, tuple(checks))})
+    return compiled
+
+
+# Any message of a known type, without checking its fields. The records of
+# a batch are checked with the same schemas, without nested batches.
+MESSAGE_SCHEMAS = _compile({
+    'new': (New, ()),
+    'update': (Update, ()),
+    'out': (Out, ()),
+    'reset': (Reset, ()),
+    'subscribe': (Subscription, ()),
+    'unsubscribe': (Subscription, ()),
+    'trace': (Trace, ()),
+    'batch': (Batch, (('data', list, True),)),
+    'snapshot': (Snapshot, ()),
+})
+
+# Messages sent by the gateways (and the peer brokers) to the broker
+TRACE_FIELD = ('trace', dict, False)
+GATEWAY_SCHEMAS = _compile({
+    'new': (New, (('uid', str, True), ('dst', str, False), TRACE_FIELD)),
+    'update': (Update, (('uid', str, True), ('endpoint', str, False),
+                        ('dst', str, False), TRACE_FIELD,
+                        ('value', VALUE_TYPES, False))),
+    'out': (Out, (('uid', str, True), TRACE_FIELD)),
+    'reset': (Reset, (('uid', str, True), TRACE_FIELD)),
+    'batch': (Batch, (('data', list, True),)),
+    'snapshot': (Snapshot, (('data', check_nodes, True),
+                            ('dst', str, False))),
+})
+
+# Messages sent by the web clients to the broker, commands are forwarded
+# as is to the gateways
+CLIENT_SCHEMAS = _compile({
+    'new': (New, (('features', list, False),)),
+    'update': (Update, (('data', check_broker_data, True),)),
+    'subscribe': (Subscription, (('data', dict, False),)),
+    'unsubscribe': (Subscription, (('data', dict, False),)),
+    'trace': (Trace, (('data', dict, True),)),
+})
+
+_MISSING = object()
+
+
+def _validate(message, schemas):
+    """Return the typed class of a decoded message and the reason it is
+    invalid, if so.
+    """
+    if not isinstance(message, dict):
+        return None, INVALID_FORMAT
+    schema = schemas.get(message.get('type'))
+    if schema is None:
+        return None, INVALID_TYPE
+    message_class, fields = schema
+    for name, check, required in fields:
+        value = message.get(name, _MISSING)
+        if value is _MISSING:
+            if required:
+                return None, INVALID_FIELDS
+        elif not check(value):
+            return None, INVALID_FIELDS
+    return message_class, None
+
+
 class Message():
     """Utility class for generating and parsing service messages."""
 
     @staticmethod
-    def serialize(message):
-        return json.dumps(message, ensure_ascii=False)
+    def serialize(message, wire_format=JSON):
+        """Encode a message, to text for JSON or to bytes otherwise."""
+        if wire_format == MSGPACK:
+            return msgpack.packb(message, use_bin_type=True)
+        if wire_format == CBOR:
+            return cbor2.dumps(message)
+        return json_codec.dumps(message)
 
     @staticmethod
-    def new_node(uid, dst="all"):
+    def deserialize(raw, wire_format=JSON):
+        """Decode a message, binary frames use the given wire format."""
+        if isinstance(raw, (bytes, bytearray)):
+            if wire_format == MSGPACK:
+                return msgpack.unpackb(raw, raw=False)
+            if wire_format == CBOR:
+                try:
+                    return cbor2.loads(raw)
+                except cbor2.CBORDecodeError as exc:
+                    raise ValueError(exc)
+        return json_codec.loads(raw)
+
+    @staticmethod
+    def new_node(uid, dst="all", wire_format=JSON):
         """Generate a text message indicating a new node."""
-        return Message.serialize({'type': 'new', 'uid': uid, 'dst': dst})
+        return Message.serialize(New(uid=uid, dst=dst), wire_format)
 
     @staticmethod
-    def out_node(uid):
+    def out_node(uid, wire_format=JSON):
         """Generate a text message indicating a node to remove."""
-        return Message.serialize({'type': 'out', 'uid': uid})
+        return Message.serialize(Out(uid=uid), wire_format)
 
     @staticmethod
-    def reset_node(uid):
+    def reset_node(uid, wire_format=JSON):
         """Generate a text message indicating a node reset."""
-        return Message.serialize({'type': 'reset', 'uid': uid})
+        return Message.serialize(Reset(uid=uid), wire_format)
+
+    @staticmethod
+    def update_node(uid, endpoint, data, dst="all", wire_format=JSON,
+                    trace=None, value=None):
+        """Generate a text message indicating a node update.
+
+        `trace` contains the latency trace timestamps of the update, `value`
+        the typed form of the data parsed by the gateway.
+
+        >>> raw = Message.update_node('1', 'temperature', '23°C',
+        ...                           value={'number': 23, 'unit': '°C'})
+        >>> Message.deserialize(raw)['value']
+        {'number': 23, 'unit': '°C'}
+        """
+        message = Update(uid=uid, endpoint=endpoint, data=data, dst=dst)
+        if trace is not None:
+            message.update({'trace': trace})
+        if value is not None:
+            message.update({'value': value})
+        return Message.serialize(message, wire_format)
 
     @staticmethod
-    def update_node(uid, endpoint, data, dst="all"):
-        """Generate a text message indicating a node update."""
-        return Message.serialize({'type': 'update',
-                                  'uid': uid,
-                                  'endpoint': endpoint,
-                                  'data': data,
-                                  'dst': dst})
+    def snapshot(nodes, dst="all", wire_format=JSON):
+        """Generate a message with the resources of several nodes.
+
+        `nodes` maps the uid of each node to its resources.
+
+        >>> Message.snapshot({'1234': {'led': '1'}})
+        '{"type":"snapshot","data":{"1234":{"led":"1"}},"dst":"all"}'
+        """
+        return Message.serialize(Snapshot(data=nodes, dst=dst), wire_format)
 
     @staticmethod
-    def gateway_alive():
+    def batch(records, wire_format=JSON):
+        """Generate a batch message from already encoded messages.
+
+        The records are embedded as is, without decoding them again.
+
+        >>> Message.batch([Message.out_node('1')])
+        '{"type":"batch","data":[{"type":"out","uid":"1"}]}'
+        """
+        if wire_format == MSGPACK:
+            packer = msgpack.Packer(use_bin_type=True)
+            return (packer.pack_map_header(2) + packer.pack('type') +
+                    packer.pack('batch') + packer.pack('data') +
+                    packer.pack_array_header(len(records)) + b''.join(records))
+        if wire_format == CBOR:
+            return (b'\xa2' + cbor2.dumps('type') + cbor2.dumps('batch') +
+                    cbor2.dumps('data') + _cbor_array_header(len(records)) +
+                    b''.join(records))
+        return '{{"type":"batch","data":[{}]}}'.format(','.join(records))
+
+    @staticmethod
+    def subscribe(uid='*', endpoint='*', protocol='*'):
+        """Generate a text message subscribing a client to node updates."""
+        return Message.serialize({'type': 'subscribe',
+                                  'data': {'uid': uid,
+                                           'endpoint': endpoint,
+                                           'protocol': protocol}})
+
+    @staticmethod
+    def unsubscribe(uid='*', endpoint='*', protocol='*'):
+        """Generate a text message removing a client subscription."""
+        return Message.serialize({'type': 'unsubscribe',
+                                  'data': {'uid': uid,
+                                           'endpoint': endpoint,
+                                           'protocol': protocol}})
+
+    @staticmethod
+    def gateway_alive(wire_format=JSON):
         """Generate a text message indicating that a gateway is alive."""
-        return Message.serialize({'type': 'update', 'uid': 'alive'})
+        return Message.serialize({'type': 'update', 'uid': 'alive'},
+                                 wire_format)
 
     @staticmethod
     def discover_node():
         """Generate a text message for websocket node discovery."""
-        return Message.serialize({'request': 'discover'})
+        return Message.serialize(Discover())
 
     @staticmethod
-    def check_message(raw):
-        """Verify a received message is correctly formatted."""
+    def check_message(raw, wire_format=JSON, schemas=MESSAGE_SCHEMAS):
+        """Verify a received message is correctly formatted.
+
+        Binary frames are decoded with the given wire format, text frames are
+        always JSON. The message is validated with the `schemas` of its
+        sender and returned as a typed message. The reason of a rejection
+        is a constant string.
+
+        >>> Message.check_message('{"type": "out"}', schemas=GATEWAY_SCHEMAS)
+        (None, 'Invalid message fields')
+        >>> message, _ = Message.check_message('{"type": "out", "uid": "1"}')
+        >>> type(message).__name__, message.uid
+        ('Out', '1')
+        """
         reason = None
-        try:
-            message = json.loads(raw)
-        except TypeError as exc:
-            logger.warning(exc)
-            reason = "Invalid message '{}'.".format(raw)
-            message = None
-        except json.JSONDecodeError:
-            reason = ("Invalid message received "
-                      "'{}'. Only JSON format is supported.".format(raw))
-            message = None
-
-        if message is not None:
-            if not hasattr(message, '__iter__'):
-                reason = "Invalid message '{}'.".format(message)
-            elif 'type' not in message and 'data' not in message:
-                reason = "Invalid message '{}'.".format(message)
-            elif (message['type'] != 'new' and message['type'] != 'update' and
-                  message['type'] != 'out' and message['type'] != 'reset'):
-                reason = "Invalid message type '{}'.".format(message['type'])
+        if isinstance(raw, (str, bytes, bytearray)):
+            if (wire_format == JSON and raw[:1] not in ('{', b'{') and
+                    raw.lstrip()[:1] not in ('{', b'{')):
+                # Rejected without decoding, messages are JSON objects
+                reason = INVALID_FORMAT
+            else:
+                try:
+                    raw = Message.deserialize(raw, wire_format)
+                except (TypeError, ValueError):
+                    # Decoding errors of all wire formats are ValueError
+                    reason = INVALID_FORMAT
+        if reason is None:
+            message_class, reason = _validate(raw, schemas)
+        if reason is None and message_class is Batch:
+            records = []
+            for record in raw['data']:
+                record_class, reason = _validate(record, schemas)
+                if reason is not None or record_class is Batch:
+                    reason = INVALID_FIELDS
+                    break
+                records.append(record_class(record))
+            raw = dict(raw, data=records)
 
         if reason is not None:
-            logger.warning(reason)
-            message = None
+            logger.debug("%s: %r", reason, raw)
+            return None, reason
 
-        return message, reason
+        return message_class(raw), None
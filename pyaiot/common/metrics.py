@@ -0,0 +1,199 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Metrics exposed in the Prometheus text format.
+
+Only the few metric types needed by pyaiot are implemented so no extra
+dependency is required.
+
+>>> registry = Registry()
+>>> messages = registry.counter('messages_total', 'Messages.', ['type'])
+>>> messages.inc(type='new')
+>>> print(registry.expose(), end='')
+# HELP messages_total Messages.
+# TYPE messages_total counter
+messages_total{type="new"} 1
+"""
+
+import math
+from bisect import bisect_left
+
+DEFAULT_BUCKETS = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05,
+                   .1, .25, .5, 1)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return (str(value).replace('\\', r'\\').replace('\n', r'\n')
+            .replace('"', r'\"'))
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{{{}}}'.format(','.join('{}="{}"'.format(name, _escape(value))
+                                    for name, value in labels))
+
+
+class Metric():
+    """Base class of metrics, storing one value per set of label values."""
+
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        """Return the (suffix, labels, value) samples of the metric."""
+        return [('', list(zip(self.labels, key)), value)
+                for key, value in sorted(self._values.items())]
+
+
+class Counter(Metric):
+    """A value that only goes up."""
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down.
+
+    Instead of being set, the values can be computed when metrics are
+    exposed by `function`, returning a value or, for gauges with labels, a
+    dict of values indexed by tuples of label values.
+    """
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), function=None):
+        super().__init__(name, documentation, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is not None:
+            values = self.function()
+            if not self.labels:
+                values = {(): values}
+            self._values = values
+        return super().samples()
+
+
+class Histogram(Metric):
+    """Counts observed values in cumulative buckets."""
+
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # one count per bucket, then the sum of observed values
+            counts = self._values[key] = [0] * len(self.buckets) + [0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        samples = []
+        for key, counts in sorted(self._values.items()):
+            labels = list(zip(self.labels, key))
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                samples.append(('_bucket',
+                                labels + [('le', _format_value(bound))],
+                                total))
+            samples.append(('_count', labels, total))
+            samples.append(('_sum', labels, counts[-1]))
+        return samples
+
+
+class Registry():
+    """A set of metrics exposed together.
+
+    `const_labels` are added to all the samples, for instance to tell apart
+    the processes of a multi-process application.
+    """
+
+    def __init__(self, const_labels=None):
+        self.const_labels = list((const_labels or {}).items())
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, *args, **kwargs):
+        return self.register(Counter(*args, **kwargs))
+
+    def gauge(self, *args, **kwargs):
+        return self.register(Gauge(*args, **kwargs))
+
+    def histogram(self, *args, **kwargs):
+        return self.register(Histogram(*args, **kwargs))
+
+    def expose(self):
+        """Return all the metrics in the Prometheus text format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(
+                metric.name, metric.documentation.replace('\n', ' ')))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append('{}{}{} {}'.format(
+                    metric.name, suffix,
+                    _format_labels(self.const_labels + labels),
+                    _format_value(value)))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,63 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Latency tracing of node updates.
+
+When tracing is enabled, update messages carry a 'trace' dict of unix
+timestamps added along the way from the node to the web clients.
+Timestamps taken on different hosts are only comparable when their clocks
+are synchronized.
+
+>>> trace = {GATEWAY_IN: 10.0, GATEWAY_OUT: 10.5, BROKER_IN: 11.0}
+>>> list(hop_latencies(trace, BROKER_HOPS))
+[('gateway', 0.5), ('uplink', 0.5)]
+"""
+
+import numbers
+
+GATEWAY_IN = 'gw_in'
+GATEWAY_OUT = 'gw_out'
+BROKER_IN = 'br_in'
+BROKER_OUT = 'br_out'
+CLIENT_IN = 'cl_in'
+
+GATEWAY_HOPS = (('gateway', GATEWAY_IN, GATEWAY_OUT),)
+BROKER_HOPS = GATEWAY_HOPS + (('uplink', GATEWAY_OUT, BROKER_IN),
+                              ('broker', BROKER_IN, BROKER_OUT))
+CLIENT_HOPS = (('downlink', BROKER_OUT, CLIENT_IN),
+               ('end_to_end', GATEWAY_IN, CLIENT_IN))
+
+
+def hop_latencies(trace, hops):
+    """Yield the (hop, latency in seconds) of the hops found in a trace."""
+    for hop, start, end in hops:
+        start, end = trace.get(start), trace.get(end)
+        if (isinstance(start, numbers.Real) and
+                isinstance(end, numbers.Real)):
+            yield hop, end - start
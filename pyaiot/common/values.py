@@ -0,0 +1,246 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Typed node resource values.
+
+Nodes send their resource values as strings, e.g. '23°C'. Gateways parse
+the known shapes of values to a compact typed form added to the updates
+sent to the broker:
+
+- a number: 23.5
+- a number with a unit: {'number': 23, 'unit': '°C'}
+- a vector of numbers: [0.1, 0.2, 9.8]
+
+Only finite numbers and known units are typed, values of other shapes stay
+strings and have no typed form.
+"""
+
+import re
+import math
+import logging
+
+logger = logging.getLogger("pyaiot.values")
+
+AUTO = 'auto'
+NUMBER = 'number'
+VECTOR = 'vector'
+STRING = 'string'
+
+# Types of the typed forms accepted by the broker
+TYPES = (int, float, list, dict)
+
+# Known units of the numbers, other suffixes are part of a string, e.g.
+# '6LoWPAN' or '1st floor'
+UNITS = {
+    '%', '%RH', '°', '°C', '°F', 'K', 'Pa', 'hPa', 'kPa', 'bar', 'mbar',
+    'ppm', 'ppb', 'µg/m3', 'µg/m³', 'mg/m3', 'mg/m³', 'lx', 'lux', 'dB', 'dBm',
+    'V', 'mV', 'A', 'mA', 'W', 'kW', 'Wh', 'kWh', 'Hz', 'kHz', 'MHz', 'rpm',
+    'g', 'kg', 'm', 'cm', 'mm', 'km', 'm/s', 'km/h', 'm/s2', 'm/s²', 's',
+    'ms', 'min', 'h', 'deg', 'rad',
+}
+
+_NUMBER = r'[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?'
+_NUMBER_TEXT = re.compile(_NUMBER)
+# The unit of a number doesn't start like the rest of a vector
+_NUMBER_UNIT = re.compile(r'\s*({})\s*([^\d\s.,;+-][^,;]*?)?\s*'
+                          .format(_NUMBER))
+_VECTOR_SEPARATOR = re.compile(r'\s*[,;\s]\s*')
+
+
+def _number(text):
+    if _NUMBER_TEXT.fullmatch(text) is None:
+        raise ValueError("Invalid number: {}".format(text))
+    try:
+        return int(text)
+    except ValueError:
+        number = float(text)
+    if not math.isfinite(number):
+        # Overflows, e.g. '1e400', have no portable JSON encoding
+        raise ValueError("Number out of range: {}".format(text))
+    return number
+
+
+def parse_number(value):
+    """Return the typed form of a number, with an optional unit.
+
+    >>> parse_number('23°C'), parse_number(' -1.5 ')
+    ({'number': 23, 'unit': '°C'}, -1.5)
+    >>> parse_number('1,2'), parse_number('6LoWPAN'), parse_number('1e400')
+    (None, None, None)
+    """
+    match = _NUMBER_UNIT.fullmatch(value)
+    if match is None:
+        return None
+    number, unit = match.groups()
+    if unit and unit not in UNITS:
+        return None
+    try:
+        number = _number(number)
+    except ValueError:
+        return None
+    if not unit:
+        return number
+    return {'number': number, 'unit': unit}
+
+
+def parse_vector(value):
+    """Return the typed form of a vector of numbers.
+
+    >>> parse_vector('[0.1, 0.2, 9.8]'), parse_vector('1;2')
+    ([0.1, 0.2, 9.8], [1, 2])
+    >>> parse_vector('on'), parse_vector('inf, nan')
+    (None, None)
+    """
+    items = _VECTOR_SEPARATOR.split(value.strip().strip('[]()'))
+    try:
+        return [_number(item) for item in items]
+    except ValueError:
+        return None
+
+
+def parse_string(value):
+    """Leave a value as a string, without typed form."""
+    return None
+
+
+def parse_auto(value):
+    """Return the typed form of a number or a vector, None otherwise.
+
+    >>> parse_auto('23°C'), parse_auto('1, 2, 3'), parse_auto('on')
+    ({'number': 23, 'unit': '°C'}, [1, 2, 3], None)
+    """
+    typed = parse_number(value)
+    if typed is None:
+        typed = parse_vector(value)
+    return typed
+
+
+PARSERS = {
+    AUTO: parse_auto,
+    NUMBER: parse_number,
+    VECTOR: parse_vector,
+    STRING: parse_string,
+}
+
+
+def register_parser(name, parser):
+    """Register a parser that can be used for the values of endpoints.
+
+    A parser returns the typed form of a string value, None if the value
+    cannot be parsed. Typed forms of other types than TYPES are ignored.
+    """
+    PARSERS.update({name: parser})
+
+
+def register_unit(unit):
+    """Register a unit typed with the numbers it follows."""
+    UNITS.add(unit)
+
+
+def parse_parsers(parsers):
+    """Return the parsers names per endpoint from 'endpoint=parser' strings.
+
+    >>> parse_parsers(['temperature=number', 'name=string'])
+    {'temperature': 'number', 'name': 'string'}
+    """
+    parsed = {}
+    for item in parsers:
+        endpoint, _, name = item.partition('=')
+        parsed.update({endpoint.strip(): name.strip()})
+    return parsed
+
+
+def numeric(value):
+    """Return the number of a value or of its typed form, None if not a
+    number.
+
+    >>> numeric(21.5), numeric({'number': 23, 'unit': '°C'}), numeric('1')
+    (21.5, 23.0, 1.0)
+    >>> numeric([1, 2]), numeric('on'), numeric('1e400')
+    (None, None, None)
+    """
+    if isinstance(value, dict):
+        value = value.get(NUMBER)
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(number):
+        return None
+    return number
+
+
+class ValueParser():
+    """Parses the values of the node resources to their typed form.
+
+    Endpoints use the `auto` parser unless another registered parser is
+    configured for them.
+
+    >>> parser = ValueParser({'name': STRING})
+    >>> parser.parse('temperature', '23°C'), parser.parse('name', '42')
+    ({'number': 23, 'unit': '°C'}, None)
+    >>> parser.parse('led', 1) is None
+    True
+    >>> parser.register('name', str.upper)
+    >>> parser.parse('name', 'node') is None
+    True
+    """
+
+    def __init__(self, endpoints=None, default=AUTO):
+        self.default = PARSERS[default]
+        self._endpoints = {}
+        for endpoint, name in (endpoints or {}).items():
+            self.register(endpoint, name)
+
+    def register(self, endpoint, parser):
+        """Use a parser, given by name or as a function, for an endpoint."""
+        if not callable(parser):
+            if parser not in PARSERS:
+                logger.warning("Unknown value parser '%s' for endpoint '%s'",
+                               parser, endpoint)
+                return
+            parser = PARSERS[parser]
+        self._endpoints.update({endpoint: parser})
+
+    def parse(self, endpoint, value):
+        """Return the typed form of a string value, None if it stays a
+        string or is already typed.
+        """
+        if not isinstance(value, str):
+            return None
+        typed = self._endpoints.get(endpoint, self.default)(value)
+        if typed is None:
+            return None
+        if (not isinstance(typed, TYPES) or
+                (isinstance(typed, float) and not math.isfinite(typed))):
+            # The broker would reject the update and close the connection
+            logger.debug("Ignoring typed value %r of endpoint '%s'",
+                         typed, endpoint)
+            return None
+        return typed
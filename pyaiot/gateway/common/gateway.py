@@ -29,20 +29,32 @@
 
 """Base class for gateways."""
 
-import json
+import time
 import logging
 import asyncio
 from abc import ABCMeta, abstractmethod
 from tornado import web, gen
-from tornado.ioloop import PeriodicCallback
+from tornado.httpclient import HTTPClientError
+from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.websocket import websocket_connect
 
 from pyaiot.common.auth import auth_token
-from pyaiot.common.messaging import check_broker_data, Message
+from pyaiot.common.compression import compression_options
+from pyaiot.common.helpers import retry_delay
+from pyaiot.common.messaging import (
+    Message, select_wire_format, wire_formats, wire_subprotocol, JSON,
+    BATCH, SNAPSHOT, CLIENT_SCHEMAS, FEATURES_HEADER, Update
+)
+from pyaiot.common.metrics import Registry, CONTENT_TYPE
+from pyaiot.common.trace import (
+    hop_latencies, GATEWAY_HOPS, GATEWAY_IN, GATEWAY_OUT
+)
+from pyaiot.common.values import ValueParser, parse_parsers
 
 logger = logging.getLogger("pyaiot.gw.common.gateway")
 
 ALIVE_PERIOD = 30
+RECONNECT_DELAY = 3
 
 
 class GatewayBaseMixin():
@@ -50,6 +62,11 @@ class GatewayBaseMixin():
 
     PROTOCOL = None
 
+    wire_format = JSON
+
+    # Optional messages supported by the broker
+    features = frozenset()
+
     def has_node(self, uid):
         """Check if the node uid is already present."""
         return uid in self.nodes
@@ -58,9 +75,7 @@ class GatewayBaseMixin():
         """Add a new node to the list of nodes and notify the broker."""
         node.set_resource_value('protocol', self.PROTOCOL)
         self.nodes.update({node.uid: node})
-        self.send_to_broker(Message.new_node(node.uid))
-        for res, value in node.resources.items():
-            self.send_to_broker(Message.update_node(node.uid, res, value))
+        self.send_nodes({node.uid: node.resources})
         await self.discover_node(node)
 
     def reset_node(self, node, default_resources={}):
@@ -69,38 +84,86 @@ class GatewayBaseMixin():
         node.set_resource_value('protocol', self.PROTOCOL)
         for resource, value in default_resources.items():
             node.set_resource_value(resource, value)
-        self.send_to_broker(Message.reset_node(node.uid))
+        self.send_to_broker(Message.reset_node(
+            node.uid, wire_format=self.wire_format))
+        # Resources kept after the reset are not rediscovered, the node is
+        # still known by the broker
+        for resource, value in node.resources.items():
+            self.send_to_broker(Message.update_node(
+                node.uid, resource, value, wire_format=self.wire_format))
         self.discover_node(node)
 
     def remove_node(self, node):
         """Remove the given node from known nodes and notify the broker."""
         self.nodes.pop(node.uid)
-        logger.debug("Remaining nodes {}".format(self.nodes))
-        self.send_to_broker(Message.out_node(node.uid))
+        logger.debug("Remaining nodes %s", self.nodes)
+        self.send_to_broker(Message.out_node(
+            node.uid, wire_format=self.wire_format))
 
     def get_node(self, uid):
         """Return the node matching the given uid."""
         return self.nodes[uid]
 
-    def forward_data_from_node(self, node, resource, value):
-        """Send data received from a node to the broker via the gateway."""
-        logger.debug("Sending data received from node '{}': '{}', '{}'."
-                     .format(node, resource, value))
+    def forward_data_from_node(self, node, resource, value, received=None):
+        """Send data received from a node to the broker via the gateway.
+
+        :param received: the time the data was received from the node, used
+                         as ingress timestamp of the latency trace.
+
+        Traced updates are encoded once sent to the broker, with their
+        egress timestamp.
+        """
+        logger.debug("Sending data received from node '%s': '%s', '%s'.",
+                     node, resource, value,
+                     extra={'uid': node.uid, 'endpoint': resource})
         node.set_resource_value(resource, value)
-        self.send_to_broker(Message.update_node(node.uid, resource, value))
+        # Consumers use the typed value instead of parsing the string
+        typed = self.values.parse(resource, value)
+        if self.options.trace:
+            message = Update(uid=node.uid, endpoint=resource, data=value,
+                             dst="all",
+                             trace={GATEWAY_IN: received or time.time()})
+            if typed is not None:
+                message.update({'value': typed})
+            self.send_to_broker(message)
+            return
+        self.send_to_broker(Message.update_node(
+            node.uid, resource, value, wire_format=self.wire_format,
+            value=typed))
 
     def fetch_nodes_cache(self, client):
         """Send cached nodes information to a given client.
 
         :param client: the ID of the client
         """
-        logger.debug("Fetching cached information of registered nodes '{}'."
-                     .format(self.nodes))
-        for node in self.nodes.values():
-            self.send_to_broker(Message.new_node(node.uid, dst=client))
-            for resource, value in node.resources.items():
-                self.send_to_broker(
-                    Message.update_node(node.uid, resource, value, dst=client))
+        logger.debug("Fetching cached information of registered nodes '%s'.",
+                     self.nodes)
+        if not self.nodes:
+            return
+        self.send_nodes(
+            {node.uid: node.resources for node in self.nodes.values()},
+            dst=client)
+
+    def send_nodes(self, nodes, dst="all"):
+        """Send the resources of nodes to the broker.
+
+        The nodes are sent in a single snapshot message when the broker
+        supports it, otherwise as a new message followed by the updates of
+        its resources for each node.
+
+        :param nodes: a dict mapping node uids to their resources
+        """
+        if SNAPSHOT in self.features:
+            self.send_to_broker(Message.snapshot(
+                nodes, dst=dst, wire_format=self.wire_format))
+            return
+        for uid, resources in nodes.items():
+            self.send_to_broker(Message.new_node(
+                uid, dst=dst, wire_format=self.wire_format))
+            for resource, value in resources.items():
+                self.send_to_broker(Message.update_node(
+                    uid, resource, value, dst=dst,
+                    wire_format=self.wire_format))
 
     def close_client(self):
         """Close client websocket"""
@@ -108,18 +171,43 @@ class GatewayBaseMixin():
         if self.broker is not None:
             self.broker.close()
 
+    def broker_subprotocols(self):
+        """Return the subprotocols used to connect to the broker.
+
+        They contain the authentication token and, when a binary wire format
+        is configured, the corresponding subprotocol.
+        """
+        subprotocols = ['token', self.token]
+        wire_format = self.options.wire_format
+        if wire_format != JSON:
+            if wire_format in wire_formats():
+                subprotocols.append(wire_subprotocol(wire_format))
+            else:
+                logger.warning("Unsupported wire format '%s', using JSON",
+                               wire_format)
+        return subprotocols
+
     async def create_broker_connection(self, url):
         """Create an asynchronous connection to the broker."""
         while True:
+            delay = RECONNECT_DELAY
             try:
                 self.broker = await websocket_connect(
-                    url, subprotocols=['token',
-                                       auth_token(self.keys).decode()])
-            except ConnectionRefusedError:
-                logger.warning("Cannot connect, retrying in 3s")
+                    url, subprotocols=self.broker_subprotocols(),
+                    compression_options=compression_options(self.options))
+            except (ConnectionRefusedError, HTTPClientError) as exc:
+                delay = retry_delay(exc, RECONNECT_DELAY)
+                logger.warning("Cannot connect, retrying in %ss", delay)
             else:
-                logger.info("Connected to broker, waiting for incoming "
-                            "messages")
+                # The broker only selects a binary wire format it supports
+                self.wire_format = select_wire_format(
+                    [self.broker.selected_subprotocol or ''])
+                # Older brokers close the connection on batch and snapshot
+                # messages, they are only sent when announced
+                self.features = frozenset(
+                    self.broker.headers.get(FEATURES_HEADER, '').split(','))
+                logger.info("Connected to broker using %s wire format, "
+                            "waiting for incoming messages", self.wire_format)
                 # Start the periodic send of websocket alive messages
                 callback = PeriodicCallback(self.send_alive,
                                             ALIVE_PERIOD * 1000)
@@ -133,43 +221,98 @@ class GatewayBaseMixin():
                         break
                     await self.on_broker_message(message)
 
-            await gen.sleep(3)
+            await gen.sleep(delay)
 
     def send_alive(self):
-        self.send_to_broker(Message.gateway_alive())
+        self.send_to_broker(Message.gateway_alive(self.wire_format))
 
     def send_to_broker(self, message):
-        """Send a string message to the parent broker."""
-        if self.broker is not None:
-            logger.debug("Sending message '{}' to broker.".format(message))
-            self.broker.write_message(message)
+        """Send a message to the parent broker.
+
+        Text messages are JSON, bytes messages use the binary wire format
+        negotiated with the broker. Traced updates are given unencoded, they
+        are stamped with their egress timestamp when written. With a batch
+        interval, messages are sent in batches after the interval or when
+        the batch size is reached, if the broker supports batches.
+        """
+        if self.broker is None:
+            return
+        logger.debug("Sending message '%s' to broker.", message)
+        if not self.options.batch_interval or BATCH not in self.features:
+            message = self._encode(message)
+            self.broker.write_message(message,
+                                      binary=not isinstance(message, str))
+            return
+        self._batch.append(message)
+        if len(self._batch) >= self.options.batch_size:
+            self.flush_batch()
+        elif self._batch_timer is None:
+            self._batch_timer = IOLoop.current().call_later(
+                self.options.batch_interval / 1000, self.flush_batch)
+
+    def flush_batch(self):
+        """Send the pending messages to the broker, in a single batch."""
+        if self._batch_timer is not None:
+            IOLoop.current().remove_timeout(self._batch_timer)
+            self._batch_timer = None
+        pending, self._batch = self._batch, []
+        if not pending:
+            return
+        if self.broker is None:
+            # Nodes are sent again in a snapshot once reconnected
+            logger.warning("Not connected to broker, dropping %d messages",
+                           len(pending))
+            return
+        pending = [self._encode(message) for message in pending]
+        binary = not isinstance(pending[0], str)
+        if len(pending) > 1 and all(
+                isinstance(message, str) != binary for message in pending):
+            pending = [Message.batch(pending,
+                                     self.wire_format if binary else JSON)]
+        for message in pending:
+            self.broker.write_message(message,
+                                      binary=not isinstance(message, str))
+
+    def _encode(self, message):
+        """Return an encoded message, traced updates are stamped first."""
+        if isinstance(message, (str, bytes)):
+            return message
+        message['trace'][GATEWAY_OUT] = time.time()
+        for hop, latency in hop_latencies(message['trace'], GATEWAY_HOPS):
+            self.latency.observe(latency, hop=hop)
+        return Message.serialize(message, self.wire_format)
 
     async def on_broker_message(self, message):
         """Handle a message received from the broker websocket."""
-        logger.debug("Handling message '{}' received from broker."
-                     .format(message))
-        message = json.loads(message)
-
-        if message['type'] == "new":
+        logger.debug("Handling message '%s' received from broker.", message)
+        # The broker forwards the commands of the web clients
+        message, reason = Message.check_message(message, self.wire_format,
+                                                CLIENT_SCHEMAS)
+        if message is None:
+            logger.debug("Invalid message received from broker: %s", reason)
+        elif message.type == "new":
             # Received when a new client connects => fetching the nodes
             # in controller's cache
-            self.fetch_nodes_cache(message['src'])
-        elif (message['type'] == "update" and
-              check_broker_data(message['data'])):
-            data = message['data']
-            logger.debug("Forwarding message ('{}') received from broker to "
-                         "node".format(data))
+            self.fetch_nodes_cache(message.src)
+        elif message.type == "update":
+            data = message.data
+            logger.debug("Forwarding message ('%s') received from broker to "
+                         "node", data)
             # Received when a client update a node
             uid = data['uid']
             endpoint = data['endpoint']
             payload = data['payload']
-            for node in self.nodes.values():
-                if node.uid == uid:
-                    await self.update_node_resource(node, endpoint, payload)
-                    break
-        else:
-            logger.debug("Invalid data received from broker '{}'."
-                         .format(message['data']))
+            if self.has_node(uid):
+                await self.update_node_resource(
+                    self.get_node(uid), endpoint, payload)
+
+
+class GatewayMetricsHandler(web.RequestHandler):
+    """Exposes the gateway metrics in the Prometheus text format."""
+
+    def get(self):
+        self.set_header('Content-Type', CONTENT_TYPE)
+        self.write(self.application.metrics.expose())
 
 
 class GatewayBase(web.Application, GatewayBaseMixin, metaclass=ABCMeta):
@@ -187,12 +330,24 @@ class GatewayBase(web.Application, GatewayBaseMixin, metaclass=ABCMeta):
         self.nodes = {}
         self.broker = None
         self.keys = keys
+        # Reused by all connections, so the broker can keep it in its cache
+        # of verified tokens
+        self.token = auth_token(keys).decode()
+        # Messages waiting to be sent to the broker in a batch
+        self._batch = []
+        self._batch_timer = None
+        self.values = ValueParser(parse_parsers(options.value_parsers))
+        self.metrics = Registry()
+        self.latency = self.metrics.histogram(
+            'pyaiot_gateway_latency_seconds',
+            'Latency of the traced node updates per hop.', ['hop'])
         settings = {'debug': True}
 
         # Create connection to broker
         asyncio.ensure_future(self.create_broker_connection(
             "ws://{}:{}/gw".format(options.broker_host, options.broker_port)))
 
+        handlers = handlers + [(r"/metrics", GatewayMetricsHandler)]
         super().__init__(handlers, **settings)
         logger.debug('Base Gateway application started')
 
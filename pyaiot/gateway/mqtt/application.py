@@ -59,10 +59,10 @@ def run(arguments=[]):
     try:
         parse_command_line(extra_args_func=extra_args)
     except SyntaxError as exc:
-        logger.error("Invalid config file: {}".format(exc))
+        logger.error("Invalid config file: %s", exc)
         return
     except FileNotFoundError as exc:
-        logger.error("Config file not found: {}".format(exc))
+        logger.error("Config file not found: %s", exc)
         return
 
     try:
@@ -72,7 +72,7 @@ def run(arguments=[]):
         return
 
     start_application(MQTTGateway(keys, options=options),
-                      close_client=True)
+                      port=options.gateway_metrics_port, close_client=True)
 
 
 if __name__ == '__main__':
@@ -32,13 +32,13 @@
 import logging
 import time
 import uuid
-import json
 import asyncio
 
 from tornado.ioloop import PeriodicCallback
 
 from gmqtt import Client as MQTTClient
 
+from pyaiot.common.messaging import json_codec
 from pyaiot.gateway.common import Node, GatewayBase
 
 logger = logging.getLogger("pyaiot.gw.mqtt")
@@ -87,12 +87,11 @@ class MQTTGateway(GatewayBase):
 
     def on_message(self, client, topic, payload, qos, properties):
         try:
-            data = json.loads(payload)
+            data = json_codec.loads(payload)
         except Exception:
             # Skip data if not valid
             return
-        logger.debug("Received message from node: {} => {}"
-                     .format(topic, data))
+        logger.debug("Received message from node: %s => %s", topic, data)
         if topic.endswith("/check"):
             asyncio.get_event_loop().create_task(
                 self.handle_node_check(data))
@@ -120,8 +119,8 @@ class MQTTGateway(GatewayBase):
     async def discover_node(self, node):
         discover_topic = 'gateway/{}/discover'.format(node.resources['id'])
         await self.mqtt_client.publish(discover_topic, "resources", qos=1)
-        logger.debug("Published '{}' to topic: {}"
-                     .format("resources", discover_topic))
+        logger.debug("Published '%s' to topic: %s", "resources",
+                     discover_topic)
 
     def update_node_resource(self, node, endpoint, payload):
         node_id = node.resources['id']
@@ -137,7 +136,7 @@ class MQTTGateway(GatewayBase):
 
             resources_topic = 'node/{}/resources'.format(node_id)
             await self.mqtt_client.subscribe(resources_topic, 1)
-            logger.debug("Subscribed to topic: {}".format(resources_topic))
+            logger.debug("Subscribed to topic: %s", resources_topic)
 
             self.add_node(node)
         else:
@@ -180,7 +179,7 @@ class MQTTGateway(GatewayBase):
         to_remove = [node for node in self.nodes.values()
                      if int(time.time()) > node.last_seen + self.max_time]
         for node in to_remove:
-            logger.info("Removing inactive node {}".format(node.uid))
+            logger.info("Removing inactive node %s", node.uid)
             asyncio.get_event_loop().create_task(
                 self._disconnect_from_node(node))
             self.node_mapping.pop(node.resources['id'])
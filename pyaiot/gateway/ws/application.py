@@ -56,10 +56,10 @@ def run(arguments=[]):
     try:
         parse_command_line(extra_args_func=extra_args)
     except SyntaxError as exc:
-        logger.error("Invalid config file: {}".format(exc))
+        logger.error("Invalid config file: %s", exc)
         return
     except FileNotFoundError as exc:
-        logger.error("Config file not found: {}".format(exc))
+        logger.error("Config file not found: %s", exc)
         return
 
     try:
@@ -31,10 +31,10 @@
 
 import logging
 import uuid
-import json
 from tornado import websocket
 
-from pyaiot.common.messaging import Message
+from pyaiot.common.compression import compression_options
+from pyaiot.common.messaging import Message, json_codec
 from pyaiot.gateway.common import GatewayBase, Node
 
 logger = logging.getLogger("pyaiot.gw.ws")
@@ -45,6 +45,9 @@ class WebsocketNodeHandler(websocket.WebSocketHandler):
         """Allow connections from anywhere."""
         return True
 
+    def get_compression_options(self):
+        return compression_options(self.application.options)
+
     def open(self):
         """Discover nodes on each opened connection."""
         self.set_nodelay(True)
@@ -85,8 +88,8 @@ class WebsocketGateway(GatewayBase):
 
         self.node_mapping = {}
 
-        logger.info('WS gateway started, listening on port {}'
-                    .format(options.gateway_port))
+        logger.info('WS gateway started, listening on port %s',
+                    options.gateway_port)
 
     async def discover_node(self, node):
         for ws, uid in self.node_mapping.items():
@@ -97,8 +100,8 @@ class WebsocketGateway(GatewayBase):
     def update_node_resource(self, node, resource, value):
         for ws, uid in self.node_mapping.items():
             if node.uid == uid:
-                ws.write_message(json.dumps({"endpoint": resource,
-                                             "payload": value}))
+                ws.write_message(json_codec.dumps({"endpoint": resource,
+                                                   "payload": value}))
                 break
 
     def on_node_message(self, ws, message):
@@ -0,0 +1,742 @@
+"""pyaiot broker test module."""
+
+import json
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from unittest import mock
+from pytest import fixture
+
+from tornado.options import options
+from tornado.testing import AsyncHTTPTestCase, gen_test
+from tornado.websocket import websocket_connect
+
+from pyaiot.common.auth import Keys
+from pyaiot.common.compression import Deflate, DEFLATE_TRAILER
+from pyaiot.common.helpers import parse_command_line
+from pyaiot.common.messaging import (
+    Message, JSON, CLIENT_SCHEMAS, GATEWAY_SCHEMAS, FEATURES_HEADER
+)
+from pyaiot.broker.application import extra_args
+from pyaiot.broker.broker import Broker
+from pyaiot.broker.commands import CommandScheduler
+from pyaiot.broker.frames import Frames
+from pyaiot.broker.telemetry import SegmentLog
+from pyaiot.broker import outbound
+from pyaiot.broker.outbound import OutboundQueue, DROP_OLDEST, DISCONNECT
+from pyaiot.broker.workers import WorkerBus
+
+
+class FakeWebsocket():
+    """Records what the broker writes to a websocket."""
+
+    peer = False
+    wire_format = JSON
+    compression = None
+    features = frozenset()
+    queue = None
+
+    def __init__(self, uid=None):
+        self.uid = uid
+        self.frames = []
+        self.keys = []
+        self.messages = []
+        self.closed = False
+
+    def send(self, frame, key=None):
+        self.frames.append(frame)
+        self.keys.append(key)
+
+    def write_message(self, message, binary=False):
+        self.messages.append(message)
+
+    def close(self, code=None, reason=None):
+        self.closed = True
+
+
+@fixture
+def broker(monkeypatch):
+    monkeypatch.setattr(sys, 'argv', ['aiot-broker'])
+    parse_command_line(extra_args_func=extra_args)
+    return Broker(Keys(private='private', secret='secret'), options)
+
+
+def payload(frame):
+    """Return the payload of a small websocket frame."""
+    return frame[4:] if frame[1] == 126 else frame[2:]
+
+
+def received(client):
+    """Return the messages sent to a client, without their session stamps."""
+    messages = []
+    for frame in client.frames:
+        message = json.loads(payload(frame))
+        message.pop('epoch', None)
+        message.pop('seq', None)
+        messages.append(Message.serialize(message))
+    return messages
+
+
+def send_from_client(broker, client, message):
+    message, _ = Message.check_message(Message.serialize(message),
+                                       schemas=CLIENT_SCHEMAS)
+    broker.on_client_message(client, message)
+
+
+def connect_client(broker, uid, features=()):
+    client = FakeWebsocket(uid)
+    send_from_client(broker, client, {'type': 'new', 'src': uid,
+                                      'features': list(features)})
+    return client
+
+
+def connect_gateway(broker):
+    gateway = FakeWebsocket()
+    broker.add_gateway(gateway)
+    return gateway
+
+
+def send_from_gateway(broker, gateway, raw):
+    message, _ = Message.check_message(raw, schemas=GATEWAY_SCHEMAS)
+    broker.on_gateway_message(gateway, message, raw)
+
+
+def test_broadcast_shares_frame(broker):
+    clients = [connect_client(broker, str(uid)) for uid in range(3)]
+    gateway = connect_gateway(broker)
+
+    raw = Message.new_node('1234')
+    send_from_gateway(broker, gateway, raw)
+
+    assert received(clients[0]) == [raw]
+    assert all(client.frames[0] is clients[0].frames[0]
+               for client in clients)
+
+
+def test_broadcast_compressed_once(broker):
+    compression = Deflate(wbits=15, level=6, mem_level=8, threshold=64)
+    clients = [connect_client(broker, str(uid)) for uid in range(3)]
+    for client in clients[1:]:
+        client.compression = compression
+    gateway = connect_gateway(broker)
+
+    small = Message.new_node('1234')
+    large = Message.update_node('1234', 'led', 'on' * 100)
+    send_from_gateway(broker, gateway, small)
+    send_from_gateway(broker, gateway, large)
+
+    # Small messages stay uncompressed
+    assert clients[1].frames[0] == clients[0].frames[0]
+    frame = clients[1].frames[1]
+    assert frame is clients[2].frames[1]
+    assert frame[0] & 0x40
+    assert len(frame) < len(clients[0].frames[1])
+    message = json.loads(zlib.decompressobj(-15).decompress(
+        payload(frame) + DEFLATE_TRAILER))
+    assert message['data'] == 'on' * 100
+
+
+def test_reply_sent_to_single_client(broker):
+    clients = [connect_client(broker, str(uid)) for uid in range(2)]
+    gateway = connect_gateway(broker)
+
+    raw = Message.new_node('1234', dst='1')
+    send_from_gateway(broker, gateway, raw)
+
+    assert clients[0].frames == []
+    assert received(clients[1]) == [raw]
+
+
+def test_gateway_frame_with_whitespace(broker):
+    client = connect_client(broker, 'client')
+    gateway = connect_gateway(broker)
+
+    # Clients receive valid stamped JSON, without the leading whitespace
+    raw = Message.new_node('1234')
+    send_from_gateway(broker, gateway, ' \n' + raw + '\n')
+    frame = payload(client.frames[0]).decode()
+    assert frame.startswith('{"seq":1,"type":"new"')
+    assert received(client) == [raw]
+
+
+def test_gateway_json_binary_frame(broker):
+    client = connect_client(broker, 'client')
+    gateway = connect_gateway(broker)
+
+    # JSON received in a binary frame is stamped and sent as text
+    raw = Message.new_node('1234')
+    send_from_gateway(broker, gateway, raw.encode())
+    assert client.frames[0][0] & 0x0f == 0x1
+    assert received(client) == [raw]
+    assert len(broker.replay.since(broker.replay.epoch, 0)) == 1
+
+
+def test_queue_drop_oldest_keeps_control_frames():
+    queue = OutboundQueue(maxsize=2, policy=DROP_OLDEST)
+    queue.put(b'new')
+    queue.put(b'update1', key=('1234', 'led'))
+    queue.put(b'update2', key=('1234', 'led'))
+
+    assert queue.drain() == [b'new', b'update2']
+    assert queue.dropped == 1
+    assert len(queue) == 0
+
+    # Control frames are only dropped when no keyed frame is left
+    for frame in (b'new', b'update', b'out', b'reset'):
+        queue.put(frame, key=('1234', 'led') if frame == b'update' else None)
+    assert queue.drain() == [b'out', b'reset']
+    assert (queue.dropped, queue.dropped_control) == (3, 1)
+
+    # The warning about dropped control frames is rate limited
+    queue = OutboundQueue(maxsize=2, policy=DROP_OLDEST)
+    with mock.patch.object(outbound.logger, 'warning') as warning:
+        for frame in (b'new', b'out', b'reset', b'new', b'out'):
+            queue.put(frame)
+    assert queue.dropped_control == 3
+    assert warning.call_count == 1
+
+
+def test_queue_disconnect():
+    queue = OutboundQueue(maxsize=1, policy=DISCONNECT)
+
+    assert queue.put(b'update1', key=('1234', 'led'))
+    assert not queue.put(b'update2', key=('1234', 'led'))
+
+
+def test_new_client_served_from_cache(broker, monkeypatch):
+    gateway = connect_gateway(broker)
+    send_from_gateway(broker, gateway, Message.new_node('1234'))
+    send_from_gateway(broker, gateway,
+                      Message.update_node('1234', 'led', '1'))
+    send_from_gateway(broker, gateway, Message.new_node('5678'))
+    send_from_gateway(broker, gateway, Message.out_node('5678'))
+
+    # Cached messages are sent, and counted, without being decoded
+    monkeypatch.setattr(Frames, '_decoded', None)
+    client = connect_client(broker, 'client')
+
+    assert gateway.messages == []
+    assert received(client) == [
+        Message.new_node('1234', dst='client'),
+        Message.update_node('1234', 'led', '1', dst='client')]
+
+
+def test_gateway_closed_clears_cache(broker):
+    gateway = connect_gateway(broker)
+    send_from_gateway(broker, gateway, Message.new_node('1234'))
+    broker.remove_ws(gateway)
+
+    assert '1234' not in broker.nodes
+
+
+def test_subscriptions(broker):
+    gateway = connect_gateway(broker)
+    send_from_gateway(broker, gateway, Message.new_node('1234'))
+    send_from_gateway(broker, gateway,
+                      Message.update_node('1234', 'protocol', 'CoAP'))
+
+    client_all = connect_client(broker, 'all')
+    client_led = FakeWebsocket('led')
+    broker.on_client_message(
+        client_led, Message.check_message(Message.subscribe(
+            endpoint='led', protocol='CoAP'))[0])
+    send_from_client(broker, client_led, {'type': 'new', 'src': 'led'})
+    client_all.frames.clear()
+
+    # The led client only received the node announce
+    assert received(client_led) == [
+        Message.new_node('1234', dst='led')]
+    client_led.frames.clear()
+
+    for endpoint in ('led', 'temperature'):
+        send_from_gateway(broker, gateway,
+                          Message.update_node('1234', endpoint, '1'))
+
+    assert len(client_all.frames) == 2
+    assert received(client_led) == [
+        Message.update_node('1234', 'led', '1')]
+
+    broker.on_client_message(
+        client_led, Message.check_message(Message.unsubscribe(
+            endpoint='led', protocol='CoAP'))[0])
+    send_from_gateway(broker, gateway,
+                      Message.update_node('1234', 'led', '0'))
+
+    assert len(client_led.frames) == 1
+    assert gateway.messages == []
+
+
+def test_update_coalescing(broker, monkeypatch):
+    monkeypatch.setattr(broker.options, 'update_coalescing', 50)
+    gateway = connect_gateway(broker)
+    client = connect_client(broker, 'client')
+    send_from_gateway(broker, gateway, Message.new_node('1234'))
+    for value in range(3):
+        send_from_gateway(broker, gateway,
+                          Message.update_node('1234', 'imu', value))
+    send_from_gateway(broker, gateway, Message.new_node('5678'))
+    send_from_gateway(broker, gateway,
+                      Message.update_node('5678', 'imu', 0))
+    send_from_gateway(broker, gateway, Message.reset_node('5678'))
+
+    assert received(client) == [Message.new_node('1234'),
+                                Message.new_node('5678'),
+                                Message.reset_node('5678')]
+    assert broker.nodes.resources('1234') == {'imu': 2}
+
+    broker.flush_updates()
+    assert received(client)[3:] == [
+        Message.update_node('1234', 'imu', 2)]
+
+
+def test_batch(broker):
+    gateway = connect_gateway(broker)
+    clients = [connect_client(broker, str(uid), features=['batch'])
+               for uid in range(2)]
+    plain = connect_client(broker, 'plain')
+    records = [Message.new_node('1234'),
+               Message.update_node('1234', 'imu', 1),
+               Message.update_node('1234', 'imu', 2)]
+    send_from_gateway(broker, gateway, Message.batch(records))
+
+    assert broker.nodes.resources('1234') == {'imu': 2}
+    assert received(plain) == records
+    # Clients supporting batches receive the same single batch frame
+    assert len(clients[0].frames) == 1
+    assert clients[1].frames[0] is clients[0].frames[0]
+    batch = json.loads(payload(clients[0].frames[0]))
+    assert batch['type'] == 'batch'
+    assert [record['data'] for record in batch['data'][1:]] == [1, 2]
+    # Batches with control records are queued as control frames, batches of
+    # updates with the keys of their updates
+    assert clients[0].keys == [None]
+    send_from_gateway(broker, gateway, Message.batch(records[1:]))
+    assert clients[0].keys[1] == (('1234', 'imu'), ('1234', 'imu'))
+
+    # Nested batches are rejected
+    raw = Message.batch([Message.batch(records)])
+    assert Message.check_message(raw, schemas=GATEWAY_SCHEMAS)[0] is None
+
+
+def test_snapshot(broker):
+    gateway = connect_gateway(broker)
+    client = connect_client(broker, 'client')
+    nodes = {'1234': {'led': '1', 'protocol': 'coap'}, '5678': {}}
+    send_from_gateway(broker, gateway, Message.snapshot(nodes))
+
+    assert broker.routes['5678'] is gateway
+    assert broker.nodes.resources('1234') == nodes['1234']
+    assert received(client) == [
+        Message.new_node('1234'),
+        Message.update_node('1234', 'led', '1'),
+        Message.update_node('1234', 'protocol', 'coap'),
+        Message.new_node('5678')]
+
+    # Joining clients supporting snapshots receive all nodes in one frame
+    client = connect_client(broker, 'new', features=['snapshot'])
+    assert received(client) == [Message.snapshot(nodes, dst='new')]
+
+
+def test_remote_gateway_events(broker):
+    bus = WorkerBus(broker, 0, 2, '/tmp')
+    sent = []
+    bus.send = lambda worker, event: sent.append((worker, event))
+    client = connect_client(broker, 'client')
+
+    bus._on_event(1, {'kind': 'gateway', 'gateway': 'gw',
+                      'message': Message.new_node('1234')})
+
+    assert received(client) == [Message.new_node('1234')]
+    assert '1234' in broker.nodes
+
+    command = {'type': 'update', 'src': 'client',
+               'data': {'uid': '1234', 'endpoint': 'led', 'payload': '1'}}
+    send_from_client(broker, client, command)
+    assert sent == [(1, {'kind': 'client', 'gateway': 'gw',
+                         'message': Message.serialize(command)})]
+
+    bus._on_event(1, {'kind': 'gateway-closed', 'gateway': 'gw'})
+    assert '1234' not in broker.nodes
+    assert received(client)[-1] == Message.out_node('1234')
+
+
+def test_federation(broker):
+    gateway = connect_gateway(broker)
+    gateway.uid = 'gw'
+    send_from_gateway(broker, gateway, Message.new_node('local'))
+    client = connect_client(broker, 'client')
+    connection = FakeWebsocket()
+    link = broker.federation.open_link(connection)
+    assert connection.messages == [Message.serialize(
+        {'kind': 'hello', 'broker': broker.federation.uid})]
+    connection.messages.clear()
+
+    # The nodes of the gateways of the broker are sent to the identified peer
+    broker.federation.on_link_message(link, Message.serialize(
+        {'kind': 'hello', 'broker': 'peer'}))
+    assert connection.messages == [Message.serialize(
+        {'kind': 'node', 'message': Message.new_node('local')})]
+
+    broker.federation.on_link_message(link, Message.serialize(
+        {'kind': 'node', 'message': Message.new_node('remote')}))
+    assert received(client)[-1] == Message.new_node('remote')
+    # Messages from peers are not relayed to peers
+    assert len(connection.messages) == 1
+
+    command = {'type': 'update', 'src': 'client',
+               'data': {'uid': 'remote', 'endpoint': 'led', 'payload': '1'}}
+    send_from_client(broker, client, command)
+    assert connection.messages[-1] == Message.serialize(
+        {'kind': 'client', 'message': Message.serialize(command)})
+
+    broker.federation.on_link_message(link, Message.serialize(
+        {'kind': 'client', 'message': Message.serialize(command)}))
+    assert len(connection.messages) == 2
+
+    # Other client messages are not accepted from peers
+    for message in ({'type': 'subscribe', 'data': {}},
+                    {'type': 'new', 'src': 'client'}):
+        broker.federation.on_link_message(link, Message.serialize(
+            {'kind': 'client', 'message': Message.serialize(message)}))
+    assert ('pyaiot_broker_invalid_messages_total{source="peer"} 2\n'
+            in broker.metrics.expose())
+
+    broker.federation.close_link(link)
+    assert 'remote' not in broker.nodes
+    assert 'local' in broker.nodes
+
+
+def test_federation_duplicate_links(broker):
+    federation = broker.federation
+    client = connect_client(broker, 'client')
+    # Both brokers list each other as peers, the link dialed by the broker
+    # with the lowest id is kept
+    peer_id = federation.uid + '-higher'
+    dialed = federation.open_link(FakeWebsocket(), url='ws://peer/peer')
+    accepted = federation.open_link(FakeWebsocket())
+    federation.on_link_message(accepted, Message.serialize(
+        {'kind': 'hello', 'broker': peer_id}))
+    federation.on_link_message(accepted, Message.serialize(
+        {'kind': 'node', 'message': Message.new_node('remote')}))
+    federation.on_link_message(dialed, Message.serialize(
+        {'kind': 'hello', 'broker': peer_id}))
+
+    assert accepted.connection.closed and not dialed.connection.closed
+    assert federation.peer_links == {peer_id: dialed}
+    assert received(client) == [Message.new_node('remote'),
+                                Message.out_node('remote')]
+
+    # A new link with a linked peer is refused
+    again = federation.open_link(FakeWebsocket())
+    federation.on_link_message(again, Message.serialize(
+        {'kind': 'hello', 'broker': peer_id}))
+    assert again.connection.closed
+    assert list(federation.links) == [dialed.uid]
+
+
+def test_command_routed_to_owner(broker):
+    gateways = [connect_gateway(broker) for _ in range(3)]
+    for index, gateway in enumerate(gateways):
+        send_from_gateway(broker, gateway, Message.new_node(str(index)))
+    client = connect_client(broker, 'client')
+
+    command = {'type': 'update', 'src': 'client',
+               'data': {'uid': '1', 'endpoint': 'led', 'payload': '1'}}
+    send_from_client(broker, client, command)
+
+    assert [len(gateway.messages) for gateway in gateways] == [0, 1, 0]
+    assert gateways[1].messages == [Message.serialize(command)]
+
+    send_from_gateway(broker, gateways[1], Message.out_node('1'))
+    send_from_client(broker, client, command)
+    assert len(gateways[1].messages) == 1
+
+    # A node that moved keeps its state when its former gateway reports it
+    send_from_gateway(broker, gateways[0], Message.new_node('2'))
+    send_from_gateway(broker, gateways[0],
+                      Message.update_node('2', 'led', '1'))
+    send_from_gateway(broker, gateways[2], Message.out_node('2'))
+    broker.remove_ws(gateways[2])
+    assert broker.nodes.resources('2') == {'led': '1'}
+    assert Message.out_node('2') not in received(client)
+
+
+def test_client_commands_scheduled_fairly(broker, monkeypatch):
+    clock = [0]
+    monkeypatch.setattr('pyaiot.broker.ratelimit.time.monotonic',
+                        lambda: clock[0])
+    forwarded = []
+    scheduler = CommandScheduler(forwarded.append,
+                                 broker.metrics.client_commands,
+                                 rate=1, rates={'update': 2}, burst=2)
+
+    def command(endpoint, value):
+        return {'type': 'update', 'src': 'client',
+                'data': {'uid': '1', 'endpoint': endpoint, 'payload': value}}
+
+    scheduler.submit('greedy', command('led', '1'))
+    scheduler.submit('greedy', command('pwm', '1'))
+    scheduler.submit('greedy', command('led', '0'))
+    clock[0] += 0.5
+    scheduler.submit('greedy', command('led', '0'))
+    scheduler.submit('greedy', command('led', '1'))
+    scheduler.submit('other', command('led', '0'))
+    clock[0] += 0.5
+    scheduler.submit('greedy', command('pwm', '0'))
+    for _ in range(2):
+        clock[0] += 1
+        scheduler.dispatch()
+
+    # The greedy client is over its own rate once, its queued led update is
+    # replaced by a newer one, and the other client is served in between
+    assert [(message['data']['endpoint'], message['data']['payload'])
+            for message in forwarded] == [('led', '1'), ('pwm', '1'),
+                                          ('led', '1'), ('led', '0'),
+                                          ('pwm', '0')]
+    metrics = broker.metrics.expose()
+    assert ('pyaiot_broker_client_commands_total'
+            '{type="update",outcome="dropped"} 1\n') in metrics
+    assert ('pyaiot_broker_client_commands_total'
+            '{type="update",outcome="coalesced"} 1\n') in metrics
+    assert ('pyaiot_broker_client_commands_total'
+            '{type="update",outcome="forwarded"} 5\n') in metrics
+
+
+def test_metrics(broker):
+    client = connect_client(broker, 'client')
+    gateway = connect_gateway(broker)
+    gateway.uid = 'gw'
+    send_from_gateway(broker, gateway, Message.new_node('1234'))
+    send_from_client(broker, client, {'type': 'update', 'src': 'client',
+                                      'data': {'uid': '1234',
+                                               'endpoint': 'led',
+                                               'payload': '1'}})
+
+    metrics = broker.metrics.expose()
+
+    assert 'pyaiot_broker_clients 1\n' in metrics
+    assert 'pyaiot_broker_gateway_nodes{gateway="gw"} 1\n' in metrics
+    assert ('pyaiot_broker_messages_received_total'
+            '{source="gateway",type="new"} 1\n') in metrics
+    assert ('pyaiot_broker_messages_sent_total'
+            '{destination="client",type="new"} 1\n') in metrics
+    assert ('pyaiot_broker_messages_sent_total'
+            '{destination="gateway",type="update"} 1\n') in metrics
+    assert 'pyaiot_broker_broadcast_seconds_count 1\n' in metrics
+    assert 'pyaiot_broker_client_queued_frames 0\n' in metrics
+
+    # Frames dropped from the queues of slow clients are counted per kind
+    queue = OutboundQueue(maxsize=1, on_drop=broker.metrics.dropped_frame)
+    for frame in (b'new', b'out', b'update1', b'update2'):
+        queue.put(frame, key=('1234', 'led') if b'update' in frame else None)
+    metrics = broker.metrics.expose()
+    assert ('pyaiot_broker_client_dropped_frames_total'
+            '{kind="control"} 2\n') in metrics
+    assert ('pyaiot_broker_client_dropped_frames_total'
+            '{kind="update"} 1\n') in metrics
+
+
+def test_resume_session(broker, monkeypatch):
+    gateway = connect_gateway(broker)
+    send_from_gateway(broker, gateway, Message.new_node('1234'))
+    client = connect_client(broker, 'client')
+    send_from_gateway(broker, gateway,
+                      Message.update_node('1234', 'led', '0'))
+    last = json.loads(payload(client.frames[-1]))
+    broker.remove_ws('client')
+
+    send_from_gateway(broker, gateway,
+                      Message.update_node('1234', 'led', '1'))
+
+    # Only the missed update is replayed
+    client = FakeWebsocket('client')
+    send_from_client(broker, client, {
+        'type': 'new', 'src': 'client',
+        'data': {'epoch': broker.replay.epoch, 'seq': last['seq']}})
+    assert received(client) == [Message.update_node('1234', 'led', '1')]
+
+    # Fall back to the cached nodes when the missed updates are gone
+    client = FakeWebsocket('other')
+    monkeypatch.setattr(broker.replay, '_entries', [])
+    send_from_client(broker, client, {
+        'type': 'new', 'src': 'other',
+        'data': {'epoch': broker.replay.epoch, 'seq': last['seq']}})
+    assert received(client) == [
+        Message.new_node('1234', dst='other'),
+        Message.update_node('1234', 'led', '1', dst='other')]
+    snapshot = json.loads(payload(client.frames[0]))
+    assert snapshot['epoch'] == broker.replay.epoch
+
+    # Session stamps sent by a gateway are replaced by the broker ones
+    raw = Message.serialize({'type': 'update', 'uid': '1234',
+                             'endpoint': 'led', 'data': '0', 'seq': 99})
+    send_from_gateway(broker, gateway, raw)
+    assert json.loads(payload(client.frames[-1]))['seq'] == broker.replay.seq
+
+    # Clients supporting snapshots learn the epoch even without nodes
+    broker.remove_ws(gateway)
+    client = connect_client(broker, 'empty', features=['snapshot'])
+    assert json.loads(payload(client.frames[0])) == {
+        'type': 'snapshot', 'data': {}, 'dst': 'empty',
+        'epoch': broker.replay.epoch, 'seq': broker.replay.seq}
+
+
+def test_trace(broker):
+    client = connect_client(broker, 'client')
+    gateway = connect_gateway(broker)
+    send_from_gateway(broker, gateway, Message.new_node('1234'))
+    send_from_gateway(broker, gateway, Message.update_node(
+        '1234', 'led', '1', trace={'gw_in': 1.0, 'gw_out': 1.5}))
+
+    trace = json.loads(payload(client.frames[-1]))['trace']
+    assert trace['br_in'] <= trace['br_out']
+    send_from_client(broker, client, {'type': 'trace', 'src': 'client',
+                                      'data': dict(trace, cl_in=3.0)})
+
+    metrics = broker.metrics.expose()
+    for hop in ('gateway', 'uplink', 'broker', 'downlink', 'end_to_end'):
+        assert ('pyaiot_broker_latency_seconds_count{{hop="{}"}} 1\n'
+                .format(hop)) in metrics
+    assert ('pyaiot_broker_latency_seconds_sum{hop="gateway"} 0.5\n'
+            in metrics)
+
+
+def test_typed_values(broker):
+    gateway = connect_gateway(broker)
+    client = connect_client(broker, 'client')
+    send_from_gateway(broker, gateway, Message.new_node('1234'))
+    raw = Message.update_node('1234', 'temperature', '23°C',
+                              value={'number': 23, 'unit': '°C'})
+    send_from_gateway(broker, gateway, raw)
+
+    assert received(client)[-1] == raw
+    assert broker.nodes.resources('1234') == {'temperature': '23°C'}
+    assert list(broker.history.window('1234', 'temperature')[1]) == [23.0]
+
+    raw = Message.update_node('1234', 'temperature', '23°C', value='23')
+    assert Message.check_message(raw, schemas=GATEWAY_SCHEMAS)[0] is None
+
+
+def test_telemetry_log(tmp_path):
+    log = SegmentLog(str(tmp_path), segment_size=100, retention=0)
+    for timestamp in range(10):
+        log.append('1234', 'temperature', str(20 + timestamp), timestamp)
+        log.append('1234', 'name', 'node', timestamp)
+        if timestamp % 2:
+            log.flush()
+    log.close()
+    assert len(list(tmp_path.iterdir())) == 5
+
+    times, values = SegmentLog(str(tmp_path), retention=0).window(
+        '1234', 'temperature', since=3, until=6)
+    assert list(times) == [3, 4, 5, 6]
+    assert list(values) == [23, 24, 25, 26]
+
+    # A record torn by a crash is dropped when the log is opened again
+    segment = sorted(tmp_path.iterdir())[-1]
+    size = segment.stat().st_size
+    with open(str(segment), 'ab') as data:
+        data.write(b'torn')
+    log = SegmentLog(str(tmp_path), retention=0)
+    times, _ = log.window('1234', 'temperature')
+    assert len(times) == 10
+    assert segment.stat().st_size == size
+
+    # Segments are deleted once all their records are older than the
+    # retention, the first kept one may start before it
+    log = SegmentLog(str(tmp_path), segment_size=100,
+                     retention=time.time() - 6.5)
+    log.append('1234', 'temperature', '30', 10)
+    log.flush()
+    segments = sorted(path.name for path in tmp_path.iterdir())
+    assert segments == ['{:020d}.seg'.format(timestamp * 1000000)
+                        for timestamp in (6, 8, 10)]
+    times, _ = log.window('1234', 'temperature')
+    assert list(times) == [7, 8, 9, 10]
+
+
+class TestHTTPEndpoints(AsyncHTTPTestCase):
+
+    def get_app(self):
+        with mock.patch.object(sys, 'argv', ['aiot-broker']):
+            parse_command_line(extra_args_func=extra_args)
+        return Broker(Keys(private='private', secret='secret'), options)
+
+    def test_nodes(self):
+        broker = self._app
+        gateway = connect_gateway(broker)
+        send_from_gateway(broker, gateway, Message.new_node('1234'))
+        send_from_gateway(broker, gateway,
+                          Message.update_node('1234', 'led', '1'))
+        send_from_gateway(broker, gateway,
+                          Message.update_node('1234', 'name', 'node'))
+
+        response = self.fetch('/nodes?fields=led')
+        assert json.loads(response.body) == {'1234': {'led': '1'}}
+        etag = response.headers['Etag']
+        response = self.fetch('/nodes/1234')
+        assert json.loads(response.body) == {'led': '1', 'name': 'node'}
+
+        response = self.fetch('/nodes', headers={'If-None-Match': etag})
+        assert response.code == 304
+        send_from_gateway(broker, gateway,
+                          Message.update_node('1234', 'led', '0'))
+        response = self.fetch('/nodes', headers={'If-None-Match': etag})
+        assert response.code == 200
+        assert self.fetch('/nodes/5678').code == 404
+
+    def test_history(self):
+        broker = self._app
+        gateway = connect_gateway(broker)
+        send_from_gateway(broker, gateway, Message.new_node('1234'))
+        for value in ('20', '22', '21', 'unknown', '23'):
+            send_from_gateway(broker, gateway,
+                              Message.update_node('1234', 'temperature',
+                                                  value))
+
+        response = json.loads(self.fetch('/history/1234/temperature').body)
+        assert [value for _, value in response['samples']] == [20, 22, 21, 23]
+        response = json.loads(
+            self.fetch('/history/1234/temperature?points=1').body)
+        assert [sample[1:] for sample in response['samples']] == [[20, 23,
+                                                                   21.5]]
+        assert self.fetch('/history/1234/temperature?points=0').code == 400
+        assert self.fetch('/history/1234/led').code == 404
+
+    @gen_test
+    async def test_gateway_features(self):
+        with mock.patch.object(self._app.tokens, 'verify', return_value=True):
+            connection = await websocket_connect(
+                'ws://127.0.0.1:{}/gw'.format(self.get_http_port()),
+                subprotocols=['token', 'token'])
+        assert connection.headers[FEATURES_HEADER] == 'batch,snapshot'
+        connection.close()
+
+    @gen_test
+    async def test_telemetry_flushed_in_executor(self):
+        broker = self._app
+        threads = []
+        with tempfile.TemporaryDirectory() as directory:
+            broker.telemetry = SegmentLog(directory)
+            flush = broker.telemetry.flush
+
+            def record_thread():
+                threads.append(threading.get_ident())
+                flush()
+
+            broker.telemetry.flush = record_thread
+            gateway = connect_gateway(broker)
+            send_from_gateway(broker, gateway, Message.new_node('1234'))
+            send_from_gateway(broker, gateway,
+                              Message.update_node('1234', 'temperature', '21'))
+            broker.flush_telemetry()
+            await broker._telemetry_flush
+            broker.telemetry.close()
+
+            # The log is written outside of the IOLoop thread
+            assert threads and threads[0] != threading.get_ident()
+            times, values = SegmentLog(directory).window('1234',
+                                                         'temperature')
+            assert list(values) == [21]
@@ -0,0 +1,207 @@
+"""pyaiot gateway test module."""
+
+import asyncio
+import logging
+from unittest import mock
+
+from tornado.ioloop import IOLoop
+
+from pyaiot.common.messaging import (
+    Message, BATCH, SNAPSHOT, GATEWAY_SCHEMAS
+)
+from pyaiot.common.metrics import Registry
+from pyaiot.common.trace import GATEWAY_IN, GATEWAY_OUT
+from pyaiot.common.values import ValueParser
+from pyaiot.gateway.common.gateway import GatewayBaseMixin
+from pyaiot.gateway.common.node import Node
+
+
+class FakeBroker():
+    """Records what the gateway writes to the broker websocket."""
+
+    def __init__(self):
+        self.messages = []
+
+    def write_message(self, message, binary=False):
+        self.messages.append((message, binary))
+
+
+class FakeOptions():
+    batch_interval = 10
+    batch_size = 3
+    trace = False
+
+
+class FakeGateway(GatewayBaseMixin):
+
+    PROTOCOL = 'test'
+    features = frozenset([BATCH])
+
+    def __init__(self):
+        self.options = FakeOptions()
+        self.broker = FakeBroker()
+        self.nodes = {}
+        self._batch = []
+        self._batch_timer = None
+        self.values = ValueParser()
+        self.metrics = Registry()
+        self.latency = self.metrics.histogram('latency', 'Latency.', ['hop'])
+
+    async def discover_node(self, node):
+        pass
+
+
+def sent(gateway):
+    return [message for message, _ in gateway.broker.messages]
+
+
+def records(message):
+    message, reason = Message.check_message(message, schemas=GATEWAY_SCHEMAS)
+    assert reason is None and message.type == 'batch'
+    return [record['data'] for record in message.records]
+
+
+def test_batch_size_flush():
+    gateway = FakeGateway()
+
+    async def run():
+        for value in range(4):
+            gateway.send_to_broker(Message.update_node('1', 'x', value))
+
+    IOLoop.current().run_sync(run)
+
+    # The batch is sent as soon as the batch size is reached
+    assert len(gateway.broker.messages) == 1
+    message, binary = gateway.broker.messages[0]
+    assert not binary
+    assert records(message) == [0, 1, 2]
+    assert len(gateway._batch) == 1
+    assert gateway._batch_timer is not None
+    gateway.flush_batch()
+    assert gateway._batch_timer is None
+
+
+def test_batch_timer_flush():
+    gateway = FakeGateway()
+
+    async def run():
+        gateway.send_to_broker(Message.update_node('1', 'x', 0))
+        gateway.send_to_broker(Message.update_node('1', 'x', 1))
+        assert gateway.broker.messages == []
+        await asyncio.sleep(0.05)
+
+    IOLoop.current().run_sync(run)
+
+    # The pending messages are sent once the batch interval elapsed
+    assert len(gateway.broker.messages) == 1
+    assert records(gateway.broker.messages[0][0]) == [0, 1]
+    assert gateway._batch == [] and gateway._batch_timer is None
+
+    # A single pending message is sent as is
+    async def run_single():
+        gateway.send_to_broker(Message.update_node('1', 'x', 2))
+        await asyncio.sleep(0.05)
+
+    IOLoop.current().run_sync(run_single)
+    assert gateway.broker.messages[-1] == (
+        Message.update_node('1', 'x', 2), False)
+
+
+def test_batch_mixed_messages():
+    gateway = FakeGateway()
+    text = Message.update_node('1', 'x', 0)
+    binary = b'\x82\xa4type\xa3out\xa3uid\xa11'
+
+    async def run():
+        gateway.send_to_broker(text)
+        gateway.send_to_broker(binary)
+        gateway.flush_batch()
+
+    IOLoop.current().run_sync(run)
+
+    # Text and binary messages cannot share a batch, they are sent as is
+    assert gateway.broker.messages == [(text, False), (binary, True)]
+
+
+def test_batch_unsupported():
+    gateway = FakeGateway()
+    gateway.features = frozenset()
+    messages = [Message.update_node('1', 'x', value) for value in range(2)]
+    for message in messages:
+        gateway.send_to_broker(message)
+
+    # Brokers not announcing batches receive the messages as is
+    assert sent(gateway) == messages
+    assert gateway._batch == [] and gateway._batch_timer is None
+
+
+def test_batch_dropped_without_broker(caplog):
+    gateway = FakeGateway()
+
+    async def run():
+        gateway.send_to_broker(Message.update_node('1', 'x', 0))
+        gateway.broker = None
+        with caplog.at_level(logging.WARNING):
+            gateway.flush_batch()
+
+    IOLoop.current().run_sync(run)
+
+    assert gateway._batch == [] and gateway._batch_timer is None
+    assert "dropping 1 messages" in caplog.text
+
+
+def test_send_nodes():
+    gateway = FakeGateway()
+    gateway.options.batch_interval = 0
+    node = Node('1234', led='1')
+    IOLoop.current().run_sync(lambda: gateway.add_node(node))
+
+    # Brokers not announcing snapshots receive new and update messages
+    assert sent(gateway) == [Message.new_node('1234'),
+                             Message.update_node('1234', 'led', '1'),
+                             Message.update_node('1234', 'protocol', 'test')]
+
+    gateway.features = frozenset([SNAPSHOT])
+    gateway.broker = FakeBroker()
+    gateway.fetch_nodes_cache('client')
+    assert sent(gateway) == [Message.snapshot(
+        {'1234': {'led': '1', 'protocol': 'test'}}, dst='client')]
+
+
+def test_reset_node():
+    gateway = FakeGateway()
+    gateway.features = frozenset([SNAPSHOT])
+    gateway.options.batch_interval = 0
+    node = Node('1234', led='1')
+    gateway.nodes['1234'] = node
+    gateway.discover_node = lambda node: None
+    gateway.reset_node(node, {'name': 'node'})
+
+    # The node is known by the broker, only its kept resources are updated
+    assert sent(gateway) == [Message.reset_node('1234'),
+                             Message.update_node('1234', 'protocol', 'test'),
+                             Message.update_node('1234', 'name', 'node')]
+
+
+def test_trace_stamped_when_sent():
+    gateway = FakeGateway()
+    gateway.options.trace = True
+    node = Node('1234')
+
+    async def run():
+        with mock.patch('pyaiot.gateway.common.gateway.time.time',
+                        return_value=2.0):
+            gateway.forward_data_from_node(node, 'led', '1', received=1.0)
+            gateway.forward_data_from_node(node, 'pwm', '2', received=1.0)
+        # The egress timestamp is taken when the batch is sent
+        with mock.patch('pyaiot.gateway.common.gateway.time.time',
+                        return_value=3.0):
+            gateway.flush_batch()
+
+    IOLoop.current().run_sync(run)
+
+    message, reason = Message.check_message(gateway.broker.messages[0][0],
+                                            schemas=GATEWAY_SCHEMAS)
+    assert [record.trace for record in message.records] == [
+        {GATEWAY_IN: 1.0, GATEWAY_OUT: 3.0}] * 2
+    assert 'latency_sum{hop="gateway"} 4\n' in gateway.metrics.expose()
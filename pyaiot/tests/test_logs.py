@@ -0,0 +1,40 @@
+"""pyaiot logging test module."""
+
+import logging
+import logging.handlers
+import os
+import queue
+
+from pytest import mark
+
+from pyaiot.common import logs
+
+
+@mark.skipif(not hasattr(os, 'fork'), reason="requires os.fork")
+def test_listener_restarted_after_fork(tmp_path, monkeypatch):
+    path = tmp_path / 'worker.log'
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(
+        records, logging.FileHandler(str(path)))
+    queue_handler = logs.LogQueueHandler(records)
+    test_logger = logging.getLogger('pyaiot.test.fork')
+    test_logger.addHandler(queue_handler)
+    monkeypatch.setattr(test_logger, 'propagate', False)
+    monkeypatch.setattr(logs, '_listener', listener)
+    monkeypatch.setattr(logs, '_queue_handler', queue_handler)
+    listener.start()
+    try:
+        pid = os.fork()
+        if pid == 0:
+            # The worker records are written by the listener of the child
+            try:
+                test_logger.warning("Record of worker %s", os.getpid())
+                logs.stop_listener()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+    finally:
+        test_logger.removeHandler(queue_handler)
+        listener.stop()
+
+    assert path.read_text() == "Record of worker {}\n".format(pid)
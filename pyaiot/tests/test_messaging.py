@@ -3,7 +3,11 @@
 import json
 from pytest import mark
 
-from pyaiot.common.messaging import Message
+from pyaiot.common.messaging import (
+    Message, JSONCodec, Update, json_codecs, select_wire_format, wire_formats,
+    wire_subprotocol, CLIENT_SCHEMAS, GATEWAY_SCHEMAS, INVALID_FIELDS,
+    INVALID_TYPE, JSON, Out
+)
 
 
 @mark.parametrize('message', [1234, "test", "àéèïôû"])
@@ -13,6 +17,17 @@ def test_serialize(message):
     assert serialized == json.dumps(message, ensure_ascii=False)
 
 
+@mark.parametrize('name', json_codecs())
+def test_json_codecs(name):
+    codec = JSONCodec(name)
+    message = {'type': 'update', 'uid': 'à/1', 'endpoint': 'temperature',
+               'data': [21.5, 1, None, True], 'dst': 'all'}
+
+    assert codec.dumps(message) == JSONCodec('json').dumps(message)
+    assert codec.loads(codec.dumps(message)) == message
+    assert codec.loads(codec.dumps(message).encode()) == message
+
+
 def test_new_node():
     serialized = Message.new_node('1234')
 
@@ -73,9 +88,62 @@ def test_check_message_bad_type():
     assert "Invalid message type" in reason
 
 
-@mark.parametrize('msg_type', ["new", "out", "update", "reset"])
+@mark.parametrize('msg_type', ["new", "out", "update", "reset",
+                                      "subscribe", "unsubscribe", "trace"])
 def test_check_message_valid(msg_type):
     to_test = json.dumps({"type": msg_type, "data": "test"})
     message, reason = Message.check_message(to_test)
     assert message is not None
     assert reason is None
+
+
+@mark.parametrize('raw, schemas, reason', [
+    ('{"type": "update", "endpoint": "led"}', GATEWAY_SCHEMAS,
+     INVALID_FIELDS),
+    ('{"type": "new", "uid": 1234}', GATEWAY_SCHEMAS, INVALID_FIELDS),
+    ('{"type": "out", "uid": "1", "trace": 1}', GATEWAY_SCHEMAS,
+     INVALID_FIELDS),
+    ('{"type": "subscribe"}', GATEWAY_SCHEMAS, INVALID_TYPE),
+    ('{"type": "update", "data": {"uid": "1"}}', CLIENT_SCHEMAS,
+     INVALID_FIELDS),
+    ('{"type": "trace", "data": "test"}', CLIENT_SCHEMAS, INVALID_FIELDS),
+    ('{"type": "update", "data": {"uid": ["1"], "endpoint": "led", '
+     '"payload": "1"}}', CLIENT_SCHEMAS, INVALID_FIELDS),
+    ('{"type": "update", "data": {"uid": "1", "endpoint": {}, '
+     '"payload": "1"}}', CLIENT_SCHEMAS, INVALID_FIELDS),
+])
+def test_check_message_schemas(raw, schemas, reason):
+    assert Message.check_message(raw, schemas=schemas) == (None, reason)
+
+
+def test_check_message_typed():
+    message, reason = Message.check_message(
+        Message.update_node('1234', 'led', '1'), schemas=GATEWAY_SCHEMAS)
+
+    assert reason is None
+    assert isinstance(message, Update)
+    assert (message.uid, message.endpoint, message.data) == ('1234', 'led',
+                                                             '1')
+
+    # Leading whitespace is valid JSON
+    for raw in (' {"type": "out", "uid": "1"}',
+                b'\n{"type": "out", "uid": "1"}'):
+        message, reason = Message.check_message(raw)
+        assert reason is None and isinstance(message, Out)
+
+
+@mark.parametrize('wire_format', wire_formats())
+def test_wire_format_roundtrip(wire_format):
+    serialized = Message.update_node('1234', 'test', 42,
+                                     wire_format=wire_format)
+    message, reason = Message.check_message(serialized, wire_format)
+    assert reason is None
+    assert message == {'type': 'update', 'uid': '1234', 'endpoint': 'test',
+                       'data': 42, 'dst': 'all'}
+
+
+def test_select_wire_format():
+    assert select_wire_format(['token', 'abcd']) == JSON
+    for wire_format in wire_formats():
+        assert select_wire_format(
+            ['token', 'abcd', wire_subprotocol(wire_format)]) == wire_format
@@ -0,0 +1,77 @@
+"""pyaiot typed values test module."""
+
+from pytest import mark
+
+from pyaiot.common.values import (
+    ValueParser, numeric, parse_auto, parse_number, parse_vector,
+    register_unit, UNITS, NUMBER, STRING
+)
+
+
+@mark.parametrize('value,typed', [
+    ('23', 23),
+    ('-1.5', -1.5),
+    ('2e3', 2000.0),
+    ('23.5 °C', {'number': 23.5, 'unit': '°C'}),
+    ('45%', {'number': 45, 'unit': '%'}),
+    ('1013 hPa', {'number': 1013, 'unit': 'hPa'}),
+    ('0.1, 0.2, 9.8', [0.1, 0.2, 9.8]),
+    ('[1;2;3]', [1, 2, 3]),
+])
+def test_parse_auto(value, typed):
+    assert parse_auto(value) == typed
+
+
+@mark.parametrize('value', [
+    '6LoWPAN', '1st floor', '12:30', '2001:db8::1', 'v1.2.3', '1_000',
+    '1e400', '-1e400', 'inf', 'nan', 'Infinity', '1, inf', 'on', '',
+])
+def test_parse_auto_strings(value):
+    # Strings that only look like numbers are not typed
+    assert parse_auto(value) is None
+
+
+def test_parse_number_vector():
+    assert parse_number('1, 2') is None
+    assert parse_number('12 apples') is None
+    assert parse_vector('1 2 3') == [1, 2, 3]
+    assert parse_vector('1e400 2') is None
+
+
+def test_register_unit():
+    assert parse_number('3 furlongs') is None
+    register_unit('furlongs')
+    try:
+        assert parse_number('3 furlongs') == {'number': 3,
+                                              'unit': 'furlongs'}
+    finally:
+        UNITS.discard('furlongs')
+
+
+def test_numeric():
+    assert numeric({'number': 1, 'unit': 'V'}) == 1.0
+    for value in ('inf', 'nan', '1e400', float('inf'), None, [1]):
+        assert numeric(value) is None
+
+
+def test_value_parser():
+    parser = ValueParser({'name': STRING, 'level': NUMBER})
+
+    assert parser.parse('temperature', '21.5°C') == {'number': 21.5,
+                                                     'unit': '°C'}
+    assert parser.parse('network', '6LoWPAN') is None
+    assert parser.parse('name', '42') is None
+    assert parser.parse('level', '1, 2') is None
+    assert parser.parse('level', 3) is None
+
+
+def test_custom_parser_types():
+    parser = ValueParser({'name': str.upper, 'level': lambda value: None,
+                          'ratio': float, 'tags': str.split})
+
+    # Typed forms the broker would reject are ignored
+    assert parser.parse('name', 'node') is None
+    assert parser.parse('level', '1') is None
+    assert parser.parse('ratio', 'inf') is None
+    assert parser.parse('ratio', '0.5') == 0.5
+    assert parser.parse('tags', 'a b') == ['a', 'b']
@@ -80,6 +80,11 @@ if __name__ == '__main__':
             'gmqtt',
             'cryptography>=1.7.2'
           ],
+          extras_require={
+            # Optional binary wire formats of the gateways connections
+            'msgpack': ['msgpack>=1.0'],
+            'cbor': ['cbor2>=5.0'],
+          },
           classifiers=[
             'Development Status :: 4 - Beta',
             'Programming Language :: Python :: 3 :: Only',
@@ -0,0 +1,229 @@
+"""Synthetic load test of a pyaiot broker.
+
+Simulated gateways push node updates at a fixed rate to a broker, started
+in-process or reached by URL, while simulated web clients receive them. The
+end-to-end latency is measured with the latency trace of the updates.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+from array import array
+
+from cryptography.fernet import Fernet
+from tornado.options import options
+from tornado.websocket import websocket_connect
+
+from pyaiot.common.auth import Keys, auth_token, check_key_file
+from pyaiot.common.helpers import parse_command_line
+from pyaiot.common.messaging import (
+    Message, wire_subprotocol, JSON
+)
+from pyaiot.common.trace import GATEWAY_IN, GATEWAY_OUT
+
+SCENARIO = {
+    # None to start a broker in-process, listening on broker_port
+    'broker_url': None,
+    'broker_port': 8100,
+    # Command line options of the in-process broker
+    'broker_options': [],
+    # Keys of a remote broker, and its process id to report its memory
+    'key_file': '~/.pyaiot/keys',
+    'broker_pid': None,
+    'gateways': 10,
+    'nodes': 10,
+    'endpoints': ['temperature'],
+    # Updates per second of each node endpoint
+    'rate': 1.0,
+    'clients': 10,
+    'wire_format': JSON,
+    # Durations in seconds
+    'duration': 30,
+    'drain': 2,
+}
+
+
+class Stats():
+    """Counters and latency samples of a run."""
+
+    def __init__(self):
+        self.sent = 0
+        self.received = 0
+        self.latencies = array('d')
+        self.errors = 0
+
+    def percentile(self, ratio):
+        """Return a latency percentile in milliseconds."""
+        if not self.latencies:
+            return float('nan')
+        ordered = sorted(self.latencies)
+        return ordered[min(int(ratio * len(ordered)), len(ordered) - 1)] * 1e3
+
+
+def broker_rss(pid=None):
+    """Return the resident memory of a process in MB."""
+    try:
+        with open('/proc/{}/status'.format(pid or os.getpid())) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid is None:
+        # Peak memory of the current process, in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return float('nan')
+
+
+def start_broker(scenario):
+    """Start a broker in this process and return its URL and keys."""
+    from pyaiot.broker.application import extra_args
+    from pyaiot.broker.broker import Broker
+
+    sys.argv[1:] = scenario['broker_options']
+    parse_command_line(extra_args_func=extra_args)
+    keys = Keys(private=Fernet.generate_key().decode(),
+                secret=Fernet.generate_key().decode())
+    Broker(keys, options).listen(scenario['broker_port'])
+    return 'ws://localhost:{}'.format(scenario['broker_port']), keys
+
+
+async def run_gateway(url, keys, index, scenario, stats, stop):
+    """Push the updates of the simulated nodes of a gateway."""
+    subprotocols = ['token', auth_token(keys).decode()]
+    wire_format = scenario['wire_format']
+    if wire_format != JSON:
+        subprotocols.append(wire_subprotocol(wire_format))
+    connection = await websocket_connect(url + '/gw',
+                                         subprotocols=subprotocols)
+    binary = wire_format != JSON
+    nodes = ['loadtest-{}-{}'.format(index, node)
+             for node in range(scenario['nodes'])]
+    for uid in nodes:
+        await connection.write_message(
+            Message.new_node(uid, wire_format=wire_format), binary=binary)
+
+    resources = [(uid, endpoint) for uid in nodes
+                 for endpoint in scenario['endpoints']]
+    interval = 1 / (scenario['rate'] * len(resources))
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + random.random() * interval
+    while not stop.is_set():
+        for uid, endpoint in resources:
+            deadline += interval
+            await asyncio.sleep(max(0, deadline - loop.time()))
+            if stop.is_set():
+                break
+            now = time.time()
+            await connection.write_message(
+                Message.update_node(uid, endpoint,
+                                    str(random.randrange(0, 100)),
+                                    wire_format=wire_format,
+                                    trace={GATEWAY_IN: now,
+                                           GATEWAY_OUT: now}),
+                binary=binary)
+            stats.sent += 1
+    connection.close()
+
+
+async def run_client(url, stats, ready):
+    """Receive the updates broadcast to a web client."""
+    connection = await websocket_connect(url + '/ws')
+    await connection.write_message(json.dumps({'type': 'new'}))
+    ready.release()
+    while True:
+        raw = await connection.read_message()
+        if raw is None:
+            break
+        message = json.loads(raw)
+        if message['type'] != 'update' or 'trace' not in message:
+            continue
+        stats.received += 1
+        stats.latencies.append(time.time() - message['trace'][GATEWAY_OUT])
+
+
+async def run(scenario):
+    """Run a load test scenario and return its stats."""
+    if scenario['broker_url'] is None:
+        url, keys = start_broker(scenario)
+        pid = None
+    else:
+        url = scenario['broker_url'].rstrip('/')
+        keys = check_key_file(os.path.expanduser(scenario['key_file']))
+        pid = scenario['broker_pid']
+
+    stats = Stats()
+    stop = asyncio.Event()
+    ready = asyncio.Semaphore(0)
+    clients = [asyncio.ensure_future(run_client(url, stats, ready))
+               for _ in range(scenario['clients'])]
+    for _ in clients:
+        await ready.acquire()
+    gateways = [asyncio.ensure_future(
+        run_gateway(url, keys, index, scenario, stats, stop))
+        for index in range(scenario['gateways'])]
+
+    start = time.time()
+    await asyncio.sleep(scenario['duration'])
+    stop.set()
+    await asyncio.gather(*gateways, return_exceptions=True)
+    elapsed = time.time() - start
+    await asyncio.sleep(scenario['drain'])
+    rss = broker_rss(pid)
+    for client in clients:
+        client.cancel()
+    return stats, elapsed, rss
+
+
+def report(scenario, stats, elapsed, rss):
+    """Print the results of a run."""
+    expected = stats.sent * scenario['clients']
+    print("Gateways: {gateways}, nodes per gateway: {nodes}, endpoints: "
+          "{endpoints}, rate: {rate}/s, clients: {clients}"
+          .format(**scenario))
+    print("Updates sent:       {} ({:.1f}/s)"
+          .format(stats.sent, stats.sent / elapsed))
+    print("Updates delivered:  {} ({:.1f}/s)"
+          .format(stats.received, stats.received / elapsed))
+    print("Dropped:            {} ({:.2%})"
+          .format(expected - stats.received,
+                  (expected - stats.received) / expected if expected else 0))
+    print("Latency p50/p99/p999: {:.2f} / {:.2f} / {:.2f} ms"
+          .format(stats.percentile(0.5), stats.percentile(0.99),
+                  stats.percentile(0.999)))
+    print("Broker RSS:         {:.1f} MB{}"
+          .format(rss, " (including the load test)"
+                  if scenario['broker_url'] is None else ""))
+
+
+def main(args):
+    """Main function."""
+    scenario = dict(SCENARIO)
+    if args.scenario is not None:
+        with open(args.scenario) as scenario_file:
+            scenario.update(json.load(scenario_file))
+    if args.broker_url is not None:
+        scenario.update({'broker_url': args.broker_url})
+    stats, elapsed, rss = asyncio.get_event_loop().run_until_complete(
+        run(scenario))
+    report(scenario, stats, elapsed, rss)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Broker load test")
+    parser.add_argument('scenario', nargs='?', default=None,
+                        help="Scenario file (JSON).")
+    parser.add_argument('--broker-url', type=str, default=None,
+                        help="URL of the broker to test, e.g. "
+                             "ws://localhost:8000, in-process by default.")
+    args = parser.parse_args()
+    try:
+        main(args)
+    except KeyboardInterrupt:
+        print("Exiting")
+        sys.exit()
@@ -0,0 +1,51 @@
+"""Benchmark of the JSON codecs available to pyaiot messaging."""
+
+import sys
+import timeit
+import argparse
+
+from pyaiot.common.messaging import JSONCodec, json_codecs
+
+MESSAGES = {
+    'update': {'type': 'update', 'uid': 'fd00:aaaa:bbbb::1',
+               'endpoint': 'temperature', 'data': '21.5°C', 'dst': 'all',
+               'trace': {'gw_in': 1500000000.123456,
+                         'gw_out': 1500000000.123789}},
+    'command': {'type': 'update', 'src': 'client',
+                'data': {'uid': 'fd00:aaaa:bbbb::1', 'endpoint': 'led',
+                         'payload': '1'}},
+    # Cached resources of 100 nodes, as served by the broker on /nodes
+    'nodes': {'node-{}'.format(uid): {'name': 'node', 'os': 'riot',
+                                      'temperature': '21.5°C',
+                                      'pressure': '1013hPa', 'led': '0'}
+              for uid in range(100)},
+}
+
+
+def main(args):
+    """Main function."""
+    print("{:8} {:8} {:>14} {:>14}".format("codec", "message",
+                                           "encode (µs)", "decode (µs)"))
+    for name in json_codecs():
+        codec = JSONCodec(name)
+        for kind, message in MESSAGES.items():
+            raw = codec.dumps(message)
+            encode = min(timeit.repeat(lambda: codec.dumps(message),
+                                       number=args.number, repeat=3))
+            decode = min(timeit.repeat(lambda: codec.loads(raw),
+                                       number=args.number, repeat=3))
+            print("{:8} {:8} {:14.2f} {:14.2f}".format(
+                name, kind, encode / args.number * 1e6,
+                decode / args.number * 1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="JSON codecs benchmark")
+    parser.add_argument('--number', type=int, default=10000,
+                        help="Number of operations per measure.")
+    args = parser.parse_args()
+    try:
+        main(args)
+    except KeyboardInterrupt:
+        print("Exiting")
+        sys.exit()